@@ -36,4 +36,28 @@ CREATE TABLE IF NOT EXISTS `t_document_chunk` (
   `crt` timestamp NULL DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间',
   `upt` timestamp NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '更新时间',
   PRIMARY KEY (`oid`) COMMENT '文档分片表'
-) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin COMMENT='文档分片表';
\ No newline at end of file
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin COMMENT='文档分片表';
+
+CREATE TABLE IF NOT EXISTS `t_document_job` (
+  `oid` bigint unsigned NOT NULL,
+  `doc_oid` bigint unsigned NOT NULL COMMENT '文档ID',
+  `status` tinyint DEFAULT '0' COMMENT '任务状态:0-排队,1-执行中,2-已完成,3-失败',
+  `stage` varchar(32) COLLATE utf8mb4_bin DEFAULT 'queued' COMMENT '当前阶段',
+  `owner` varchar(128) COLLATE utf8mb4_bin DEFAULT NULL COMMENT '执行进程(主机名:pid)',
+  `active_doc_oid` bigint unsigned DEFAULT NULL COMMENT '排队或执行中时等于doc_oid, 结束后置空, 保证同一文档只有一个未结束任务',
+  `pages_total` int DEFAULT '0' COMMENT '总页数',
+  `pages_parsed` int DEFAULT '0' COMMENT '已解析页数',
+  `chunks_total` int DEFAULT '0' COMMENT '分片总数',
+  `chunks_embedded` int DEFAULT '0' COMMENT '已向量化分片数',
+  `chunks_questioned` int DEFAULT '0' COMMENT '已生成模拟问题分片数',
+  `chunks_indexed` int DEFAULT '0' COMMENT '已写入索引分片数',
+  `error` varchar(1000) COLLATE utf8mb4_bin DEFAULT NULL COMMENT '失败原因',
+  `started_at` timestamp NULL DEFAULT NULL COMMENT '开始时间',
+  `finished_at` timestamp NULL DEFAULT NULL COMMENT '结束时间',
+  `crt` timestamp NULL DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间',
+  `upt` timestamp NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '更新时间',
+  PRIMARY KEY (`oid`),
+  UNIQUE KEY `uk_active_doc_oid` (`active_doc_oid`),
+  KEY `idx_doc_oid` (`doc_oid`),
+  KEY `idx_status_upt` (`status`, `upt`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin COMMENT='文档分片任务表';
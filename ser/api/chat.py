@@ -1,23 +1,32 @@
+import asyncio
+import json
 import logging
 import time
 
 from fastapi import APIRouter
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
 
+from ser.utils.chat_history import chat_history
 from ser.utils.comm import get_current_time, create_response
-from ser.utils.elasticsearch_cli import es_client
-from ser.utils.model_cli import embed, llm
-from ser.utils.redis_cli import redis_client
+from ser.utils.context_select import context_selector
+from ser.utils.history_summary import history_summarizer
+from ser.utils.metrics import span, stage_seconds
+from ser.utils.model_worker import model_client
+from ser.utils.prompt_assembler import prompt_assembler
+from ser.utils.reranker import rerank_stage
+from ser.utils.retrieval import retriever
+from ser.utils.retrieval_cache import retrieval_cache
+from ser.utils.semantic_cache import semantic_cache
+from ser.utils.work_scheduler import work_scheduler
 
 router = APIRouter()
 
-# 历史记录条数
-history_chat_limit = 20
 
-index_name = 'rag_demo_es_document_index'
-
-
-prompt = '''
+# 系统提示词: 各轮不变, 放在最前面
+system_prompt = '''
 #角色
 - 你是基于文档片段进行整理总结要点进行回复的小助理
 - 你是可以自我思考的智慧体
@@ -30,7 +39,10 @@ prompt = '''
 #限制
 - 禁止胡言乱语
 - 不知道或不清楚直接明确回复'无法回答您的问题'
+'''
 
+# 本轮用户消息: 检索到的文档片段与当前问题
+user_prompt = '''
 <文档片段>
 {document_chunk}
 </文档片段>
@@ -47,91 +59,249 @@ class ChatSendRequest(BaseModel):
     message: str
 
 
-def query_elasticsearch(query_text,top_k=20, min_score=6):
-    '''混合搜索：结合全文检索和向量相似度'''
-
-    query_vector = embed([query_text])[0].tolist()
-    es_query = {
-        "query": {
-            "bool": {
-
-                "should": [
-                    {
-                        "multi_match": {
-                            "query": query_text,
-                            "fields": ["content","questions"],
-                            "boost": 0.4
-                        }
-                    },
-                    {
-                        "script_score": {
-                            "query": {"match_all": {}},
-                            "script": {
-                                "source": f"Math.max(0, cosineSimilarity(params.query_vector, 'emb_512')) * {0.6}",
-                                "params": {
-                                    "query_vector": query_vector
-                                }
-                            }
-                        }
-                    }
-                ]
-            }
-        },
-        "size": top_k,
-        "min_score": min_score
-    }
-    content_str = ''
-    es_result = es_client.search(index=index_name, query=es_query)
-    for i, hit in enumerate(es_result['hits']['hits']):
-        logging.info(f"结果 {i + 1}  ID: {hit['_id']} 分数: {hit['_score']}")
-        logging.info(f"  内容预览: {hit['_source']['content'][:100]}...")
-        if hit['_score'] >= min_score:
-            content_str += hit['_source']['content'] + '\n'
+def log_hits(hits):
+    for i, hit in enumerate(hits):
+        logging.info(f"结果 {i + 1}  ID: {hit['id']} 分数: {hit['score']:.4f} "
+                     f"向量: {hit['vector_score']} 全文: {hit['lexical_score']}")
+        logging.info(f"  内容预览: {hit['content'][:100]}...")
+
+
+async def aquery_elasticsearch(query_text, query_vector, top_k=None, min_score=None):
+    '''混合搜索(异步客户端, 不阻塞事件循环)'''
+    hits = await retriever.asearch(query_text, query_vector, top_k=top_k, min_score=min_score)
+    log_hits(hits)
+    return hits
+
+
+async def prepare_chat(question, user_identifier):
+    '''
+    检索文档并组装对话
+    返回上下文: cache_hit 是否命中语义缓存, retrieval_cache_hit 是否命中检索缓存, answer 缓存回答,
+    content_str 使用的文档内容, messages 发送给模型的消息, used_hits 使用的检索结果, user_message 本轮用户消息,
+    cacheable 是否可使用语义缓存(无历史上下文的首轮问题)
+    '''
+    st = time.time()
+    ctx = {'cache_hit': False, 'retrieval_cache_hit': False, 'answer': None, 'messages': None, 'used_hits': [],
+           'rerank': None, 'cacheable': False}
+    # 获取历史与向量化/检索并发进行
+    history_task = asyncio.create_task(chat_history.aget_context(user_identifier))
+    summary_task = asyncio.create_task(history_summarizer.aget(user_identifier)) if history_summarizer else None
+    try:
+        # 问题向量(与并发请求合并批量计算)
+        with span('embed'):
+            query_vector = await model_client.embed_query(question)
+        ctx['query_vector'] = query_vector
+        chat_his_msg = await history_task
+        summary = await summary_task if summary_task else {}
+
+        # 缓存只按问题向量匹配, 有历史上下文的追问(如"第二个呢?")含义依赖本会话, 不查也不写缓存
+        ctx['cacheable'] = semantic_cache is not None and not chat_his_msg and not summary.get('summary')
+        # 相似问题直接复用缓存回答
+        with span('semantic_cache'):
+            cached = await run_in_threadpool(semantic_cache.lookup, query_vector) if ctx['cacheable'] else None
+        if cached:
+            ctx.update(cache_hit=True, answer=cached['answer'], content_str=cached['related_docs'])
+            hits = None
         else:
-            logging.info("pass..")
-    # 重排序-暂不实现
-    return content_str
+            # 根据问题搜索es, 索引未变化时复用检索结果
+            top_k = rerank_stage.candidates if rerank_stage else retriever.top_k
+            hits, generation = (await retrieval_cache.get(question, top_k, retriever.min_score)
+                                if retrieval_cache else (None, -1))
+            ctx['retrieval_cache_hit'] = hits is not None
+            if hits is None:
+                with span('retrieval'):
+                    hits = await aquery_elasticsearch(question, query_vector, top_k)
+                if retrieval_cache:
+                    await retrieval_cache.put(question, top_k, retriever.min_score, hits, generation)
+    finally:
+        for task in (history_task, summary_task):
+            if task and not task.done():
+                task.cancel()
+    logging.info(f"历史记录条数: {len(chat_his_msg)}")
+    # 已被摘要覆盖的较早消息不再原文发送, 摘要并入系统提示词
+    chat_system_prompt = system_prompt
+    if history_summarizer:
+        chat_his_msg, summary_text = history_summarizer.apply(chat_his_msg, summary)
+        if summary_text:
+            chat_system_prompt = system_prompt + f"#此前对话摘要\n{summary_text}\n"
+
+    if hits is not None:
+        # 重排序: cross-encoder精排, 超出延迟预算时沿用召回顺序
+        if rerank_stage:
+            with span('rerank'):
+                hits, ctx['rerank'] = await rerank_stage.rerank(question, hits,
+                                                                elapsed_ms=(time.time() - st) * 1000)
+        # 折叠重复分片, MMR选出相关且多样的片段
+        if context_selector:
+            with span('context_select'):
+                hits = await run_in_threadpool(context_selector.select, hits, ctx['query_vector'],
+                                               prompt_assembler.count)
+        # 按token预算组装提示词
+        with span('prompt_build'):
+            messages, chunk_ids, _, _ = await run_in_threadpool(
+                prompt_assembler.assemble,
+                chat_system_prompt, user_prompt, question, [hit['content'] for hit in hits], chat_his_msg
+            )
+        ctx['used_hits'] = [hits[i] for i in chunk_ids]
+        ctx['content_str'] = ''.join(hit['content'] + '\n' for hit in ctx['used_hits'])
+        ctx['messages'] = messages
+
+    ctx['user_message'] = {"role": "user", "content": question, 'timestamp': get_current_time()}
+    stage_seconds.observe(time.time() - st, 'chat_prepare')
+    return ctx
+
+
+def cache_answer(question, ctx, answer, cost_ms):
+    '''回答写入语义缓存'''
+    if not ctx['cacheable'] or ctx['cache_hit'] or not answer:
+        return
+    # 没有使用任何文档片段的回答(如"无法回答您的问题")不关联文档, 新文档入库时无法失效, 不缓存
+    if not ctx['used_hits']:
+        return
+    semantic_cache.store(question, ctx['query_vector'], answer, ctx['content_str'],
+                         chunk_ids=[hit['id'] for hit in ctx['used_hits']],
+                         doc_oids=[hit['doc_oid'] for hit in ctx['used_hits'] if hit.get('doc_oid')],
+                         cost_ms=cost_ms)
+
 
+def save_chat(user_identifier, ctx, answer):
+    '''本轮问题与回复一起追加到历史记录'''
+    chat_history.append(user_identifier, [
+        ctx['user_message'], {"role": "assistant", "content": answer, 'timestamp': get_current_time()}])
+    if history_summarizer:
+        history_summarizer.schedule(user_identifier)
 
 
+async def asave_chat(user_identifier, ctx, answer):
+    '''本轮问题与回复一起追加到历史记录(异步)'''
+    await chat_history.aappend(user_identifier, [
+        ctx['user_message'], {"role": "assistant", "content": answer, 'timestamp': get_current_time()}])
+    # 历史过长时在后台生成摘要
+    if history_summarizer:
+        history_summarizer.schedule(user_identifier)
+
 
 @router.post("/chat/send")
 async def send_chat_message(request: ChatSendRequest):
     """发送聊天消息"""
     question = request.message
     user_identifier = request.user_identifier
+    # 模型通道已满时在检索前拒绝
+    if work_scheduler:
+        work_scheduler.check('chat')
     st = time.time()
-    # 根据问题搜索es
-    content_str = query_elasticsearch( question )
-    # 获取历史
-    chat_his_list = redis_client.get_list(f"chat_history:{user_identifier}")
-    logging.info(f"历史记录条数: {len(chat_his_list)}")
-    # 构建提示词
-    sys_prom= prompt.format(document_chunk=content_str, question=question)
-
-    # 构建数据体
-    messages = [{"role": "system", "content": sys_prom, "timestamp": get_current_time()}]
-
-    chat_his_msg = chat_his_list[-history_chat_limit:] if len(chat_his_list) > history_chat_limit else chat_his_list
-    messages.extend(chat_his_msg)
+    ctx = await prepare_chat(question, user_identifier)
     et = time.time()
 
-    # 开始使用llm
-    chat_his_msg.append({"role": "user", "content": question, 'timestamp': get_current_time()})
-    answer = llm(chat_his_list)
-    chat_his_msg.append({"role": "assistant", "content": answer, 'timestamp': get_current_time()})
+    if ctx['cache_hit']:
+        answer = ctx['answer']
+    else:
+        # 开始使用llm
+        with span('llm'):
+            answer = await model_client.llm(ctx['messages'], profile='chat', session_id=user_identifier)
+        await run_in_threadpool(cache_answer, question, ctx, answer, (time.time() - st) * 1000)
 
     # 存入redis覆盖历史记录
-    redis_client.set_list(f"chat_history:{user_identifier}", chat_his_msg)
+    await asave_chat(user_identifier, ctx, answer)
     response_time =  round((et - st) * 1000)
+    total_time = time.time() - st
+    stage_seconds.observe(total_time, 'chat_request')
 
     # 构建响应
     return create_response(data={
         'ai_response': answer,
+        # response_time 为检索与历史耗时, total_time 含生成
         'response_time': response_time,
-        'related_docs' : content_str
+        'total_time': round(total_time * 1000),
+        'related_docs' : ctx['content_str'],
+        'cache_hit': ctx['cache_hit'],
+        'retrieval_cache_hit': ctx['retrieval_cache_hit'],
+        'rerank': ctx['rerank']
     })
 
+
+def sse_event(data, event=None):
+    '''构建SSE消息'''
+    head = f"event: {event}\n" if event else ''
+    return f"{head}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@router.post("/chat/send/stream")
+async def send_chat_message_stream(request: ChatSendRequest):
+    """发送聊天消息(SSE流式返回)
+    事件格式:
+    data: {"delta": "片段"}                       逐段回复
+    event: done
+    data: {"ttft": 首字耗时ms, "total_time": 总耗时ms, "response_time": 检索耗时ms, "related_docs": "...",
+           "cache_hit": 是否命中语义缓存, "retrieval_cache_hit": 是否命中检索缓存, "rerank": 重排序阶段信息}
+    """
+    question = request.message
+    user_identifier = request.user_identifier
+    if work_scheduler:
+        work_scheduler.check('chat')
+    st = time.time()
+    ctx = await prepare_chat(question, user_identifier)
+    et = time.time()
+    # 生成所需的 chat 槽位在返回响应前申请: 通道已满时返回429与Retry-After, 而不是200后的SSE错误事件
+    reservation = None
+    if work_scheduler and not ctx['cache_hit']:
+        reservation = await work_scheduler.areserve('chat')
+    started = []
+
+    def release_unstarted():
+        # 客户端在开始迭代前断开时生成器不会执行, 由响应结束后的后台任务归还槽位
+        if reservation is not None and not started:
+            reservation.release()
+
+    def event_stream():
+        # 同步生成器由starlette放到线程池迭代, 不阻塞事件循环
+        started.append(True)
+        pieces = []
+        first_token_time = None
+        completed = False
+        try:
+            if ctx['cache_hit']:
+                stream = iter([ctx['answer']])
+            else:
+                stream = model_client.llm_stream(ctx['messages'], profile='chat', session_id=user_identifier,
+                                                 reservation=reservation)
+            for piece in stream:
+                if first_token_time is None:
+                    first_token_time = time.time()
+                pieces.append(piece)
+                yield sse_event({'delta': piece})
+            completed = True
+        except Exception as e:
+            logging.error(f"流式生成异常: {e}")
+            yield sse_event({'error': str(e)}, event='error')
+        finally:
+            answer = ''.join(pieces)
+            if answer:
+                # 历史记录保存用户已收到的内容(断开/出错时为部分回复), 下一轮可据此继续追问
+                save_chat(user_identifier, ctx, answer)
+            # 只有完整生成的回复才写入语义缓存, 截断的回复不能复用给相似问题
+            if completed:
+                cache_answer(question, ctx, answer, (time.time() - st) * 1000)
+        end_time = time.time()
+        stage_seconds.observe((first_token_time or end_time) - st, 'chat_ttft')
+        stage_seconds.observe(end_time - st, 'chat_request')
+        ttft = round(((first_token_time or end_time) - st) * 1000)
+        total_time = round((end_time - st) * 1000)
+        logging.info(f"流式回复 user={user_identifier} ttft={ttft}ms total={total_time}ms")
+        yield sse_event({
+            'ttft': ttft,
+            'total_time': total_time,
+            'response_time': round((et - st) * 1000),
+            'related_docs': ctx['content_str'],
+            'cache_hit': ctx['cache_hit'],
+            'retrieval_cache_hit': ctx['retrieval_cache_hit'],
+            'rerank': ctx['rerank']
+        }, event='done')
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+                             background=BackgroundTask(release_unstarted))
+
 @router.get("/chat/history")
 async def get_chat_history(user_identifier: str):
     """获取聊天历史
@@ -141,6 +311,6 @@ async def get_chat_history(user_identifier: str):
     ...
     ]
     """
-    chat_his_list = redis_client.get_list(f"chat_history:{user_identifier}")
+    chat_his_list = await chat_history.aget_all(user_identifier)
 
     return create_response(data=chat_his_list)
@@ -3,27 +3,43 @@ import hashlib
 import logging
 import os
 import ast
+import json
+import re
+import time
 
 from fastapi import APIRouter
+from fastapi.concurrency import run_in_threadpool
 from ser.utils.comm import create_response_error_1003, create_response
 from ser.utils.db import get_pool_conn
 
 from ser.utils.comm import generate_vector_id
+from ser.utils.conf import get_config
 from ser.utils.elasticsearch_cli import es_client
 from ser.utils.genid import IDGeneratorFactory
+from ser.utils.ingest_cache import ingest_cache, embedding_model_id, question_model_id
 
+from ser.utils.metrics import timed, span
 from ser.utils.md_chunk import  mdfile_img_replace, SmartMarkdownSplitter
-from ser.utils.mineru_pdf_pause import do_parse
+from ser.utils.mineru_pdf_pause import do_parse, pdf_page_count
 
 from ser.utils.minio_cli import minio_client
 
-from ser.utils.model_cli import embed, llm
+from ser.utils.model_worker import model_client
+from ser.utils.semantic_cache import semantic_cache
+from ser.utils.document_jobs import document_jobs, JobProgress
 
 
 router = APIRouter()
 
 index_name = 'rag_demo_es_document_index'
 
+# 入库向量化批大小, 设为1即逐条encode(原有方式), 便于对比吞吐
+ingest_embed_batch_size = get_config('model', {}).get('embed_ingest', {}).get('batch_size', 32)
+# 模拟问题批量生成, 每批合并的分片数
+question_gen_batch_size = get_config('model', {}).get('question_gen', {}).get('batch_size', 8)
+# 向量化/模拟问题/写入es 按组推进, 每组完成后更新任务进度
+index_group_size = get_config('chunk_jobs', {}).get('index_group_size', 64)
+
 # 创建文档分片索引，支持全文和向量混合检索
 document_chunk_mapping = {
     "settings": {
@@ -48,6 +64,7 @@ document_chunk_mapping = {
             "chunk_oid": {"type": "keyword"},  # 分片ID
             "chunk_index": {"type": "integer", "index": True},  # 分片序号
             "vector_id": {"type": "keyword", "index": True},  # 向量ID (hash)
+            "content_hash": {"type": "keyword"},  # 分片内容md5, 检索后去重
             "content": {"type": "text", "analyzer": "whitespace", "similarity": "scripted_sim"},  # 分片文本内容
             "emb_512": {
                 "type": "dense_vector",
@@ -72,15 +89,22 @@ document_chunk_mapping = {
 # 创建es索引
 es_client.create_index(index_name, document_chunk_mapping)
 
-def do_chunk_pdf(doc_name,file_path,):
+def do_chunk_pdf(doc_name,file_path,progress=None):
     '''
     0 获取minoio的数据
     1 pdf转换成md
     2 存储md文件及md图片
     3 返回切片文本
     '''
+    progress = progress or JobProgress()
     fbytes = minio_client.download_file(file_path)
-    mdfs, imgdir, imgprev = do_parse(doc_name, fbytes)
+    pages = pdf_page_count(fbytes)
+    progress.set(pages_total=pages)
+    progress.set_stage('parsing')
+    with span('pdf_parse'):
+        mdfs, imgdir, imgprev = do_parse(doc_name, fbytes)
+    # mineru 整份文档一次解析, 完成后页数一次到位
+    progress.set(pages_parsed=pages)
 
     # 图片资源上传
     image_url_list = minio_client.upload_directory(imgdir, imgprev)
@@ -117,25 +141,132 @@ def create_mysql_chunk_metadata(document_oid, chunks):
         })
     return chunks_dbs
 
-def llm_create_questions(text):
-    '''llm构建模拟问题'''
-    messages = [
+def question_messages(text):
+    '''构建模拟问题提示词'''
+    return [
         {"role": "user", "content": f'#文本片段'
                                     f'\n{text}'
                                     f'\n\n请根据以上内容,模拟提出最多3个问题'
                                     f'\n请以标准JSON数组格式输出,例如：[\"问题1\", \"问题2\", \"问题3\"]'}
     ]
-    return ast.literal_eval(llm(messages))
 
 
-def sava_elasticsearch_index(chunks_dbs):
+def parse_questions(output):
+    '''解析llm输出的问题数组, 解析失败返回空列表'''
+    candidates = [output]
+    # 兼容输出中夹带说明文字或代码块的情况
+    matched = re.search(r'\[.*\]', output, flags=re.DOTALL)
+    if matched:
+        candidates.append(matched.group(0))
+    for candidate in candidates:
+        for loads in (ast.literal_eval, json.loads):
+            try:
+                questions = loads(candidate.strip())
+            except Exception:
+                continue
+            if isinstance(questions, list):
+                return [str(q) for q in questions if q]
+    logging.warning(f"模拟问题解析失败: {output[:200]}")
+    return []
+
+
+# 问题生成提示词变化时缓存随之失效
+question_cache_id = (f"{question_model_id}:"
+                     f"{hashlib.md5(json.dumps(question_messages(''), ensure_ascii=False).encode('utf-8')).hexdigest()[:8]}")
+
+
+def llm_create_questions(text):
+    '''llm构建模拟问题'''
+    return parse_questions(model_client.llm_sync(question_messages(text), profile='question_gen'))
+
+
+def llm_create_questions_batch(texts):
+    '''批量构建模拟问题, 返回结果与texts一一对应, 单个分片失败不影响其他分片'''
+    results = []
+    for start in range(0, len(texts), question_gen_batch_size):
+        group = texts[start:start + question_gen_batch_size]
+        try:
+            outputs = model_client.llm_batch([question_messages(text) for text in group], profile='question_gen')
+            results.extend(parse_questions(output) for output in outputs)
+        except Exception as e:
+            # 整批生成失败时逐条重试, 把失败隔离到单个分片
+            logging.error(f"批量生成模拟问题失败, 逐条重试: {e}")
+            for text in group:
+                try:
+                    results.append(llm_create_questions(text))
+                except Exception as ex:
+                    logging.error(f"模拟问题生成失败: {ex}")
+                    results.append([])
+        logging.info(f"模拟问题生成进度 {len(results)}/{len(texts)}")
+    return results
+
+
+def embed_chunks(chunks_dbs):
+    '''分片批量向量化, 返回结果与chunks_dbs一一对应'''
+    st = time.time()
+    embeddings = model_client.embed_batch([b['chunk_content'] for b in chunks_dbs], ingest_embed_batch_size)
+    cost = time.time() - st
+    logging.info(f"向量化分片 {len(chunks_dbs)} 条 耗时 {cost:.2f}s "
+                 f"吞吐 {len(chunks_dbs) / cost if cost > 0 else 0:.1f} chunks/s "
+                 f"batch_size={ingest_embed_batch_size}")
+    return embeddings
+
+
+def embed_chunks_cached(chunks_dbs):
+    '''按content_hash复用已缓存的向量, 只对未命中且去重后的分片做向量化'''
+    hashes = [b['content_hash'] for b in chunks_dbs]
+    if ingest_cache is None:
+        return list(embed_chunks(chunks_dbs))
+    cached = ingest_cache.get_embeddings(embedding_model_id, hashes)
+    misses = list({b['content_hash']: b for b in chunks_dbs if b['content_hash'] not in cached}.values())
+    if misses:
+        embeddings = embed_chunks(misses)
+        ingest_cache.put_embeddings(embedding_model_id, [b['content_hash'] for b in misses], embeddings)
+        cached.update(zip([b['content_hash'] for b in misses], embeddings))
+    logging.info(f"向量缓存命中 {len(chunks_dbs) - len(misses)}/{len(chunks_dbs)}")
+    return [cached[h] for h in hashes]
+
+
+def create_questions_cached(chunks_dbs):
+    '''按content_hash复用已生成的模拟问题, 只对未命中的分片调用llm'''
+    hashes = [b['content_hash'] for b in chunks_dbs]
+    if ingest_cache is None:
+        return llm_create_questions_batch([b['chunk_content'] for b in chunks_dbs])
+    cached = ingest_cache.get_questions(question_cache_id, hashes)
+    misses = list({b['content_hash']: b for b in chunks_dbs if b['content_hash'] not in cached}.values())
+    if misses:
+        questions_list = llm_create_questions_batch([b['chunk_content'] for b in misses])
+        generated = dict(zip([b['content_hash'] for b in misses], questions_list))
+        # 生成失败(空列表)不写缓存, 下次重试
+        ingest_cache.put_questions(question_cache_id, {h: q for h, q in generated.items() if q})
+        cached.update(generated)
+    logging.info(f"模拟问题缓存命中 {len(chunks_dbs) - len(misses)}/{len(chunks_dbs)}")
+    return [cached[h] for h in hashes]
+
+
+def sava_elasticsearch_index(chunks_dbs, progress=None):
+    '''按组 向量化->模拟问题->写入es, 每组完成后上报进度'''
+    progress = progress or JobProgress()
+    for start in range(0, len(chunks_dbs), index_group_size):
+        group = chunks_dbs[start:start + index_group_size]
+        # 文本转向量(仅缓存未命中的分片)
+        with span('ingest_embed'):
+            embeddings = embed_chunks_cached(group)
+        progress.advance('chunks_embedded', len(group))
+        # 批量生成模拟问题(仅缓存未命中的分片)
+        with span('question_gen'):
+            questions_list = create_questions_cached(group)
+        progress.advance('chunks_questioned', len(group))
+        save_elasticsearch_group(group, embeddings, questions_list)
+        progress.advance('chunks_indexed', len(group))
+
+
+def save_elasticsearch_group(chunks_dbs, embeddings, questions_list):
     # 存储索引
     actions = []
-    for b in chunks_dbs:
-        # 文本转向量
+    for b, emb, questions in zip(chunks_dbs, embeddings, questions_list):
         content = b['chunk_content']
-        embedding = embed([content])[0].tolist()
-        questions = llm_create_questions(content)
+        embedding = emb.tolist()
         # logging.info(f"chunk={content}\n{questions}")
         es_doc = {
             "_index": index_name,
@@ -145,6 +276,7 @@ def sava_elasticsearch_index(chunks_dbs):
                 "chunk_oid": b['oid'],
                 "chunk_index": b['chunk_index'],
                 "vector_id": b['vector_id'],
+                "content_hash": b['content_hash'],
                 "content": content,
                 "emb_512": embedding,
                 "questions": questions if questions else [],
@@ -186,42 +318,77 @@ def update_chunk_state(document_oid, chunk_count,chunk_status):
 
 @router.post("/document/chunk")
 async def start_document_chunk(request: dict):
-    """开始文档分片"""
+    """开始文档分片
+    创建后台任务后立即返回任务ID, 解析/向量化/入库在任务线程池执行, 进度见 /document/chunk/status
+    """
     doc_oid = request.get("doc_id")
     logging.info(f"文档分片 {doc_oid}")
-    try:
-        with get_pool_conn() as db:
-            t_document = db['t_document']
-            # 查询t_document MD5是否已存在
-            info = t_document.find_one(oid=doc_oid)
-            logging.info(f'文档分片 info={info}')
-            if not info:
-                return create_response_error_1003('文档不存在')
-
-            # 文档分片
-            mine_type = info['mime_type']
-            doc_name = info['doc_name']
-            file_path = info['file_path']
-            if mine_type == 'application/pdf':
-                document_oid = info['oid']
-                chunks , image_url_list = do_chunk_pdf(doc_name,file_path)
-                # 创建mysql分片数据表 图片数据表
-                chunks_dbs = create_mysql_chunk_metadata(document_oid,chunks)
-                # 文本embd->存储elasticsearch
-                sava_elasticsearch_index(chunks_dbs)
-                # 存入mysql元素据
-                save_mysql(chunks_dbs)
-                # 修改文档状态表
-                update_chunk_state(document_oid,len(chunks),2)
-
-            else : raise Exception('不支持的文档类型')
-
-            return create_response(data={
-                "task_id": f"chunk_task_{doc_oid}",
-                "status": "completed"
-            })
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return create_response_error_1003(f'文档分片异常{e}')
+    return await run_in_threadpool(submit_document_chunk, doc_oid)
+
 
+def submit_document_chunk(doc_oid):
+    with get_pool_conn() as db:
+        info = db['t_document'].find_one(oid=doc_oid)
+    logging.info(f'文档分片 info={info}')
+    if not info:
+        return create_response_error_1003('文档不存在')
+    if info['mime_type'] != 'application/pdf':
+        return create_response_error_1003('不支持的文档类型')
+    task_id, status = document_jobs.submit(info['oid'], do_document_chunk)
+    return create_response(data={
+        "task_id": task_id,
+        "status": status
+    })
+
+
+@router.get("/document/chunk/status")
+async def get_document_chunk_status(task_id: str = None, doc_id: str = None):
+    """分片任务状态
+    按task_id查询, 或按doc_id查询该文档最近一次任务
+    status: queued/running/completed/failed
+    stage: queued/parsing/splitting/indexing/saving/completed/failed
+    progress: {pages_total, pages_parsed, chunks_total, chunks_embedded, chunks_questioned, chunks_indexed}
+    """
+    if not task_id and not doc_id:
+        return create_response_error_1003('缺少task_id或doc_id')
+    status = await run_in_threadpool(document_jobs.status, task_id, doc_id)
+    if not status:
+        return create_response_error_1003('任务不存在')
+    return create_response(data=status)
+
+
+@timed('document_chunk')
+def do_document_chunk(doc_oid, progress=None):
+    """执行文档分片, 返回分片数量; 由后台任务调用, 失败时文档恢复为未分片并抛出异常"""
+    progress = progress or JobProgress()
+    with get_pool_conn() as db:
+        info = db['t_document'].find_one(oid=doc_oid)
+    if not info:
+        raise Exception('文档不存在')
+    if info['mime_type'] != 'application/pdf':
+        raise Exception('不支持的文档类型')
+
+    document_oid = info['oid']
+    update_chunk_state(document_oid, 0, 1)
+    try:
+        # 文档分片
+        chunks , image_url_list = do_chunk_pdf(info['doc_name'], info['file_path'], progress)
+        progress.set_stage('splitting')
+        # 创建mysql分片数据表 图片数据表
+        chunks_dbs = create_mysql_chunk_metadata(document_oid,chunks)
+        progress.set(chunks_total=len(chunks_dbs))
+        # 文本embd->存储elasticsearch
+        progress.set_stage('indexing')
+        sava_elasticsearch_index(chunks_dbs, progress)
+        # 文档内容已变化, 失效引用该文档的缓存回答; 写入索引时已等待refresh, 此后的检索能查到新分片
+        if semantic_cache:
+            semantic_cache.invalidate_docs([document_oid])
+        # 存入mysql元素据
+        progress.set_stage('saving')
+        save_mysql(chunks_dbs)
+        # 修改文档状态表
+        update_chunk_state(document_oid,len(chunks),2)
+        return len(chunks)
+    except Exception:
+        update_chunk_state(document_oid, 0, 0)
+        raise
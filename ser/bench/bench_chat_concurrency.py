@@ -0,0 +1,120 @@
+"""
+聊天检索阶段并发吞吐: 同步客户端(线程池, 检索与历史串行) vs 异步客户端(检索与历史并发)
+默认只压测 检索+历史 阶段, 使用随机查询向量, 不依赖模型;
+指定 --url 时对运行中的服务 /api/chat/send 做端到端压测, 可分别对新旧版本服务运行对比
+运行: python ser/bench/bench_chat_concurrency.py [--clients 100] [--requests 1000] [--url http://127.0.0.1:8000]
+"""
+import sys
+import os
+
+project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, project_root)
+
+import argparse
+import asyncio
+import logging
+import time
+
+import numpy as np
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+from fastapi.concurrency import run_in_threadpool
+
+from ser.utils.chat_history import chat_history
+from ser.utils.elasticsearch_cli import es_client
+from ser.utils.redis_cli import redis_client
+from ser.utils.retrieval import retriever
+
+questions = [
+    '这份文档的主要内容是什么？',
+    '北斗系统有哪些主要应用场景？',
+    '如何提高文档检索的准确率？',
+    'RAG系统由哪些部分组成？',
+]
+
+
+def random_vector(rng):
+    vector = rng.standard_normal(512).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+async def stage_sync(i, vector):
+    """原实现: 同步客户端放到线程池, 检索后再取历史"""
+    await run_in_threadpool(retriever.search, questions[i % len(questions)], vector)
+    await run_in_threadpool(redis_client.get_list, f"chat_history:bench_{i % 100}")
+
+
+async def stage_async(i, vector):
+    """异步客户端, 检索与取历史并发"""
+    await asyncio.gather(
+        retriever.asearch(questions[i % len(questions)], vector),
+        chat_history.aget_window(f"bench_{i % 100}"),
+    )
+
+
+async def run(fn, clients, total):
+    rng = np.random.default_rng(0)
+    vectors = [random_vector(rng) for _ in range(64)]
+    latencies = []
+    counter = iter(range(total))
+
+    async def client():
+        for i in counter:
+            st = time.perf_counter()
+            await fn(i, vectors[i % len(vectors)])
+            latencies.append((time.perf_counter() - st) * 1000)
+
+    st = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    cost = time.perf_counter() - st
+    return total / cost, np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+async def run_http(url, clients, total):
+    import aiohttp
+
+    latencies = []
+    counter = iter(range(total))
+
+    async def client(session):
+        for i in counter:
+            st = time.perf_counter()
+            async with session.post(f"{url}/api/chat/send", json={
+                'user_identifier': f'bench_{i % 100}',
+                'message': questions[i % len(questions)],
+            }) as resp:
+                await resp.read()
+            latencies.append((time.perf_counter() - st) * 1000)
+
+    connector = aiohttp.TCPConnector(limit=clients)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=600)) as session:
+        st = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(clients)))
+        cost = time.perf_counter() - st
+    return total / cost, np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--url', default=None, help='端到端压测的服务地址')
+    args = parser.parse_args()
+
+    print(f"{'mode':>10} {'clients':>8} {'req/s':>8} {'p50ms':>8} {'p99ms':>8}")
+    if args.url:
+        qps, p50, p99 = await run_http(args.url, args.clients, args.requests)
+        print(f"{'http':>10} {args.clients:>8} {qps:>8.1f} {p50:>8.1f} {p99:>8.1f}")
+        return
+    try:
+        for name, fn in (('sync', stage_sync), ('async', stage_async)):
+            qps, p50, p99 = await run(fn, args.clients, args.requests)
+            print(f"{name:>10} {args.clients:>8} {qps:>8.1f} {p50:>8.1f} {p99:>8.1f}")
+    finally:
+        await es_client.aclose()
+        await redis_client.aclose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
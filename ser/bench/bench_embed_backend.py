@@ -0,0 +1,69 @@
+"""
+向量模型后端一致性与延迟对比
+以torch后端为基准, 报告 onnx / onnx_int8 的余弦一致性与单条/批量延迟
+运行: python ser/bench/bench_embed_backend.py [--backends onnx onnx_int8] [--rounds 50]
+"""
+import sys
+import os
+
+project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, project_root)
+
+import argparse
+import logging
+import time
+
+import numpy as np
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+from ser.utils.model_cli import load_embedding_model
+
+texts = [
+    '这份文档的主要内容是什么？',
+    '北斗系统',
+    '加快北斗与人工智能和大数据等新兴技术融合，创新系统架构、优化运维模式、升级特色功能。',
+    '建功新时代，奋进新征程。让我们继续发扬新时代北斗精神，筑梦星空，勇攀高峰，共同书写北斗规模应用新篇章！',
+    '今天，我们在这里隆重举行北斗规模应用国际峰会专家委员会成立暨第一次全体会议，'
+    '主要目的是贯彻落实致首届北斗峰会的贺信精神，集聚行业顶尖资源，成立峰会专家委员会，研究部署相关工作。' * 3,
+    'How does retrieval augmented generation work?',
+    '向量检索与全文检索如何混合排序',
+    '| 指标 | 2023 | 2024 |\n| --- | --- | --- |\n| 用户数 | 100 | 200 |',
+]
+
+
+def latency(model, batch, rounds):
+    model.encode(batch, normalize_embeddings=True)
+    st = time.perf_counter()
+    for _ in range(rounds):
+        model.encode(batch, normalize_embeddings=True)
+    return (time.perf_counter() - st) / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backends', nargs='+', default=['onnx', 'onnx_int8'])
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args()
+
+    base = load_embedding_model('torch')
+    base_vectors = base.encode(texts, normalize_embeddings=True)
+    batch = (texts * 4)[:32]
+
+    print(f"{'backend':>10} {'dim':>5} {'cos_min':>8} {'cos_mean':>9} {'单条ms':>8} {'批量32ms':>9}")
+    print(f"{'torch':>10} {base_vectors.shape[1]:>5} {1.0:>8.4f} {1.0:>9.4f} "
+          f"{latency(base, texts[:1], args.rounds):>8.2f} {latency(base, batch, max(1, args.rounds // 5)):>9.2f}")
+    for backend in args.backends:
+        model = load_embedding_model(backend)
+        vectors = model.encode(texts, normalize_embeddings=True)
+        assert vectors.shape == base_vectors.shape, f"{backend} 维度不一致 {vectors.shape}"
+        norms = np.linalg.norm(vectors, axis=1)
+        assert np.allclose(norms, 1.0, atol=1e-3), f"{backend} 向量未归一化"
+        cos = (vectors * base_vectors).sum(axis=1)
+        print(f"{backend:>10} {vectors.shape[1]:>5} {cos.min():>8.4f} {cos.mean():>9.4f} "
+              f"{latency(model, texts[:1], args.rounds):>8.2f} "
+              f"{latency(model, batch, max(1, args.rounds // 5)):>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+连续批处理调度 vs 逐条生成 吞吐对比
+在 1/4/16 并发下统计总生成tokens/s
+运行: python ser/bench/bench_llm_scheduler.py [--requests 32] [--max-new-tokens 128]
+"""
+import sys
+import os
+
+project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, project_root)
+
+import argparse
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+from ser.utils import model_cli
+from ser.utils.model_cli import GenerationProfile, generation_stats
+
+questions = [
+    '请简要介绍一下大型语言模型',
+    '北斗系统有哪些主要应用场景？',
+    '如何提高文档检索的准确率？',
+    '解释一下什么是向量数据库',
+    '写一段关于春天的短文',
+    'RAG系统由哪些部分组成？',
+    '简述Transformer的注意力机制',
+    '列举三个提高代码质量的方法',
+]
+
+
+def run(concurrency, total_requests, profile, use_scheduler):
+    model_cli.llm_scheduler_enabled = use_scheduler
+    # 逐条路径: 全局锁保证同一时刻只有一个请求在生成
+    serial_lock = threading.Lock()
+
+    def one(i):
+        messages = [{"role": "user", "content": questions[i % len(questions)]}]
+        if use_scheduler:
+            return model_cli.llm(messages, profile=profile)
+        with serial_lock:
+            return model_cli.llm(messages, profile=profile)
+
+    before = generation_stats.stats().get(profile.name, {}).get('tokens', 0)
+    st = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total_requests)))
+    cost = time.time() - st
+    tokens = generation_stats.stats().get(profile.name, {}).get('tokens', 0) - before
+    return tokens, cost
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=32, help='每档并发的请求总数')
+    parser.add_argument('--max-new-tokens', type=int, default=128)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    args = parser.parse_args()
+
+    profile = GenerationProfile(name='bench', max_new_tokens=args.max_new_tokens, do_sample=False, timeout_s=600)
+    model_cli.model_loader.warmup()
+
+    print(f"{'并发':>6} {'模式':>10} {'tokens':>8} {'耗时s':>8} {'tokens/s':>10}")
+    for concurrency in args.concurrency:
+        for use_scheduler in (False, True):
+            tokens, cost = run(concurrency, args.requests, profile, use_scheduler)
+            mode = 'scheduler' if use_scheduler else 'serial'
+            print(f"{concurrency:>6} {mode:>10} {tokens:>8} {cost:>8.2f} {tokens / cost:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
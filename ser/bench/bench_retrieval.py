@@ -0,0 +1,158 @@
+"""
+检索延迟对比: 旧的 match_all + script_score 全量余弦 vs HNSW kNN + 全文融合
+向独立的压测索引逐级写入合成分片(随机单位向量 + 随机词), 每个规模下报告两种查询的 p50/p99;
+knn+rrf+vec 与线上默认配置一致(开启上下文选择), 包含为融合结果按ID补取向量的mget往返
+运行: python ser/bench/bench_retrieval.py [--sizes 10000 100000 1000000] [--queries 200] [--keep]
+"""
+import sys
+import os
+
+project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, project_root)
+
+import argparse
+import logging
+import time
+
+import numpy as np
+from elasticsearch.helpers import streaming_bulk
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+from ser.utils.elasticsearch_cli import es_client
+from ser.utils.retrieval import HybridRetriever
+
+bench_index = 'rag_demo_bench_retrieval'
+dims = 512
+
+# 检索相关字段与入库索引一致
+bench_mapping = {
+    "settings": {"number_of_shards": 2, "number_of_replicas": 0, "refresh_interval": "-1"},
+    "mappings": {
+        "properties": {
+            "doc_oid": {"type": "keyword"},
+            "content": {"type": "text", "analyzer": "whitespace"},
+            "questions": {"type": "text", "analyzer": "standard"},
+            "emb_512": {"type": "dense_vector", "dims": dims, "index": True, "similarity": "cosine"},
+        }
+    }
+}
+
+vocab = [f"词{i}" for i in range(5000)]
+
+
+def random_vectors(rng, n):
+    vectors = rng.standard_normal((n, dims)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def random_text(rng, n_words):
+    return ' '.join(rng.choice(vocab, n_words))
+
+
+def fill(rng, start, end, batch=2000):
+    """写入 [start, end) 的合成分片"""
+    def actions():
+        for offset in range(start, end, batch):
+            n = min(batch, end - offset)
+            vectors = random_vectors(rng, n)
+            for i in range(n):
+                yield {
+                    "_index": bench_index,
+                    "_id": str(offset + i),
+                    "_source": {
+                        "doc_oid": str((offset + i) // 100),
+                        "content": random_text(rng, 60),
+                        "questions": [random_text(rng, 8)],
+                        "emb_512": vectors[i].tolist(),
+                    }
+                }
+
+    st = time.time()
+    for ok, info in streaming_bulk(es_client.client, actions(), chunk_size=batch, raise_on_error=True):
+        pass
+    es_client.client.indices.refresh(index=bench_index)
+    # 合并段, 避免段数影响HNSW查询延迟
+    es_client.client.indices.forcemerge(index=bench_index, max_num_segments=1, request_timeout=3600)
+    print(f"写入 {start}..{end} 耗时 {time.time() - st:.1f}s")
+
+
+def script_score_query(query_text, query_vector, top_k):
+    """原 query_elasticsearch 的查询"""
+    return {
+        "query": {
+            "bool": {
+                "should": [
+                    {"multi_match": {"query": query_text, "fields": ["content", "questions"], "boost": 0.4}},
+                    {"script_score": {
+                        "query": {"match_all": {}},
+                        "script": {
+                            "source": "Math.max(0, cosineSimilarity(params.query_vector, 'emb_512')) * 0.6",
+                            "params": {"query_vector": query_vector.tolist()}
+                        }
+                    }}
+                ]
+            }
+        },
+        "size": top_k,
+        "_source": {"excludes": ["emb_512"]},
+    }
+
+
+def percentiles(samples):
+    return np.percentile(samples, 50), np.percentile(samples, 99)
+
+
+def measure(run, queries):
+    run(*queries[0])
+    samples = []
+    for query in queries:
+        st = time.perf_counter()
+        run(*query)
+        samples.append((time.perf_counter() - st) * 1000)
+    return percentiles(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 1000000])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=20)
+    parser.add_argument('--num-candidates', type=int, default=200)
+    parser.add_argument('--keep', action='store_true', help='保留压测索引')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    if es_client.client.indices.exists(index=bench_index):
+        es_client.client.indices.delete(index=bench_index)
+    es_client.create_index(bench_index, bench_mapping)
+
+    retrievers = {
+        'knn+rrf': HybridRetriever(bench_index, fusion='rrf', num_candidates=args.num_candidates),
+        'knn+weighted': HybridRetriever(bench_index, fusion='weighted', num_candidates=args.num_candidates),
+        'knn+rrf+vec': HybridRetriever(bench_index, fusion='rrf', num_candidates=args.num_candidates,
+                                       fetch_vectors=True),
+    }
+    query_vectors = random_vectors(rng, args.queries)
+    queries = [(random_text(rng, 4), query_vectors[i]) for i in range(args.queries)]
+
+    print(f"{'chunks':>9} {'query':>14} {'p50ms':>8} {'p99ms':>8}")
+    filled = 0
+    try:
+        for size in sorted(args.sizes):
+            fill(rng, filled, size)
+            filled = size
+            p50, p99 = measure(
+                lambda text, vector: es_client.search(bench_index, script_score_query(text, vector, args.top_k)),
+                queries)
+            print(f"{size:>9} {'script_score':>14} {p50:>8.1f} {p99:>8.1f}")
+            for name, retriever in retrievers.items():
+                p50, p99 = measure(lambda text, vector: retriever.search(text, vector, top_k=args.top_k), queries)
+                print(f"{size:>9} {name:>14} {p50:>8.1f} {p99:>8.1f}")
+    finally:
+        if not args.keep:
+            es_client.client.indices.delete(index=bench_index)
+
+
+if __name__ == '__main__':
+    main()
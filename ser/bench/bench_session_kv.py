@@ -0,0 +1,92 @@
+"""
+会话KV缓存多轮复用校验
+按 ser/api/chat.py 的方式逐轮组装对话(历史按 chat.history 的窗口与 trim_step 对齐), 同一会话连续提问,
+每轮统计从上一轮缓存复用的前缀token数, 并与按token计算的期望值比较:
+期望复用 = 上一轮(提示词 + 返回的回复 + 结束符) 与本轮提示词的公共前缀长度
+运行: python ser/bench/bench_session_kv.py [--turns 16] [--max-new-tokens 96]
+"""
+import sys
+import os
+
+project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, project_root)
+
+import argparse
+import logging
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+from ser.api.chat import system_prompt, user_prompt
+from ser.utils import model_cli
+from ser.utils.chat_history import chat_history
+from ser.utils.model_cli import GenerationProfile, session_kv_cache
+
+document_chunk = '''加快北斗与人工智能和大数据等新兴技术融合，创新系统架构、优化运维模式、升级特色功能，努力打造精准可信、随遇接入、智能化、网络化、柔性化的下一代北斗系统。
+今天，我们在这里隆重举行北斗规模应用国际峰会专家委员会成立暨第一次全体会议，集聚行业顶尖资源，成立峰会专家委员会，研究部署相关工作。'''
+
+questions = [
+    '这份文档的主要内容是什么？',
+    '下一代北斗系统有哪些特点？',
+    '专家委员会成立的目的是什么？',
+    '会议在什么时间举行？',
+]
+
+
+def prompt_ids(messages):
+    text = model_cli.model_loader.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return model_cli.model_loader.tokenizer.encode(text, add_special_tokens=False)
+
+
+def common_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--turns', type=int, default=16)
+    parser.add_argument('--max-new-tokens', type=int, default=96)
+    args = parser.parse_args()
+
+    if session_kv_cache is None:
+        print("model.kv_cache.enabled 未开启")
+        return 1
+    model_cli.model_loader.warmup()
+    eos = model_cli.model_loader.tokenizer.eos_token_id
+    # 贪心解码, 不走投机解码(辅助生成不使用会话缓存)
+    profile = GenerationProfile(name='bench_session_kv', max_new_tokens=args.max_new_tokens, timeout_s=600)
+    session_id = 'bench_session_kv'
+
+    history, total, stored = [], 0, None
+    failed = 0
+    print(f"{'turn':>4} {'history':>7} {'prompt':>7} {'reused':>7} {'expected':>8}")
+    for turn in range(args.turns):
+        question = questions[turn % len(questions)]
+        messages = ([{"role": "system", "content": system_prompt}] + chat_history.align(history, total)
+                    + [{"role": "user", "content": user_prompt.format(document_chunk=document_chunk,
+                                                                      question=question)}])
+        ids = prompt_ids(messages)
+        expected = min(common_prefix(stored, ids), len(ids) - 1) if stored is not None else 0
+        before = session_kv_cache.stats()['reused_tokens']
+        answer = model_cli.llm(messages, profile=profile, session_id=session_id)
+        reused = session_kv_cache.stats()['reused_tokens'] - before
+        print(f"{turn + 1:>4} {len(messages) - 2:>7} {len(ids):>7} {reused:>7} {expected:>8}")
+        if reused != expected:
+            failed += 1
+        # 与聊天接口一致: 历史保存原始问题与返回的回复
+        stored = ids + model_cli.model_loader.tokenizer.encode(answer, add_special_tokens=False) + [eos]
+        history = (history + [{"role": "user", "content": question},
+                              {"role": "assistant", "content": answer}])[-chat_history.window:]
+        total += 2
+
+    print(f"会话KV缓存统计: {session_kv_cache.stats()}")
+    print(f"复用前缀与期望不一致: {failed}/{args.turns}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+"""
+投机解码吞吐对比
+使用 ser/api/chat.py 的对话提示词模板, 贪心解码下分别以普通解码/草稿模型辅助解码生成,
+报告 tokens/s、接受率, 并校验两种方式输出一致
+运行: python ser/bench/bench_speculative.py [--rounds 3] [--max-new-tokens 256]
+"""
+import sys
+import os
+
+project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, project_root)
+
+import argparse
+import logging
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+from ser.api.chat import system_prompt, user_prompt
+from ser.utils import model_cli
+from ser.utils.model_cli import GenerationProfile, generation_stats, speculative_stats
+
+document_chunk = '''加快北斗与人工智能和大数据等新兴技术融合，创新系统架构、优化运维模式、升级特色功能，努力打造精准可信、随遇接入、智能化、网络化、柔性化的下一代北斗系统。
+建功新时代，奋进新征程。让我们继续发扬新时代北斗精神，筑梦星空，勇攀高峰，共同书写北斗规模应用新篇章！
+今天，我们在这里隆重举行北斗规模应用国际峰会专家委员会成立暨第一次全体会议，集聚行业顶尖资源，成立峰会专家委员会，研究部署相关工作。'''
+
+questions = [
+    '这份文档的主要内容是什么？',
+    '下一代北斗系统有哪些特点？',
+    '专家委员会成立的目的是什么？',
+]
+
+
+def run(profile, rounds):
+    outputs = []
+    before = generation_stats.stats().get(profile.name, {'tokens': 0, 'seconds': 0})
+    for _ in range(rounds):
+        for question in questions:
+            messages = [{"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_prompt.format(document_chunk=document_chunk, question=question)}]
+            outputs.append(model_cli.llm(messages, profile=profile))
+    after = generation_stats.stats()[profile.name]
+    tokens = after['tokens'] - before['tokens']
+    seconds = after['seconds'] - before['seconds']
+    return outputs, tokens, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--max-new-tokens', type=int, default=256)
+    args = parser.parse_args()
+
+    # 投机解码只作用于直接生成路径
+    model_cli.llm_scheduler_enabled = False
+    model_cli.model_loader.warmup()
+    if model_cli.model_loader.draft_model is None:
+        print(f"未找到草稿模型 {model_cli.draft_model_path}, 请先下载并配置 model.draft_model")
+        return
+
+    base_profile = GenerationProfile(name='bench_base', max_new_tokens=args.max_new_tokens, timeout_s=600)
+    spec_profile = GenerationProfile(name='bench_spec', max_new_tokens=args.max_new_tokens, timeout_s=600,
+                                     speculative=True)
+    base_out, base_tokens, base_seconds = run(base_profile, args.rounds)
+    spec_out, spec_tokens, spec_seconds = run(spec_profile, args.rounds)
+
+    print(f"{'模式':>12} {'tokens':>8} {'耗时s':>8} {'tokens/s':>10}")
+    print(f"{'greedy':>12} {base_tokens:>8} {base_seconds:>8.2f} {base_tokens / base_seconds:>10.1f}")
+    print(f"{'speculative':>12} {spec_tokens:>8} {spec_seconds:>8.2f} {spec_tokens / spec_seconds:>10.1f}")
+    print(f"加速比: {(spec_tokens / spec_seconds) / (base_tokens / base_seconds):.2f}x")
+    print(f"投机解码统计: {speculative_stats.stats()}")
+    same = sum(a == b for a, b in zip(base_out, spec_out))
+    print(f"输出一致: {same}/{len(base_out)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -12,3 +12,17 @@ snapshot_download(
 )
 
 
+
+# 可选: 投机解码草稿模型
+# snapshot_download(
+#     repo_id="Qwen/Qwen3-0.6B",
+#     endpoint="https://hf-mirror.com",
+#     local_dir="./Qwen3-0.6B"
+# )
+
+# 可选: 重排序模型(chat.rerank.enabled)
+# snapshot_download(
+#     repo_id="BAAI/bge-reranker-base",
+#     endpoint="https://hf-mirror.com",
+#     local_dir="./bge-reranker-base"
+# )
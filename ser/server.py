@@ -15,11 +15,23 @@ logging.basicConfig(
 )
 
 
+from contextlib import asynccontextmanager
+
 from utils.conf import get_config
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse
 from datetime import datetime
-from utils.comm import create_response
+from utils.comm import create_response, create_response_error_1005, create_response_error_1006
+from ser.utils.model_worker import model_client
+from ser.utils.elasticsearch_cli import es_client
+from ser.utils.redis_cli import redis_client
+from ser.utils.metrics import render
+from ser.utils.work_scheduler import QueueFullError
+from ser.utils.document_jobs import document_jobs
+from ser.utils.reranker import rerank_stage
+from ser.utils.semantic_cache import semantic_cache
 
 
 # 加载配置文件
@@ -28,10 +40,25 @@ HOST_IP = get_config('api', {}).get("host", "127.0.0.1")
 HOST_PORT = get_config('api', {}).get("http_port")
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 模型在独立进程或后台线程加载预热, 不阻塞服务启动, 就绪状态见 /ready
+    model_client.start(warmup=get_config('model', {}).get('warmup_on_startup', True))
+    # 文档分片后台任务线程池, 上次未结束的任务标记为失败
+    document_jobs.start()
+    yield
+    document_jobs.stop()
+    model_client.stop()
+    # 关闭异步客户端的连接池
+    await es_client.aclose()
+    await redis_client.aclose()
+
+
 app = FastAPI(
     title="rag",
     description="api",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 # 添加 CORS 中间件
@@ -43,6 +70,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request, exc: QueueFullError):
+    """模型调用通道已满: 429 + Retry-After"""
+    return JSONResponse(status_code=429,
+                        content=create_response_error_1006(data={'lane': exc.lane, 'retry_after': exc.retry_after}),
+                        headers={'Retry-After': str(exc.retry_after)})
+
+
 # 导入路由
 
 from api.user import router as user
@@ -70,6 +105,49 @@ async def root():
     return create_response(data=f'API Server is running, {formatted_time}')
 
 
+@app.get("/ready")
+async def ready():
+    """就绪探针: 模型预热完成前返回503"""
+    status = model_client.status()
+    if not status['ready']:
+        return JSONResponse(status_code=503, content=create_response_error_1005(data=status))
+    return create_response(data=status)
+
+
+@app.get("/stats")
+async def stats():
+    """
+    运行统计汇总: 模型侧(微批大小/会话KV缓存/调度队列与平均批大小/投机解码接受率)、
+    调度通道、查询向量缓存、语义缓存、重排序与分片任务
+    """
+    return create_response(data=await run_in_threadpool(collect_stats))
+
+
+def collect_stats():
+    sources = {
+        'model': model_client.stats,
+        'semantic_cache': semantic_cache.stats if semantic_cache else None,
+        'rerank': rerank_stage.stats if rerank_stage else None,
+        'document_jobs': document_jobs.stats,
+    }
+    data = {}
+    for name, fn in sources.items():
+        try:
+            data[name] = fn() if fn else None
+        except Exception as e:
+            # 单项失败(如模型进程未就绪)不影响其他统计
+            logging.error(f"获取统计失败 {name}: {e}")
+            data[name] = {'error': str(e)}
+    return data
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus指标, 含模型进程的预填充/解码/首token/生成速度"""
+    snapshots = await run_in_threadpool(model_client.metrics_snapshots)
+    return PlainTextResponse(render(snapshots), media_type="text/plain; version=0.0.4")
+
+
 
 
 
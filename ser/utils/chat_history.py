@@ -0,0 +1,199 @@
+import json
+import logging
+from typing import List, Dict, Any
+
+from redis.exceptions import ResponseError, WatchError
+
+from ser.utils.conf import get_config
+from ser.utils.metrics import timed
+from ser.utils.redis_cli import redis_client
+
+
+class ChatHistoryStore:
+    """
+    聊天历史, 每条消息是redis列表的一个元素
+    追加: RPUSH + LTRIM + EXPIRE 在一个事务管道内完成, 并发请求不会互相覆盖
+    读取: LRANGE 只取最近窗口, 同时续期TTL(滑动过期)
+    对话上下文窗口的起点按累计消息序号对齐到 trim_step 的整数倍, 每 trim_step/2 轮才整体前移一次,
+    期间历史只在末尾追加, 提示词前缀保持不变, 会话KV缓存可以复用
+    旧版本以整个JSON数组存为字符串, 首次访问遇到类型错误时转换为列表
+    """
+
+    def __init__(self, max_messages: int = 200, window: int = 20, trim_step: int = 10, ttl_s: int = 7 * 86400,
+                 prefix: str = 'chat_history'):
+        self.max_messages = max_messages
+        self.window = window
+        # 取偶数, 保证按一问一答对齐
+        self.trim_step = max(2, int(trim_step) // 2 * 2)
+        self.ttl_s = ttl_s
+        self.prefix = prefix
+
+    def key(self, user_identifier: str) -> str:
+        return f"{self.prefix}:{user_identifier}"
+
+    def seq_key(self, user_identifier: str) -> str:
+        """累计追加的消息条数, 不受 max_messages 截断影响"""
+        return f"{self.prefix}_seq:{user_identifier}"
+
+    def align(self, messages: List[Dict[str, Any]], total: int) -> List[Dict[str, Any]]:
+        """
+        :param messages: 最近的消息, 按时间从旧到新
+        :param total: 累计消息条数, messages[-1] 的序号为 total-1
+        :return: 从对齐后的起点开始的消息, 条数不超过 window
+        """
+        first = total - len(messages)
+        start = max(first, -(-max(0, total - self.window) // self.trim_step) * self.trim_step)
+        return messages[start - first:]
+
+    @staticmethod
+    def _is_wrong_type(e: Exception) -> bool:
+        return isinstance(e, ResponseError) and 'WRONGTYPE' in str(e)
+
+    def _converted(self, blob) -> List[str]:
+        try:
+            items = json.loads(blob) if blob else []
+        except ValueError:
+            items = []
+        return [json.dumps(m, ensure_ascii=False) for m in items[-self.max_messages:]]
+
+    # ---------------- 异步(请求路径) ----------------
+
+    async def _amigrate(self, key: str):
+        client = redis_client.async_client
+        async with client.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(key)
+                    if await pipe.type(key) != 'string':
+                        await pipe.unwatch()
+                        return
+                    items = self._converted(await pipe.get(key))
+                    pipe.multi()
+                    pipe.delete(key)
+                    if items:
+                        pipe.rpush(key, *items)
+                        pipe.expire(key, self.ttl_s)
+                    await pipe.execute()
+                    logging.info(f"聊天历史转换为列表 {key} 条数 {len(items)}")
+                    return
+                except WatchError:
+                    # 转换期间被其他请求修改, 重试
+                    continue
+
+    @timed('redis')
+    async def aget_window(self, user_identifier: str, n: int = None) -> List[Dict[str, Any]]:
+        """最近n条消息(默认window), 按时间从旧到新"""
+        key = self.key(user_identifier)
+        n = n or self.window
+        for _ in range(2):
+            try:
+                async with redis_client.async_client.pipeline(transaction=False) as pipe:
+                    pipe.lrange(key, -n, -1)
+                    pipe.expire(key, self.ttl_s)
+                    items, _ = await pipe.execute()
+                return [json.loads(item) for item in items]
+            except Exception as e:
+                if not self._is_wrong_type(e):
+                    logging.error(f"读取聊天历史失败: {e}")
+                    return []
+                await self._amigrate(key)
+        return []
+
+    @timed('redis')
+    async def aget_context(self, user_identifier: str) -> List[Dict[str, Any]]:
+        """对话使用的历史: 最近窗口内从对齐起点开始的消息"""
+        key, seq_key = self.key(user_identifier), self.seq_key(user_identifier)
+        for _ in range(2):
+            try:
+                async with redis_client.async_client.pipeline(transaction=False) as pipe:
+                    pipe.lrange(key, -self.window, -1)
+                    pipe.llen(key)
+                    pipe.get(seq_key)
+                    pipe.expire(key, self.ttl_s)
+                    pipe.expire(seq_key, self.ttl_s)
+                    items, length, seq, _, _ = await pipe.execute()
+                # 计数上线前已有的历史没有序号, 以列表长度为准
+                return self.align([json.loads(item) for item in items], max(int(seq or 0), length))
+            except Exception as e:
+                if not self._is_wrong_type(e):
+                    logging.error(f"读取聊天历史失败: {e}")
+                    return []
+                await self._amigrate(key)
+        return []
+
+    async def aget_all(self, user_identifier: str) -> List[Dict[str, Any]]:
+        return await self.aget_window(user_identifier, self.max_messages)
+
+    @timed('redis')
+    async def aappend(self, user_identifier: str, messages: List[Dict[str, Any]]) -> bool:
+        """原子追加并截断到 max_messages 条, 续期TTL"""
+        key = self.key(user_identifier)
+        items = [json.dumps(m, ensure_ascii=False) for m in messages]
+        for _ in range(2):
+            try:
+                async with redis_client.async_client.pipeline(transaction=True) as pipe:
+                    pipe.rpush(key, *items)
+                    pipe.ltrim(key, -self.max_messages, -1)
+                    pipe.expire(key, self.ttl_s)
+                    pipe.incrby(self.seq_key(user_identifier), len(items))
+                    pipe.expire(self.seq_key(user_identifier), self.ttl_s)
+                    await pipe.execute()
+                return True
+            except Exception as e:
+                if not self._is_wrong_type(e):
+                    logging.error(f"写入聊天历史失败: {e}")
+                    return False
+                await self._amigrate(key)
+        return False
+
+    # ---------------- 同步(线程内调用, 如流式响应结束时) ----------------
+
+    def _migrate(self, key: str):
+        with redis_client.client.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    if pipe.type(key) != 'string':
+                        pipe.unwatch()
+                        return
+                    items = self._converted(pipe.get(key))
+                    pipe.multi()
+                    pipe.delete(key)
+                    if items:
+                        pipe.rpush(key, *items)
+                        pipe.expire(key, self.ttl_s)
+                    pipe.execute()
+                    logging.info(f"聊天历史转换为列表 {key} 条数 {len(items)}")
+                    return
+                except WatchError:
+                    continue
+
+    @timed('redis')
+    def append(self, user_identifier: str, messages: List[Dict[str, Any]]) -> bool:
+        key = self.key(user_identifier)
+        items = [json.dumps(m, ensure_ascii=False) for m in messages]
+        for _ in range(2):
+            try:
+                with redis_client.client.pipeline(transaction=True) as pipe:
+                    pipe.rpush(key, *items)
+                    pipe.ltrim(key, -self.max_messages, -1)
+                    pipe.expire(key, self.ttl_s)
+                    pipe.incrby(self.seq_key(user_identifier), len(items))
+                    pipe.expire(self.seq_key(user_identifier), self.ttl_s)
+                    pipe.execute()
+                return True
+            except Exception as e:
+                if not self._is_wrong_type(e):
+                    logging.error(f"写入聊天历史失败: {e}")
+                    return False
+                self._migrate(key)
+        return False
+
+
+_history_conf = get_config('chat', {}).get('history', {})
+chat_history = ChatHistoryStore(
+    max_messages=_history_conf.get('max_messages', 200),
+    window=_history_conf.get('window', 20),
+    trim_step=_history_conf.get('trim_step', 10),
+    ttl_s=_history_conf.get('ttl_s', 7 * 86400),
+)
@@ -1,6 +1,9 @@
+import base64
 import hashlib
 from datetime import datetime
 
+import numpy as np
+
 
 def create_response(code="0", data=None):
     """创建统一响应格式"""
@@ -14,6 +17,12 @@ def create_response_error_1003(data="文档上传错误"):
 def create_response_error_1004( data="数据库操作错误"):
     return create_response('1004', data)
 
+def create_response_error_1005(data="模型未就绪"):
+    return create_response('1005', data)
+
+def create_response_error_1006(data="服务繁忙, 请稍后重试"):
+    return create_response('1006', data)
+
 
 def generate_vector_id( doc_id: str, chunk_id: str, content: str) -> str:
     """生成向量ID的hash值"""
@@ -24,3 +33,12 @@ def get_current_time():
     """获取当前时间字符串"""
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+
+
+def vector_to_b64(vector) -> str:
+    """向量压缩为float16后base64编码, 便于存入redis"""
+    return base64.b64encode(np.asarray(vector, dtype=np.float16).tobytes()).decode('ascii')
+
+def b64_to_vector(data: str):
+    """base64还原向量(float32)"""
+    return np.frombuffer(base64.b64decode(data), dtype=np.float16).astype(np.float32)
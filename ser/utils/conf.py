@@ -34,4 +34,22 @@ def get_config(key, default=None):
         return None
     if default is None:
         default = os.environ.get(key.upper())
-    return CONFIGS.get(key, default)
\ No newline at end of file
+    return CONFIGS.get(key, default)
+
+def model_path(kind: str) -> str:
+    """配置的模型目录(相对 ser/): kind 为 llm | embedding"""
+    model_conf = get_config('model', {})
+    if kind == 'llm':
+        return model_conf.get('llm_model', 'models/Qwen3-4B-Instruct-2507')
+    return model_conf.get('embedding', {}).get('model', 'models/bge-small-zh-v1.5')
+
+
+def model_id(kind: str) -> str:
+    """
+    模型标识, 用作向量/生成结果缓存的命名空间: 取配置的模型目录名, 更换模型后旧缓存不再命中;
+    向量后端不同(torch/onnx/onnx_int8)结果不同, 向量模型标识带上后端
+    """
+    name = os.path.basename(os.path.normpath(model_path(kind)))
+    if kind == 'embedding':
+        return f"{name}:{get_config('model', {}).get('embedding', {}).get('backend', 'torch')}"
+    return name
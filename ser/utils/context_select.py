@@ -0,0 +1,99 @@
+import hashlib
+import logging
+from typing import List, Dict, Any
+
+import numpy as np
+
+from ser.utils.conf import get_config
+
+
+def content_hash(hit: Dict[str, Any]) -> str:
+    """与入库时 t_document_chunk.content_hash 一致(md5), 旧数据未存储时现算"""
+    return hit.get('content_hash') or hashlib.md5(hit['content'].encode('utf-8')).hexdigest()
+
+
+class ContextSelector:
+    """
+    检索后的上下文选择
+    1. 按 content_hash 折叠重复分片, 保留排名最高的一条
+    2. MMR(最大边际相关)贪心选择: score = λ·相关度 - (1-λ)·与已选片段的最大相似度,
+       相似度为 emb_512 余弦, 一次矩阵乘法算出全部两两相似度;
+       相关度优先用重排序分数(cross-encoder原始logit, 经sigmoid映射到[0,1]后与余弦相似度同量纲), 否则用与问题向量的余弦
+    3. 在token预算与条数上限内停止
+    """
+
+    def __init__(self, mmr_lambda: float = 0.7, max_chunks: int = 8, max_tokens: int = 3072):
+        self.mmr_lambda = mmr_lambda
+        self.max_chunks = max_chunks
+        self.max_tokens = max_tokens
+
+    def collapse(self, hits: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        seen, unique = set(), []
+        for hit in hits:
+            key = content_hash(hit)
+            if key not in seen:
+                seen.add(key)
+                unique.append(hit)
+        return unique
+
+    def _relevance(self, hits: List[Dict[str, Any]], vectors: np.ndarray, query_vector) -> np.ndarray:
+        if all(hit.get('rerank_score') is not None for hit in hits):
+            logits = np.array([hit['rerank_score'] for hit in hits], dtype=np.float32)
+            # logit无界, 不归一化时会压过多样性惩罚, λ失去作用
+            return 1.0 / (1.0 + np.exp(-logits))
+        return vectors @ np.asarray(query_vector, dtype=np.float32)
+
+    def select(self, hits: List[Dict[str, Any]], query_vector, count_tokens) -> List[Dict[str, Any]]:
+        """
+        :param hits: 检索结果, 按相关度降序, 含 content/emb_512
+        :param count_tokens: 计算片段token数的函数
+        :return: 选中的片段, 按选择顺序
+        """
+        unique = self.collapse(hits)
+        if not unique:
+            return []
+        if any(hit.get('emb_512') is None for hit in unique):
+            # 缺少向量时只做去重, 按原顺序截取
+            order = range(len(unique))
+        else:
+            vectors = np.asarray([hit['emb_512'] for hit in unique], dtype=np.float32)
+            vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+            order = self._mmr(vectors, self._relevance(unique, vectors, query_vector))
+
+        selected, used_tokens = [], 0
+        for i in order:
+            if len(selected) >= self.max_chunks:
+                break
+            n = count_tokens(unique[i]['content'])
+            if used_tokens + n > self.max_tokens:
+                continue
+            selected.append(unique[i])
+            used_tokens += n
+        logging.info(f"上下文选择 检索 {len(hits)} 去重 {len(unique)} 选中 {len(selected)} tokens {used_tokens}")
+        return selected
+
+    def _mmr(self, vectors: np.ndarray, relevance: np.ndarray) -> List[int]:
+        """返回全部候选的MMR排序, 预算截断由调用方完成"""
+        n = len(vectors)
+        similarity = vectors @ vectors.T
+        max_sim = np.full(n, -np.inf, dtype=np.float32)
+        remaining = np.ones(n, dtype=bool)
+        order = []
+        for _ in range(n):
+            penalty = np.where(np.isinf(max_sim), 0.0, max_sim)
+            scores = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * penalty
+            scores[~remaining] = -np.inf
+            j = int(np.argmax(scores))
+            order.append(j)
+            remaining[j] = False
+            max_sim = np.maximum(max_sim, similarity[j])
+        return order
+
+
+_select_conf = get_config('chat', {}).get('context_select', {})
+_budget_conf = get_config('chat', {}).get('prompt_budget', {})
+context_selector = ContextSelector(
+    mmr_lambda=_select_conf.get('mmr_lambda', 0.7),
+    max_chunks=_select_conf.get('max_chunks', 8),
+    max_tokens=_select_conf.get('max_tokens', _budget_conf.get('context_max_tokens', 3072)),
+) if _select_conf.get('enabled', True) else None
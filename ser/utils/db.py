@@ -1,9 +1,11 @@
 import logging
+import time
 
 import dataset
-from .conf import get_config
+from ser.utils.conf import get_config
+from ser.utils.metrics import stage_seconds
 from contextlib import contextmanager
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.pool import QueuePool
 
 
@@ -69,6 +71,14 @@ def _create_db_pool():
 # 全局连接池实例
 _db_pool = _create_db_pool()
 
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    stage_seconds.observe(time.perf_counter() - conn.info['query_start'].pop(), 'mysql')
+
+
 @contextmanager
 def get_pool_conn():
     """从连接池获取连接的上下文管理器"""
@@ -77,6 +87,9 @@ def get_pool_conn():
     try:
         # 从连接池获取连接
         db = dataset.connect(str(engine.url))
+        # mysql 耗时只统计每条SQL的执行, 不含调用方在 with 块内的其他操作(ES/模型调用等)
+        event.listen(db.engine, 'before_cursor_execute', _before_execute)
+        event.listen(db.engine, 'after_cursor_execute', _after_execute)
         yield db
     except Exception as e:
         if db:
@@ -0,0 +1,269 @@
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional, Tuple
+
+from sqlalchemy.exc import IntegrityError
+
+from ser.utils.comm import get_current_time
+from ser.utils.conf import get_config
+from ser.utils.db import get_pool_conn
+from ser.utils.genid import IDGeneratorFactory
+from ser.utils.work_scheduler import QueueFullError
+
+# t_document_job.status
+JOB_QUEUED, JOB_RUNNING, JOB_COMPLETED, JOB_FAILED = 0, 1, 2, 3
+JOB_STATUS_NAMES = {JOB_QUEUED: 'queued', JOB_RUNNING: 'running', JOB_COMPLETED: 'completed', JOB_FAILED: 'failed'}
+
+# 任务结束时一并写入: active_doc_oid 置空后同一文档可再次提交
+FINISHED_COLUMNS = {'active_doc_oid': None}
+
+# 各阶段进度计数, 与 t_document_job 列同名
+PROGRESS_FIELDS = ('pages_total', 'pages_parsed', 'chunks_total', 'chunks_embedded', 'chunks_questioned',
+                   'chunks_indexed')
+
+
+class JobProgress:
+    """
+    任务进度
+    计数在内存中实时更新, 阶段切换时以及最多每 flush_interval_s 秒写入一次 t_document_job;
+    job_id 为 None 时只记录不落库(同步调用分片流程时使用)
+    """
+
+    def __init__(self, job_id: str = None, flush_interval_s: float = 2.0):
+        self.job_id = job_id
+        self.flush_interval_s = flush_interval_s
+        self.stage = 'queued'
+        self.counters = dict.fromkeys(PROGRESS_FIELDS, 0)
+        self._lock = threading.Lock()
+        self._flushed = 0.0
+
+    def set_stage(self, stage: str, **columns):
+        """切换阶段并立即落库, columns 为需要一并更新的任务列(status/started_at等)"""
+        with self._lock:
+            self.stage = stage
+        self.flush(force=True, **columns)
+
+    def set(self, **counters):
+        with self._lock:
+            self.counters.update(counters)
+        self.flush()
+
+    def advance(self, field: str, n: int = 1):
+        with self._lock:
+            self.counters[field] += n
+        self.flush()
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {'stage': self.stage, **self.counters}
+
+    def flush(self, force: bool = False, **columns):
+        if self.job_id is None:
+            return
+        now = time.time()
+        if not force and now - self._flushed < self.flush_interval_s:
+            return
+        self._flushed = now
+        try:
+            with get_pool_conn() as db:
+                db['t_document_job'].update({'oid': self.job_id, **self.snapshot(), **columns}, keys=['oid'])
+        except Exception as e:
+            logging.error(f"更新分片任务进度失败 job={self.job_id}: {e}")
+
+
+class DocumentJobManager:
+    """
+    文档分片后台任务
+    提交时写入 t_document_job 并立即返回任务ID, 解析/向量化/入库由线程池执行;
+    同一文档已有排队或执行中的任务时直接返回该任务(active_doc_oid 唯一键, 多进程提交同样去重),
+    排队任务数超过 max_pending 时拒绝(429);
+    任务记录执行进程 owner(主机名:pid), 进程每 heartbeat_s 秒为自己的未结束任务续约;
+    超过 lease_s 未续约, 或同一主机上 owner 进程已不存在的任务标记为失败, 文档恢复为未分片, 可重新提交
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 32, flush_interval_s: float = 2.0,
+                 heartbeat_s: float = 30, lease_s: float = 120):
+        self.workers = max(1, int(workers))
+        self.max_pending = max_pending
+        self.flush_interval_s = flush_interval_s
+        self.heartbeat_s = heartbeat_s
+        self.lease_s = max(lease_s, heartbeat_s * 2)
+        self.hostname = socket.gethostname()
+        self.owner = f"{self.hostname}:{os.getpid()}"
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        # 本进程内未结束任务的实时进度
+        self._jobs: Dict[str, JobProgress] = {}
+        self._pending = 0
+        # 单个任务耗时的滑动平均, 用于估计 Retry-After
+        self._ema_s = None
+
+    def start(self):
+        # 进程复用(如 fork 后)时 pid 可能变化
+        self.owner = f"{self.hostname}:{os.getpid()}"
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='document-job')
+        self._stop_event.clear()
+        self._recover()
+        threading.Thread(target=self._heartbeat_loop, name='document-job-heartbeat', daemon=True).start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._executor is not None:
+            # 未开始的任务取消, 租约过期后由存活的进程标记为失败
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _heartbeat_loop(self):
+        while not self._stop_event.wait(self.heartbeat_s):
+            self._heartbeat()
+            self._recover()
+
+    def _heartbeat(self):
+        with self._lock:
+            job_ids = list(self._jobs)
+        if not job_ids:
+            return
+        try:
+            now = get_current_time()
+            with get_pool_conn() as db:
+                t_document_job = db['t_document_job']
+                for job_id in job_ids:
+                    t_document_job.update({'oid': job_id, 'upt': now}, keys=['oid'])
+        except Exception as e:
+            logging.error(f"分片任务续约失败: {e}")
+
+    def _is_dead(self, owner: Optional[str]) -> bool:
+        """同一主机上的 owner 进程已不存在(本进程重启前留下的任务), 其他主机只能依赖租约"""
+        host, _, pid = (owner or '').rpartition(':')
+        if host != self.hostname or not pid.isdigit() or owner == self.owner:
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            return False
+        return False
+
+    def _recover(self):
+        """把 owner 进程已退出的未结束任务标记为失败"""
+        cutoff = datetime.now() - timedelta(seconds=self.lease_s)
+        try:
+            with get_pool_conn() as db:
+                t_document_job = db['t_document_job']
+                rows = [row for row in t_document_job.find(status=[JOB_QUEUED, JOB_RUNNING])
+                        if row['owner'] != self.owner
+                        and (self._is_dead(row['owner']) or row['upt'] is None or row['upt'] < cutoff)]
+                for row in rows:
+                    t_document_job.update({'oid': row['oid'], 'status': JOB_FAILED, 'stage': 'failed',
+                                           'error': f"执行进程 {row['owner']} 已退出, 任务中断",
+                                           'finished_at': get_current_time(), **FINISHED_COLUMNS},
+                                          keys=['oid'])
+                    db['t_document'].update({'oid': row['doc_oid'], 'chunk_status': 0}, keys=['oid'])
+            if rows:
+                logging.warning(f"分片任务中断 {len(rows)} 个, 已标记为失败")
+        except Exception as e:
+            logging.error(f"恢复分片任务状态失败: {e}")
+
+    def _retry_after(self) -> int:
+        per_job = self._ema_s if self._ema_s is not None else 30
+        return max(1, round(per_job * (self._pending + 1) / self.workers))
+
+    def submit(self, doc_oid, handler: Callable[[str, JobProgress], int]) -> Tuple[str, str]:
+        """
+        :param handler: handler(doc_oid, progress) 执行分片并返回分片数量, 失败时抛出异常
+        :return: (任务ID, 任务状态)
+        """
+        if self._executor is None:
+            raise RuntimeError('分片任务线程池未启动')
+        with self._lock:
+            with get_pool_conn() as db:
+                t_document_job = db['t_document_job']
+                active = t_document_job.find_one(active_doc_oid=doc_oid)
+                if active:
+                    return str(active['oid']), JOB_STATUS_NAMES[active['status']]
+                if self._pending >= self.max_pending:
+                    raise QueueFullError('document_job', self._retry_after())
+                job_id = IDGeneratorFactory.get_generator().generate_id()
+                try:
+                    t_document_job.insert({'oid': job_id, 'doc_oid': doc_oid, 'active_doc_oid': doc_oid,
+                                           'owner': self.owner, 'status': JOB_QUEUED, 'stage': 'queued'})
+                except IntegrityError:
+                    # 其他进程同时提交了同一文档, 以唯一键上已存在的任务为准
+                    active = t_document_job.find_one(active_doc_oid=doc_oid)
+                    if not active:
+                        raise
+                    return str(active['oid']), JOB_STATUS_NAMES[active['status']]
+            progress = JobProgress(job_id, self.flush_interval_s)
+            self._jobs[job_id] = progress
+            self._pending += 1
+        self._executor.submit(self._run, job_id, doc_oid, handler, progress)
+        logging.info(f"分片任务提交 job={job_id} doc={doc_oid} 排队 {self._pending}")
+        return job_id, JOB_STATUS_NAMES[JOB_QUEUED]
+
+    def _run(self, job_id: str, doc_oid, handler, progress: JobProgress):
+        with self._lock:
+            self._pending -= 1
+        st = time.time()
+        progress.set_stage('running', status=JOB_RUNNING, started_at=get_current_time())
+        try:
+            chunk_count = handler(doc_oid, progress)
+            progress.set_stage('completed', status=JOB_COMPLETED, finished_at=get_current_time(),
+                               **FINISHED_COLUMNS)
+            logging.info(f"分片任务完成 job={job_id} doc={doc_oid} 分片 {chunk_count} 耗时 {time.time() - st:.1f}s")
+        except Exception as e:
+            logging.exception(f"分片任务失败 job={job_id} doc={doc_oid}: {e}")
+            progress.set_stage('failed', status=JOB_FAILED, error=str(e)[:1000], finished_at=get_current_time(),
+                               **FINISHED_COLUMNS)
+        finally:
+            cost = time.time() - st
+            with self._lock:
+                self._jobs.pop(job_id, None)
+                self._ema_s = cost if self._ema_s is None else self._ema_s * 0.8 + cost * 0.2
+
+    @staticmethod
+    def _format(row: Dict, progress: Optional[JobProgress]) -> Dict:
+        live = progress.snapshot() if progress is not None else {}
+        return {
+            'task_id': str(row['oid']),
+            'doc_id': str(row['doc_oid']),
+            'status': JOB_STATUS_NAMES.get(row['status'], 'unknown'),
+            'stage': live.get('stage', row['stage']),
+            'progress': {field: live.get(field, row[field]) for field in PROGRESS_FIELDS},
+            'error': row['error'],
+            'crt': row['crt'],
+            'started_at': row['started_at'],
+            'finished_at': row['finished_at'],
+        }
+
+    def status(self, task_id: str = None, doc_oid=None) -> Optional[Dict]:
+        """按任务ID查询, 或查询文档最近一次任务; 执行中的任务进度取内存中的实时值"""
+        with get_pool_conn() as db:
+            t_document_job = db['t_document_job']
+            if task_id:
+                row = t_document_job.find_one(oid=task_id)
+            else:
+                row = t_document_job.find_one(doc_oid=doc_oid, order_by=['-crt', '-oid'])
+        if not row:
+            return None
+        return self._format(row, self._jobs.get(str(row['oid'])))
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers, 'pending': self._pending, 'active': len(self._jobs) - self._pending,
+                    'ema_s': round(self._ema_s, 1) if self._ema_s is not None else None}
+
+
+_jobs_conf = get_config('chunk_jobs', {})
+document_jobs = DocumentJobManager(
+    workers=_jobs_conf.get('workers', 2),
+    max_pending=_jobs_conf.get('max_pending', 32),
+    flush_interval_s=_jobs_conf.get('flush_interval_s', 2.0),
+    heartbeat_s=_jobs_conf.get('heartbeat_s', 30),
+    lease_s=_jobs_conf.get('lease_s', 120),
+)
@@ -1,7 +1,8 @@
 import os
 import logging
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, AsyncElasticsearch
 from .conf import get_config
+from ser.utils.metrics import timed
 
 PROJECT_BASE = os.path.abspath(
             os.path.join(
@@ -22,17 +23,22 @@ class ElasticsearchClient:
     def _initialize(self):
         """初始化 Elasticsearch 客户端"""
         es_config = get_config('elasticsearch', {})
-
-        self.client = Elasticsearch(
+        self._client_kwargs = dict(
             hosts=[es_config.get('host', 'localhost:9200')],
             http_auth=(
                 es_config.get('username', ''),
                 es_config.get('password', '')
             ) if es_config.get('username') else None,
             verify_certs=False,
-            timeout=es_config.get('timeout', 600)
+            # 每个节点的连接池大小, 同步/异步客户端各自一个池, 进程内共享
+            connections_per_node=es_config.get('connections_per_node', 32),
         )
 
+        self.client = Elasticsearch(timeout=es_config.get('timeout', 600), **self._client_kwargs)
+        # 检索请求的超时远小于入库
+        self._search_timeout = es_config.get('search_timeout', 30)
+        self._async_client = None
+
         # 测试连接
         try:
             if self.client.ping():
@@ -54,6 +60,7 @@ class ElasticsearchClient:
             logging.info(f"创建索引失败: {e}")
             raise
 
+    @timed('es_index')
     def index_document(self, index_name, document, doc_id=None):
         """索引文档"""
         try:
@@ -67,11 +74,17 @@ class ElasticsearchClient:
             logging.info(f"索引文档失败: {e}")
             raise
 
+    @timed('es_bulk')
     def bulk_index(self, actions):
-        """批量索引文档"""
+        """批量索引文档, 返回时新文档已可被检索"""
         try:
             from elasticsearch.helpers import bulk
-            result = bulk(self.client, actions)
+            from ser.utils.retrieval_cache import bump_index_generation
+            actions = list(actions)
+            # 等待下一次refresh后再返回: 否则递增代数后的 refresh_interval 内仍查到旧结果, 并以新代数写入检索缓存
+            result = bulk(self.client, actions, refresh='wait_for')
+            # 索引内容已变化且已可见, 递增代数使检索缓存失效
+            bump_index_generation(a['_index'] for a in actions if a.get('_index'))
             return result
         except Exception as e:
             logging.info(f"批量索引失败: {e}")
@@ -82,6 +95,19 @@ class ElasticsearchClient:
                     logging.info(f"  文档 {i + 1} 错误: {error}")
             raise
 
+    @property
+    def async_client(self):
+        """异步客户端, 首次使用时在事件循环内创建"""
+        if self._async_client is None:
+            self._async_client = AsyncElasticsearch(timeout=self._search_timeout, **self._client_kwargs)
+        return self._async_client
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
+
+    @timed('es_search')
     def search(self, index, query):
         """搜索文档"""
         try:
@@ -94,6 +120,70 @@ class ElasticsearchClient:
             logging.info(f"搜索失败: {e}")
             raise
 
+    @timed('es_search')
+    def msearch(self, index, queries):
+        """多个查询一次往返, 返回与queries一一对应的结果"""
+        try:
+            body = []
+            for query in queries:
+                body.append({"index": index})
+                body.append(query)
+            result = self.client.msearch(body=body)
+            for i, response in enumerate(result['responses']):
+                if 'error' in response:
+                    raise Exception(f"第{i + 1}个查询失败: {response['error']}")
+            return result['responses']
+        except Exception as e:
+            logging.info(f"批量搜索失败: {e}")
+            raise
+
+    @timed('es_search')
+    async def async_search(self, index, query):
+        """搜索文档(异步)"""
+        try:
+            return await self.async_client.search(index=index, body=query)
+        except Exception as e:
+            logging.info(f"搜索失败: {e}")
+            raise
+
+    @timed('es_search')
+    async def async_msearch(self, index, queries):
+        """多个查询一次往返(异步)"""
+        try:
+            body = []
+            for query in queries:
+                body.append({"index": index})
+                body.append(query)
+            result = await self.async_client.msearch(body=body)
+            for i, response in enumerate(result['responses']):
+                if 'error' in response:
+                    raise Exception(f"第{i + 1}个查询失败: {response['error']}")
+            return result['responses']
+        except Exception as e:
+            logging.info(f"批量搜索失败: {e}")
+            raise
+
+    @timed('es_mget')
+    def mget(self, index, ids, source_includes):
+        """按ID批量取文档的部分字段, 返回 {id: _source}, 不存在的ID不返回"""
+        try:
+            result = self.client.mget(index=index, body={"ids": list(ids)}, _source_includes=source_includes)
+            return {doc['_id']: doc['_source'] for doc in result['docs'] if doc.get('found')}
+        except Exception as e:
+            logging.info(f"批量获取文档失败: {e}")
+            raise
+
+    @timed('es_mget')
+    async def async_mget(self, index, ids, source_includes):
+        """按ID批量取文档的部分字段(异步)"""
+        try:
+            result = await self.async_client.mget(index=index, body={"ids": list(ids)},
+                                                  _source_includes=source_includes)
+            return {doc['_id']: doc['_source'] for doc in result['docs'] if doc.get('found')}
+        except Exception as e:
+            logging.info(f"批量获取文档失败: {e}")
+            raise
+
 
 # 全局实例
 es_client = ElasticsearchClient()
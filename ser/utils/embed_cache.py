@@ -0,0 +1,145 @@
+import asyncio
+import hashlib
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from ser.utils.conf import get_config, model_id
+
+
+def normalize_query(text: str) -> str:
+    """查询文本归一化: 全半角统一, 合并空白, 去首尾空白"""
+    text = unicodedata.normalize('NFKC', text or '')
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+class QueryEmbeddingCache:
+    """
+    查询向量缓存
+    键为归一化后的查询文本, 值为float16向量; 进程内LRU, 条目数与字节数双上限, 带TTL;
+    redis_enabled 时未命中再查redis, 多个服务进程共享
+    """
+
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 64 * 1024 * 1024, ttl_s: int = 3600,
+                 redis_enabled: bool = False, redis_ttl_s: int = 86400, namespace: str = 'default'):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.redis_enabled = redis_enabled
+        self.redis_ttl_s = redis_ttl_s
+        # 向量模型或后端变化时键随之变化, 避免混用不同模型的向量
+        self.namespace = namespace
+        self._entries = OrderedDict()  # key -> (float16向量, 写入时间)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'redis_hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha1(normalize_query(text).encode('utf-8')).hexdigest()
+
+    def _redis_key(self, key: str) -> str:
+        return f"query_embed:{self.namespace}:{key}"
+
+    def _get_local(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            vector, created = item
+            if self.ttl_s and time.time() - created > self.ttl_s:
+                self._pop(key)
+                self._stats['expired'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return vector.astype(np.float32)
+
+    def _pop(self, key: str):
+        vector, _ = self._entries.pop(key)
+        self._bytes -= vector.nbytes
+
+    def _put_local(self, key: str, vector: np.ndarray):
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (vector, time.time())
+            self._bytes += vector.nbytes
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._pop(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        """查找缓存向量(float32), 未命中返回None"""
+        key = self._key(text)
+        vector = self._get_local(key)
+        if vector is not None or not self.redis_enabled:
+            if vector is None:
+                self._count('misses')
+            return vector
+        try:
+            from ser.utils.redis_cli import redis_client
+            raw = redis_client.client.get(self._redis_key(key))
+        except Exception as e:
+            logging.error(f"查询向量缓存读取redis失败: {e}")
+            raw = None
+        if raw is None:
+            self._count('misses')
+            return None
+        from ser.utils.comm import b64_to_vector
+        vector = b64_to_vector(raw).astype(np.float16)
+        self._put_local(key, vector)
+        self._count('redis_hits')
+        return vector.astype(np.float32)
+
+    def put(self, text: str, vector):
+        key = self._key(text)
+        vector = np.asarray(vector, dtype=np.float16).ravel()
+        self._put_local(key, vector)
+        if self.redis_enabled:
+            try:
+                from ser.utils.comm import vector_to_b64
+                from ser.utils.redis_cli import redis_client
+                redis_client.client.set(self._redis_key(key), vector_to_b64(vector), ex=self.redis_ttl_s)
+            except Exception as e:
+                logging.error(f"查询向量缓存写入redis失败: {e}")
+
+    async def aget(self, text: str) -> Optional[np.ndarray]:
+        """异步查找: 本地命中直接返回, 需要访问redis时放到线程中执行"""
+        if not self.redis_enabled:
+            return self.get(text)
+        vector = self._get_local(self._key(text))
+        if vector is not None:
+            return vector
+        return await asyncio.to_thread(self.get, text)
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['redis_hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hit_rate': round((self._stats['hits'] + self._stats['redis_hits']) / lookups, 4) if lookups else 0,
+            }
+
+
+_model_conf = get_config('model', {})
+_cache_conf = _model_conf.get('query_embed_cache', {})
+query_embed_cache = QueryEmbeddingCache(
+    max_entries=_cache_conf.get('max_entries', 10000),
+    max_bytes=int(_cache_conf.get('max_mb', 64) * 1024 * 1024),
+    ttl_s=_cache_conf.get('ttl_s', 3600),
+    redis_enabled=_cache_conf.get('redis', False),
+    redis_ttl_s=_cache_conf.get('redis_ttl_s', 86400),
+    namespace=model_id('embedding'),
+) if _cache_conf.get('enabled', True) else None
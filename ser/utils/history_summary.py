@@ -0,0 +1,134 @@
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+
+from ser.utils.chat_history import chat_history
+from ser.utils.conf import get_config
+from ser.utils.model_worker import model_client
+from ser.utils.prompt_assembler import prompt_assembler
+from ser.utils.redis_cli import redis_client
+
+summary_prompt = '''
+请将以下对话整理为一段简洁的摘要, 保留用户的身份背景、关注的问题、已得到的关键结论和尚未解决的问题;
+只输出摘要正文, 不超过300字。
+
+<已有摘要>
+{summary}
+</已有摘要>
+
+<新增对话>
+{dialogue}
+</新增对话>
+'''
+
+
+class HistorySummarizer:
+    """
+    滚动对话摘要
+    历史中未被摘要覆盖的消息超过 trigger_tokens 时, 后台把较早的消息与已有摘要合并为新摘要,
+    只保留最近 keep_recent 条消息原文; 摘要随系统提示词发送, 每轮预填充长度近似恒定
+    redis: chat_summary:{user} hash {summary, marker(最后一条已摘要消息), updated}
+    列表中的原始消息不做修改, /chat/history 仍可看到完整记录
+    """
+
+    def __init__(self, trigger_tokens: int = 3000, keep_recent: int = 6, ttl_s: int = 7 * 86400,
+                 max_workers: int = 2, prefix: str = 'chat_summary'):
+        self.trigger_tokens = trigger_tokens
+        self.keep_recent = keep_recent
+        self.ttl_s = ttl_s
+        self.prefix = prefix
+        # 摘要生成在后台线程执行, 不占用请求路径
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='history-summary')
+
+    def key(self, user_identifier: str) -> str:
+        return f"{self.prefix}:{user_identifier}"
+
+    def _lock_key(self, user_identifier: str) -> str:
+        return f"{self.prefix}:lock:{user_identifier}"
+
+    async def aget(self, user_identifier: str) -> Dict[str, str]:
+        try:
+            return await redis_client.async_client.hgetall(self.key(user_identifier))
+        except Exception as e:
+            logging.error(f"读取对话摘要失败: {e}")
+            return {}
+
+    @staticmethod
+    def uncovered(messages: List[Dict[str, Any]], marker: Optional[str]) -> List[Dict[str, Any]]:
+        """摘要标记之后的消息; 标记已滑出窗口时窗口内的消息均未被覆盖"""
+        if not marker:
+            return messages
+        marker_msg = json.loads(marker)
+        for i in range(len(messages) - 1, -1, -1):
+            if messages[i] == marker_msg:
+                return messages[i + 1:]
+        return messages
+
+    def apply(self, messages: List[Dict[str, Any]],
+              summary: Dict[str, str]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """:return: (需原文发送的消息, 摘要文本)"""
+        if not summary.get('summary'):
+            return messages, None
+        return self.uncovered(messages, summary.get('marker')), summary['summary']
+
+    def schedule(self, user_identifier: str):
+        """本轮结束后调用, 立即返回"""
+        self._executor.submit(self._compact_safe, user_identifier)
+
+    def _compact_safe(self, user_identifier: str):
+        try:
+            self.compact(user_identifier)
+        except Exception as e:
+            logging.error(f"对话摘要失败 user={user_identifier}: {e}")
+
+    def compact(self, user_identifier: str) -> bool:
+        client = redis_client.client
+        # 同一用户同时只有一个摘要任务
+        if not client.set(self._lock_key(user_identifier), '1', nx=True, ex=300):
+            return False
+        try:
+            summary = client.hgetall(self.key(user_identifier))
+            messages = [json.loads(item) for item in
+                        client.lrange(chat_history.key(user_identifier), -chat_history.window, -1)]
+            pending = self.uncovered(messages, summary.get('marker'))
+            if len(pending) <= self.keep_recent:
+                return False
+            tokens = sum(prompt_assembler.count(m.get('content', '')) for m in pending)
+            if tokens < self.trigger_tokens:
+                return False
+
+            old = pending[:-self.keep_recent]
+            # 在完整的一问一答之后截断
+            while old and old[-1].get('role') == 'user':
+                old = old[:-1]
+            if not old:
+                return False
+            st = time.time()
+            dialogue = '\n'.join(f"{'用户' if m['role'] == 'user' else '助手'}: {m['content']}" for m in old)
+            new_summary = model_client.llm_sync([{"role": "user", "content": summary_prompt.format(
+                summary=summary.get('summary', '无'), dialogue=dialogue)}], profile='summary').strip()
+            if not new_summary:
+                return False
+            pipe = client.pipeline(transaction=True)
+            pipe.hset(self.key(user_identifier), mapping={
+                'summary': new_summary,
+                'marker': json.dumps(old[-1], ensure_ascii=False),
+                'updated': str(time.time()),
+            })
+            pipe.expire(self.key(user_identifier), self.ttl_s)
+            pipe.execute()
+            logging.info(f"对话摘要更新 user={user_identifier} 摘要消息 {len(old)} 条 {tokens} tokens "
+                         f"耗时 {time.time() - st:.1f}s")
+            return True
+        finally:
+            client.delete(self._lock_key(user_identifier))
+
+
+_summary_conf = get_config('chat', {}).get('history', {}).get('summary', {})
+history_summarizer = HistorySummarizer(
+    trigger_tokens=_summary_conf.get('trigger_tokens', 3000),
+    keep_recent=_summary_conf.get('keep_recent', 6),
+    ttl_s=get_config('chat', {}).get('history', {}).get('ttl_s', 7 * 86400),
+) if _summary_conf.get('enabled', False) else None
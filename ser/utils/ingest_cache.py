@@ -0,0 +1,191 @@
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+from typing import List, Dict
+
+import numpy as np
+
+from ser.utils.conf import get_config, model_id
+
+PROJECT_BASE = os.path.abspath(
+            os.path.join(
+                os.path.dirname(os.path.realpath(__file__)),
+                os.pardir
+            )
+)
+
+
+def _safe_name(model_id: str) -> str:
+    return re.sub(r'[^0-9A-Za-z._-]+', '_', model_id)
+
+
+class VectorStore:
+    """
+    按 content_hash 存储分片向量
+    vectors.f16 为定长float16行的追加文件, 读取时内存映射; index.jsonl 为 hash -> 行号 的边车索引;
+    先写向量再写索引, 异常中断时索引中超出文件行数的记录在加载时丢弃;
+    多个进程(多worker/任务进程)共用目录, 追加时持有向量文件的 flock, 行号读取与两次写入在同一把锁内完成
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._vector_path = os.path.join(directory, 'vectors.f16')
+        self._index_path = os.path.join(directory, 'index.jsonl')
+        self._meta_path = os.path.join(directory, 'meta.json')
+        self._lock = threading.Lock()
+        self._rows: Dict[str, int] = {}
+        self._dim = None
+        self._mmap = None
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, 'r', encoding='utf-8') as f:
+                self._dim = json.load(f)['dim']
+        if self._dim is None or not os.path.exists(self._index_path):
+            return
+        total_rows = os.path.getsize(self._vector_path) // (self._dim * 2) if os.path.exists(self._vector_path) else 0
+        with open(self._index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue
+                if item['row'] < total_rows:
+                    self._rows[item['hash']] = item['row']
+
+    def _vectors(self):
+        """内存映射向量文件, 文件增长后重新映射"""
+        rows = os.path.getsize(self._vector_path) // (self._dim * 2)
+        if self._mmap is None or self._mmap.shape[0] < rows:
+            self._mmap = np.memmap(self._vector_path, dtype=np.float16, mode='r', shape=(rows, self._dim))
+        return self._mmap
+
+    def get_many(self, hashes: List[str]) -> Dict[str, np.ndarray]:
+        with self._lock:
+            found = {h: self._rows[h] for h in hashes if h in self._rows}
+            if not found:
+                return {}
+            vectors = self._vectors()
+            return {h: np.asarray(vectors[row], dtype=np.float32) for h, row in found.items()}
+
+    def put_many(self, hashes: List[str], vectors):
+        vectors = np.asarray(vectors, dtype=np.float16)
+        with self._lock:
+            if self._dim is None:
+                self._dim = int(vectors.shape[1])
+                with open(self._meta_path, 'w', encoding='utf-8') as f:
+                    json.dump({'dim': self._dim}, f)
+            new = [(h, v) for h, v in zip(hashes, vectors) if h not in self._rows]
+            if not new:
+                return
+            row_bytes = self._dim * 2
+            with open(self._vector_path, 'ab') as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    size = os.fstat(f.fileno()).st_size
+                    if size % row_bytes:
+                        # 上次写入中断留下的不完整行
+                        os.ftruncate(f.fileno(), size - size % row_bytes)
+                    start = size // row_bytes
+                    f.write(np.stack([v for _, v in new]).tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                    with open(self._index_path, 'a', encoding='utf-8') as index:
+                        for i, (h, _) in enumerate(new):
+                            index.write(json.dumps({'hash': h, 'row': start + i}) + '\n')
+                            self._rows[h] = start + i
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def __len__(self):
+        return len(self._rows)
+
+
+class QuestionStore:
+    """按 content_hash 存储生成的模拟问题, questions.jsonl 追加写入"""
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self._path = os.path.join(directory, 'questions.jsonl')
+        self._lock = threading.Lock()
+        self._questions: Dict[str, List[str]] = {}
+        if os.path.exists(self._path):
+            with open(self._path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._questions[item['hash']] = item['questions']
+
+    def get_many(self, hashes: List[str]) -> Dict[str, List[str]]:
+        with self._lock:
+            return {h: self._questions[h] for h in hashes if h in self._questions}
+
+    def put_many(self, items: Dict[str, List[str]]):
+        with self._lock:
+            new = {h: q for h, q in items.items() if h not in self._questions}
+            if not new:
+                return
+            with open(self._path, 'a', encoding='utf-8') as f:
+                # 多进程追加时整批写入, 行之间不交错
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    for h, questions in new.items():
+                        f.write(json.dumps({'hash': h, 'questions': questions}, ensure_ascii=False) + '\n')
+                    f.flush()
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            self._questions.update(new)
+
+    def __len__(self):
+        return len(self._questions)
+
+
+class IngestCache:
+    """
+    入库缓存: 相同内容的分片(重复页眉页脚/免责声明/文档新版本)复用向量与模拟问题
+    键为 content_hash, 按模型标识分目录存放, 更换向量模型/后端或问题生成模型/提示词后自动失效
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def _store(self, kind: str, model_id: str):
+        key = (kind, model_id)
+        if key not in self._stores:
+            with self._lock:
+                if key not in self._stores:
+                    directory = os.path.join(self.cache_dir, kind, _safe_name(model_id))
+                    self._stores[key] = VectorStore(directory) if kind == 'embedding' else QuestionStore(directory)
+                    logging.info(f"入库缓存 {kind} {model_id} 条目 {len(self._stores[key])}")
+        return self._stores[key]
+
+    def get_embeddings(self, model_id: str, hashes: List[str]) -> Dict[str, np.ndarray]:
+        return self._store('embedding', model_id).get_many(hashes)
+
+    def put_embeddings(self, model_id: str, hashes: List[str], vectors):
+        self._store('embedding', model_id).put_many(hashes, vectors)
+
+    def get_questions(self, model_id: str, hashes: List[str]) -> Dict[str, List[str]]:
+        return self._store('questions', model_id).get_many(hashes)
+
+    def put_questions(self, model_id: str, items: Dict[str, List[str]]):
+        self._store('questions', model_id).put_many(items)
+
+
+_model_conf = get_config('model', {})
+_cache_conf = _model_conf.get('ingest_cache', {})
+# 模型标识与 model_cli 加载的模型一致, 更换模型或向量后端后旧缓存不再命中
+embedding_model_id = model_id('embedding')
+question_model_id = model_id('llm')
+ingest_cache = IngestCache(
+    os.path.join(PROJECT_BASE, _cache_conf.get('dir', 'cache/ingest'))
+) if _cache_conf.get('enabled', True) else None
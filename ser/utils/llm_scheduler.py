@@ -0,0 +1,410 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import List, Dict, Callable, Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+from ser.utils.conf import get_config
+from ser.utils.metrics import timed, llm_prefill_seconds
+from ser.utils.model_cli import model_loader, device, get_profile, generation_stats, session_kv_cache, \
+    GenerationProfile
+
+
+def _to_legacy(cache):
+    """DynamicCache -> [(key, value), ...] 每层形状 [B, H, T, D]"""
+    if hasattr(cache, 'layers'):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return [tuple(kv) for kv in cache.to_legacy_cache()]
+
+
+def _from_legacy(past):
+    return DynamicCache.from_legacy_cache(tuple(past))
+
+
+def _left_pad(t: torch.Tensor, length: int, dim: int):
+    """在dim维左侧补0到指定长度"""
+    pad = length - t.shape[dim]
+    if pad <= 0:
+        return t
+    # F.pad 的参数从最后一维开始成对给出
+    pads = [0, 0] * (t.dim() - dim - 1) + [pad, 0]
+    return F.pad(t, pads)
+
+
+class _Sequence:
+    """调度中的单个生成请求"""
+
+    def __init__(self, prompt_ids: List[int], profile: GenerationProfile, session_id: Optional[str],
+                 on_text: Optional[Callable[[str], None]], stop_event: Optional[threading.Event]):
+        self.prompt_ids = prompt_ids
+        self.profile = profile
+        self.session_id = session_id
+        self.on_text = on_text
+        self.stop_event = stop_event
+        self.future = Future()
+        self.generated = []
+        self.text = ''  # 已解码文本, 流式输出/停止词检测用
+        self.submit_time = time.time()
+        self.start_time = None
+        self.first_token_time = None
+        # 已并入运行批次, 之后的异常由 _fail_all 统一处理
+        self.merged = False
+
+    @property
+    def elapsed(self):
+        return time.time() - (self.start_time or self.submit_time)
+
+
+class LLMScheduler:
+    """
+    连续批处理(iteration-level batching)调度
+    独占语言模型的后台线程, 每个解码步之间接纳新请求并入运行批次,
+    先结束的序列立即移出批次并返回结果, 不必等待批内最长的序列;
+    请求按生成模板的 lane 分为 chat 与 ingest 两个队列: 先接纳 chat, 有 chat 请求等待时不接纳 ingest,
+    且批次内 ingest 序列不超过 ingest_max_active 个, 为聊天请求保留解码位置
+    """
+
+    def __init__(self, max_batch_size: int = 16, prefill_batch_size: int = 4, wait_margin_s: float = 60,
+                 ingest_max_active: int = None):
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.prefill_batch_size = max(1, int(prefill_batch_size))
+        self.ingest_max_active = (max(1, self.max_batch_size // 2) if ingest_max_active is None
+                                  else max(1, min(int(ingest_max_active), self.max_batch_size)))
+        # 调用方等待结果的上限 = 生成超时 + 排队/预填充余量
+        self.wait_margin_s = wait_margin_s
+        self._queues = {'chat': deque(), 'ingest': deque()}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        # 运行中批次状态
+        self._active: List[_Sequence] = []
+        self._past = None  # [(key, value)] 每层 [B, H, T, D], 左侧padding
+        self._mask = None  # [B, T]
+        self._eos_ids = None
+        # 统计
+        self._lock = threading.Lock()
+        self._steps = 0
+        self._step_tokens = 0
+        self._completed = 0
+        self._max_active = 0
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='llm-scheduler', daemon=True)
+                    self._thread.start()
+
+    def submit(self, messages: List[Dict[str, str]], profile='chat', session_id: str = None,
+               on_text: Callable[[str], None] = None, stop_event: threading.Event = None) -> Future:
+        """
+        提交生成请求, 返回Future, 结果为生成文本
+        on_text: 流式回调, 每解码出新文本时调用
+        stop_event: 置位后提前结束该请求(如客户端断开)
+        """
+        profile = get_profile(profile)
+        tokenizer = model_loader.tokenizer
+        text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        prompt_ids = tokenizer(text).input_ids
+        seq = _Sequence(prompt_ids, profile, session_id, on_text, stop_event)
+        self._ensure_started()
+        with self._cond:
+            self._queues['ingest' if profile.lane == 'ingest' else 'chat'].append(seq)
+            self._cond.notify()
+        return seq.future
+
+    def wait_timeout(self, profile) -> float:
+        return get_profile(profile).timeout_s + self.wait_margin_s
+
+    def wait(self, future: Future, profile='chat', stop_event: threading.Event = None) -> str:
+        """等待生成结果; 超时后通知调度线程放弃该请求并抛出 TimeoutError, 调用方不会永久阻塞"""
+        timeout = self.wait_timeout(profile)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            if stop_event is not None:
+                stop_event.set()
+            raise TimeoutError(f"llm生成等待超时 {timeout:.0f}s")
+
+    def generate(self, messages: List[Dict[str, str]], profile='chat', session_id: str = None) -> str:
+        stop_event = threading.Event()
+        future = self.submit(messages, profile, session_id, stop_event=stop_event)
+        return self.wait(future, profile, stop_event)
+
+    def _run(self):
+        with torch.inference_mode():
+            while True:
+                try:
+                    self._admit(block=not self._active)
+                    if self._active:
+                        self._decode_step()
+                except Exception as e:
+                    logging.exception(f"llm调度异常: {e}")
+                    self._fail_all(e)
+
+    def _fail_all(self, error):
+        self._fail(self._active, error)
+        self._active, self._past, self._mask = [], None, None
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    @staticmethod
+    def _fail(seqs: List[_Sequence], error):
+        for seq in seqs:
+            if not seq.future.done():
+                seq.future.set_exception(error)
+
+    # ---------------- 接纳新请求 ----------------
+
+    def _take(self, block: bool) -> List[_Sequence]:
+        """按优先级取出可接纳的请求: chat 优先, chat 队列清空后才接纳 ingest"""
+        chat, ingest = self._queues['chat'], self._queues['ingest']
+        active_ingest = sum(seq.profile.lane == 'ingest' for seq in self._active)
+        new = []
+        with self._cond:
+            while block and not chat and not ingest:
+                self._cond.wait()
+            while chat and len(self._active) + len(new) < self.max_batch_size:
+                new.append(chat.popleft())
+            while (ingest and not chat and active_ingest < self.ingest_max_active
+                   and len(self._active) + len(new) < self.max_batch_size):
+                new.append(ingest.popleft())
+                active_ingest += 1
+        return new
+
+    def _admit(self, block: bool):
+        new = self._take(block)
+        # 排队期间调用方已放弃(等待超时/断开)的请求不再预填充
+        for seq in new:
+            if seq.stop_event is not None and seq.stop_event.is_set():
+                self._fail([seq], TimeoutError('请求已取消'))
+        new = [seq for seq in new if not seq.future.done()]
+        if not new:
+            return
+
+        fresh = []
+        for i, seq in enumerate(new):
+            seq.start_time = time.time()
+            try:
+                cache_kwargs = {}
+                if seq.session_id is not None and session_kv_cache is not None:
+                    cache_kwargs = session_kv_cache.take(seq.session_id,
+                                                         torch.tensor([seq.prompt_ids], device=device))
+                if not cache_kwargs:
+                    fresh.append(seq)
+                    continue
+                # 命中会话缓存的请求单独prefill新增部分
+                self._prefill([seq], cache_kwargs['past_key_values'])
+            except Exception as e:
+                self._prefill_failed([seq], e, new[i + 1:] + fresh)
+        for start in range(0, len(fresh), self.prefill_batch_size):
+            group = fresh[start:start + self.prefill_batch_size]
+            try:
+                self._prefill(group, None)
+            except Exception as e:
+                self._prefill_failed(group, e, fresh[start + self.prefill_batch_size:])
+
+    def _prefill_failed(self, seqs: List[_Sequence], error: Exception, rest: List[_Sequence]):
+        """
+        预填充失败(如长提示词显存不足)
+        尚未并入批次: 只让这组请求失败, 运行批次不受影响;
+        已并入批次: 批次状态不可信, 剩余未预填充的请求一并失败, 异常交由 _run 重置批次
+        """
+        if any(seq.merged for seq in seqs):
+            self._fail(rest, error)
+            raise error
+        logging.exception(f"llm预填充失败 {len(seqs)} 个请求: {error}")
+        self._fail(seqs, error)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _prefill(self, seqs: List[_Sequence], past):
+        st = time.time()
+        model = model_loader.llm_model
+        tokenizer = model_loader.tokenizer
+        if past is not None:
+            prefix_len = past.get_seq_length()
+            ids = seqs[0].prompt_ids
+            input_ids = torch.tensor([ids[prefix_len:]], device=device)
+            mask = torch.ones((1, len(ids)), dtype=torch.long, device=device)
+            position_ids = torch.arange(prefix_len, len(ids), device=device).unsqueeze(0)
+            out = model(input_ids=input_ids, attention_mask=mask, position_ids=position_ids,
+                        past_key_values=past, cache_position=position_ids[0],
+                        use_cache=True, logits_to_keep=1)
+        else:
+            max_len = max(len(seq.prompt_ids) for seq in seqs)
+            input_ids = torch.full((len(seqs), max_len), tokenizer.pad_token_id, dtype=torch.long)
+            mask = torch.zeros((len(seqs), max_len), dtype=torch.long)
+            for i, seq in enumerate(seqs):
+                input_ids[i, max_len - len(seq.prompt_ids):] = torch.tensor(seq.prompt_ids)
+                mask[i, max_len - len(seq.prompt_ids):] = 1
+            input_ids, mask = input_ids.to(device), mask.to(device)
+            position_ids = (mask.cumsum(-1) - 1).clamp(min=0)
+            out = model(input_ids=input_ids, attention_mask=mask, position_ids=position_ids,
+                        past_key_values=DynamicCache(), use_cache=True, logits_to_keep=1)
+
+        self._merge(_to_legacy(out.past_key_values), mask, seqs)
+        cost = time.time() - st
+        for seq in seqs:
+            llm_prefill_seconds.observe(cost, seq.profile.name)
+        self._accept(seqs, out.logits[:, -1, :])
+
+    def _merge(self, past, mask, seqs):
+        """新prefill的序列并入运行批次, 两边左侧补齐到相同长度后按batch维拼接"""
+        if not self._active:
+            self._past, self._mask, self._active = past, mask, list(seqs)
+        else:
+            # 先算出合并结果再整体赋值, 拼接中途出错(显存不足)时运行批次保持原状
+            length = max(self._mask.shape[1], mask.shape[1])
+            merged_past = [
+                (torch.cat([_left_pad(k0, length, 2), _left_pad(k1, length, 2)]),
+                 torch.cat([_left_pad(v0, length, 2), _left_pad(v1, length, 2)]))
+                for (k0, v0), (k1, v1) in zip(self._past, past)
+            ]
+            merged_mask = torch.cat([_left_pad(self._mask, length, 1), _left_pad(mask, length, 1)])
+            self._past, self._mask = merged_past, merged_mask
+            self._active.extend(seqs)
+        for seq in seqs:
+            seq.merged = True
+        with self._lock:
+            self._max_active = max(self._max_active, len(self._active))
+
+    # ---------------- 解码 ----------------
+
+    @timed('decode_step')
+    def _decode_step(self):
+        model = model_loader.llm_model
+        input_ids = torch.tensor([[seq.generated[-1]] for seq in self._active], device=device)
+        mask = torch.cat([self._mask, self._mask.new_ones((len(self._active), 1))], dim=1)
+        position_ids = mask.sum(-1, keepdim=True) - 1
+        out = model(input_ids=input_ids, attention_mask=mask, position_ids=position_ids,
+                    past_key_values=_from_legacy(self._past), use_cache=True)
+        self._past = _to_legacy(out.past_key_values)
+        self._mask = mask
+        with self._lock:
+            self._steps += 1
+            self._step_tokens += len(self._active)
+        self._accept(list(self._active), out.logits[:, -1, :])
+
+    def _sample(self, logits: torch.Tensor, profile: GenerationProfile, generated: List[int]) -> int:
+        logits = logits.float()
+        if profile.repetition_penalty != 1.0 and generated:
+            ids = torch.tensor(sorted(set(generated)), device=logits.device)
+            scores = logits[ids]
+            logits[ids] = torch.where(scores > 0, scores / profile.repetition_penalty,
+                                      scores * profile.repetition_penalty)
+        if not profile.do_sample:
+            return int(logits.argmax())
+        logits = logits / max(profile.temperature, 1e-5)
+        if profile.top_k and profile.top_k > 0:
+            kth = torch.topk(logits, min(profile.top_k, logits.shape[-1])).values[-1]
+            logits[logits < kth] = float('-inf')
+        if profile.top_p and profile.top_p < 1.0:
+            sorted_logits, sorted_idx = torch.sort(logits, descending=True)
+            cum = sorted_logits.softmax(-1).cumsum(-1)
+            remove = cum - sorted_logits.softmax(-1) > profile.top_p
+            logits[sorted_idx[remove]] = float('-inf')
+        return int(torch.multinomial(logits.softmax(-1), 1))
+
+    def _eos(self):
+        if self._eos_ids is None:
+            eos = model_loader.llm_model.generation_config.eos_token_id
+            eos = set(eos if isinstance(eos, (list, tuple)) else [eos])
+            eos.add(model_loader.tokenizer.eos_token_id)
+            self._eos_ids = {e for e in eos if e is not None}
+        return self._eos_ids
+
+    def _accept(self, seqs: List[_Sequence], logits: torch.Tensor):
+        """为每个序列采样下一个token, 并把已结束的序列移出批次"""
+        tokenizer = model_loader.tokenizer
+        eos_ids = self._eos()
+        finished = []
+        for i, seq in enumerate(seqs):
+            token = self._sample(logits[i], seq.profile, seq.generated)
+            seq.generated.append(token)
+            if seq.first_token_time is None:
+                seq.first_token_time = time.time()
+            done = token in eos_ids
+            if seq.on_text or seq.profile.stop_strings:
+                text = tokenizer.decode(seq.generated, skip_special_tokens=True)
+                # 不完整的多字节字符等下一个token再输出
+                if not text.endswith('�'):
+                    trimmed = seq.profile.trim(text)
+                    done = done or len(trimmed) < len(text)
+                    if seq.on_text and len(trimmed) > len(seq.text):
+                        seq.on_text(trimmed[len(seq.text):])
+                    seq.text = trimmed
+            done = (done
+                    or len(seq.generated) >= seq.profile.max_new_tokens
+                    or seq.elapsed >= seq.profile.timeout_s
+                    or (seq.stop_event is not None and seq.stop_event.is_set()))
+            if done:
+                finished.append(seq)
+        if finished:
+            self._finish(finished)
+
+    def _finish(self, finished: List[_Sequence]):
+        tokenizer = model_loader.tokenizer
+        finished_ids = {id(seq) for seq in finished}
+        keep = [i for i, seq in enumerate(self._active) if id(seq) not in finished_ids]
+        length = self._mask.shape[1]
+        for i, seq in enumerate(self._active):
+            if id(seq) not in finished_ids:
+                continue
+            text = seq.profile.trim(tokenizer.decode(seq.generated, skip_special_tokens=True))
+            if seq.session_id is not None and session_kv_cache is not None:
+                # 取出该序列的有效缓存(去掉左侧padding), 只保留提示词与返回文本对应的部分存入会话缓存
+                valid = int(self._mask[i].sum())
+                past = [(k[i:i + 1, :, length - valid:].clone(), v[i:i + 1, :, length - valid:].clone())
+                        for k, v in self._past]
+                sequence = torch.tensor(seq.prompt_ids + seq.generated, device=device)
+                session_kv_cache.put(seq.session_id, sequence, _from_legacy(past), len(seq.prompt_ids),
+                                     seq.text if seq.on_text else text)
+            n_tokens = len([t for t in seq.generated if t not in self._eos()])
+            # 首token耗时含排队等待
+            generation_stats.record(seq.profile.name, n_tokens, seq.elapsed,
+                                    ttft=seq.first_token_time - seq.submit_time,
+                                    decode=time.time() - seq.first_token_time)
+            seq.future.set_result(text)
+        with self._lock:
+            self._completed += len(finished)
+
+        if not keep:
+            self._active, self._past, self._mask = [], None, None
+            return
+        index = torch.tensor(keep, device=device)
+        self._active = [self._active[i] for i in keep]
+        self._past = [(k.index_select(0, index), v.index_select(0, index)) for k, v in self._past]
+        self._mask = self._mask.index_select(0, index)
+        # 去掉所有序列都是padding的左侧列
+        used = self._mask.sum(0).nonzero()
+        first = int(used[0]) if len(used) else 0
+        if first > 0:
+            self._past = [(k[:, :, first:], v[:, :, first:]) for k, v in self._past]
+            self._mask = self._mask[:, first:]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': {lane: len(pending) for lane, pending in self._queues.items()},
+                'ingest_max_active': self.ingest_max_active,
+                'active': len(self._active),
+                'max_active': self._max_active,
+                'decode_steps': self._steps,
+                'avg_batch_size': round(self._step_tokens / self._steps, 2) if self._steps else 0,
+                'completed': self._completed,
+            }
+
+
+_scheduler_conf = get_config('model', {}).get('llm_scheduler', {})
+llm_scheduler = LLMScheduler(
+    max_batch_size=_scheduler_conf.get('max_batch_size', 16),
+    prefill_batch_size=_scheduler_conf.get('prefill_batch_size', 4),
+    wait_margin_s=_scheduler_conf.get('wait_margin_s', 60),
+    ingest_max_active=_scheduler_conf.get('ingest_max_active'),
+)
@@ -0,0 +1,142 @@
+import functools
+import inspect
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Tuple, Sequence
+
+# 秒级耗时分桶
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# 生成速度分桶(tokens/s)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500)
+
+
+class Histogram:
+    """
+    直方图, 按标签值分序列
+    observe 只做一次二分查找与计数, 锁内不分配对象, 对请求路径的开销可忽略
+    """
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str], buckets: Sequence[float]):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # 标签值 -> [各桶计数(非累计, 最后一个为+Inf), 总和, 次数]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labelvalues: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'help': self.help,
+                'labelnames': self.labelnames,
+                'buckets': self.buckets,
+                'series': {labels: [list(counts), total, count] for labels, (counts, total, count) in
+                           self._series.items()},
+            }
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Histogram(name, help_text, labelnames, buckets)
+            return self._metrics[name]
+
+    def snapshot(self):
+        """可序列化的快照, 用于从模型进程传回主进程"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {m.name: m.snapshot() for m in metrics}
+
+
+def _label_str(names, values):
+    return ','.join(f'{n}="{str(v)}"' for n, v in zip(names, values))
+
+
+def render(snapshots: Dict[str, dict]) -> str:
+    """
+    渲染为Prometheus文本格式
+    :param snapshots: 进程名 -> 快照, 进程名作为 process 标签
+    """
+    merged = {}
+    for process, snapshot in snapshots.items():
+        for name, metric in snapshot.items():
+            merged.setdefault(name, []).append((process, metric))
+    lines = []
+    for name in sorted(merged):
+        items = merged[name]
+        lines.append(f"# HELP {name} {items[0][1]['help']}")
+        lines.append(f"# TYPE {name} histogram")
+        for process, metric in items:
+            names = ('process',) + tuple(metric['labelnames'])
+            for labels, (counts, total, count) in metric['series'].items():
+                base = _label_str(names, (process,) + tuple(labels))
+                cumulative = 0
+                for bound, n in zip(metric['buckets'], counts):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{{base},le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{base},le="+Inf"}} {count}')
+                lines.append(f'{name}_sum{{{base}}} {total}')
+                lines.append(f'{name}_count{{{base}}} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+metrics_registry = MetricsRegistry()
+
+# 各阶段耗时: embed / es_search / redis / prompt_build / mysql / minio ...
+stage_seconds = metrics_registry.histogram(
+    'rag_stage_duration_seconds', '各处理阶段耗时(秒)', ('stage',))
+llm_prefill_seconds = metrics_registry.histogram(
+    'rag_llm_prefill_seconds', '语言模型预填充耗时(秒)', ('profile',))
+llm_decode_seconds = metrics_registry.histogram(
+    'rag_llm_decode_seconds', '语言模型解码耗时(秒, 首token之后)', ('profile',))
+llm_ttft_seconds = metrics_registry.histogram(
+    'rag_llm_ttft_seconds', '首token耗时(秒)', ('profile',))
+llm_tokens_per_second = metrics_registry.histogram(
+    'rag_llm_tokens_per_second', '生成速度(tokens/s)', ('profile',), buckets=RATE_BUCKETS)
+
+
+@contextmanager
+def span(stage: str):
+    """记录代码块耗时到 rag_stage_duration_seconds{stage}"""
+    st = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - st, stage)
+
+
+def timed(stage: str):
+    """函数耗时装饰器, 支持普通函数与协程"""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -4,6 +4,7 @@ import json
 import os
 from pathlib import Path
 
+import pypdfium2 as pdfium
 from loguru import logger
 
 from mineru.cli.common import convert_pdf_bytes_to_bytes_by_pypdfium2, prepare_env, read_fn
@@ -26,6 +27,15 @@ os.environ['MODELSCOPE_CACHE'] =   os.path.join(PROJECT_BASE, 'modelscope')
 
 output_dir = os.path.join(PROJECT_BASE, 'temp')
 
+
+def pdf_page_count(pdf_bytes: bytes) -> int:
+    """pdf总页数, 用于分片任务进度"""
+    pdf = pdfium.PdfDocument(pdf_bytes)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
 def do_parse(
         pdf_file_name:str,
         pdf_bytes:bytes,
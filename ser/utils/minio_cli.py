@@ -5,6 +5,7 @@ from pathlib import Path
 from minio import Minio
 from minio.error import S3Error
 from .conf import get_config
+from ser.utils.metrics import timed
 import io
 
 class MinIOClient:
@@ -90,6 +91,7 @@ class MinIOClient:
         ext = Path(file_path).suffix.lower()
         return extension_mapping.get(ext, 'application/octet-stream')
 
+    @timed('minio')
     def upload_file(self, prev:str, file_content: bytes, filename: str, content_type: str = None) -> str:
         """
         上传文件到 MinIO
@@ -126,6 +128,7 @@ class MinIOClient:
             logging.info(f"上传文件时出错: {e}")
             raise
 
+    @timed('minio')
     def upload_file_spec_path(self,local_file_path,object_name):
         # 上传文件
         try:
@@ -146,6 +149,7 @@ class MinIOClient:
             logging.info(f"上传文件失败 {local_file_path}  error: {e}")
             return object_name
 
+    @timed('minio')
     def upload_directory(self,local_dir,remote_dir):
         """
         上传目录下的所有文件到 MinIO
@@ -225,6 +229,7 @@ class MinIOClient:
 
 
 
+    @timed('minio')
     def download_file(self, object_name: str) -> bytes:
         """
         下载文件
@@ -1,11 +1,24 @@
 import os
+import asyncio
 import logging
-from typing import List, Dict
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import List, Dict, Any
 
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from sentence_transformers import SentenceTransformer
+import numpy as np
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer, StoppingCriteria, \
+    StoppingCriteriaList
 import torch
 
+from ser.utils.conf import get_config, model_path
+from ser.utils.metrics import span, timed, llm_prefill_seconds, llm_decode_seconds, llm_ttft_seconds, \
+    llm_tokens_per_second
+
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 logging.info(f'使用设备: {device}')
 
@@ -16,40 +29,882 @@ PROJECT_BASE = os.path.abspath(
             )
 )
 
-emb_model_path = os.path.join(PROJECT_BASE, 'models/bge-small-zh-v1.5')
-llm_model_path = os.path.join(PROJECT_BASE, 'models/Qwen3-4B-Instruct-2507')
+emb_model_path = os.path.join(PROJECT_BASE, model_path('embedding'))
+llm_model_path = os.path.join(PROJECT_BASE, model_path('llm'))
 
-emb_model = SentenceTransformer(emb_model_path).to(device)
+# 开启后 llm/llm_stream/llm_batch 统一提交到连续批处理调度线程
+llm_scheduler_enabled = bool(get_config('model', {}).get('llm_scheduler', {}).get('enabled', False))
 
+# 投机解码草稿模型(与主模型同词表的小模型), 未配置或不存在时回退普通解码;
+# 只在直接生成路径使用, 连续批处理调度开启时不加载, 避免占用显存
+_draft_model_conf = get_config('model', {}).get('draft_model')
+draft_model_path = (os.path.join(PROJECT_BASE, _draft_model_conf)
+                    if _draft_model_conf and not llm_scheduler_enabled else None)
+
+# 向量模型后端: torch | onnx | onnx_int8 (onnx后端仅CPU)
+_embedding_conf = get_config('model', {}).get('embedding', {})
+embedding_backend = _embedding_conf.get('backend', 'torch')
+emb_onnx_dir = os.path.join(PROJECT_BASE, _embedding_conf.get('onnx_dir', 'models/bge-small-zh-v1.5-onnx'))
+
+# 重排序模型(cross-encoder), chat.rerank.enabled 开启时预热加载
+_rerank_conf = get_config('chat', {}).get('rerank', {})
+rerank_enabled = bool(_rerank_conf.get('enabled', False))
+reranker_model_path = os.path.join(PROJECT_BASE, _rerank_conf.get('model', 'models/bge-reranker-base'))
+
+
+def load_embedding_model(backend: str = None):
+    """按后端加载向量模型, 返回对象均提供 encode / get_sentence_embedding_dimension"""
+    backend = backend or embedding_backend
+    if backend in ('onnx', 'onnx_int8'):
+        from ser.utils.onnx_embed import OnnxEmbedder
+        return OnnxEmbedder(emb_model_path, emb_onnx_dir,
+                            quantize=backend == 'onnx_int8',
+                            intra_op_threads=_embedding_conf.get('intra_op_threads', 0))
+    if backend != 'torch':
+        raise ValueError(f"不支持的向量模型后端: {backend}")
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(emb_model_path).to(device)
+
+
+
+class ModelLoader:
+    """
+    模型懒加载
+    导入模块时不加载模型, 首次使用时加载; 服务启动后由 warmup 显式加载并预热
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._emb_model = None
+        self._tokenizer = None
+        self._llm_model = None
+        self._draft_model = None
+        self._draft_checked = False
+        self._reranker = None
+        self.ready = False
+        self.warmup_error = None
+
+    @property
+    def emb_model(self):
+        if self._emb_model is None:
+            with self._lock:
+                if self._emb_model is None:
+                    st = time.time()
+                    self._emb_model = load_embedding_model()
+                    logging.info(f"加载向量模型 {emb_model_path} backend={embedding_backend} "
+                                 f"耗时 {time.time() - st:.1f}s")
+        return self._emb_model
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            with self._lock:
+                if self._tokenizer is None:
+                    tokenizer = AutoTokenizer.from_pretrained(llm_model_path)
+                    # 批量生成需左侧padding, 保证各序列的生成位置对齐
+                    tokenizer.padding_side = 'left'
+                    if tokenizer.pad_token is None:
+                        tokenizer.pad_token = tokenizer.eos_token
+                    self._tokenizer = tokenizer
+        return self._tokenizer
+
+    @property
+    def llm_model(self):
+        if self._llm_model is None:
+            with self._lock:
+                if self._llm_model is None:
+                    st = time.time()
+                    self._llm_model = AutoModelForCausalLM.from_pretrained(
+                        llm_model_path,
+                        # torch_dtype="auto",
+                        dtype="auto",
+                        device_map=device
+                    )
+                    logging.info(f"加载语言模型 {llm_model_path} 耗时 {time.time() - st:.1f}s")
+        return self._llm_model
+
+    @property
+    def draft_model(self):
+        """草稿模型, 未配置、文件不存在或连续批处理调度开启时为None"""
+        if not self._draft_checked:
+            with self._lock:
+                if not self._draft_checked:
+                    if draft_model_path and os.path.exists(draft_model_path):
+                        st = time.time()
+                        self._draft_model = AutoModelForCausalLM.from_pretrained(
+                            draft_model_path,
+                            dtype="auto",
+                            device_map=device
+                        )
+                        speculative_stats.attach(self.llm_model, self._draft_model)
+                        logging.info(f"加载草稿模型 {draft_model_path} 耗时 {time.time() - st:.1f}s")
+                    else:
+                        logging.info(f"未找到草稿模型 {draft_model_path}, 使用普通解码")
+                    self._draft_checked = True
+        return self._draft_model
+
+    @property
+    def reranker(self):
+        if self._reranker is None:
+            with self._lock:
+                if self._reranker is None:
+                    from sentence_transformers import CrossEncoder
+                    st = time.time()
+                    self._reranker = CrossEncoder(reranker_model_path, max_length=512, device=device)
+                    logging.info(f"加载重排序模型 {reranker_model_path} 耗时 {time.time() - st:.1f}s")
+        return self._reranker
+
+    def warmup(self):
+        """加载全部模型并各跑一次推理, 完成后标记就绪"""
+        try:
+            st = time.time()
+            embed(['warmup'])
+            if draft_model_path:
+                _ = self.draft_model
+            if rerank_enabled:
+                rerank('warmup', ['warmup'])
+            llm([{"role": "user", "content": "你好"}], profile=GenerationProfile(name='warmup', max_new_tokens=1))
+            self.ready = True
+            logging.info(f"模型预热完成 耗时 {time.time() - st:.1f}s")
+        except Exception as e:
+            self.warmup_error = str(e)
+            logging.error(f"模型预热失败: {e}")
+            raise
+
+    def status(self):
+        return {
+            'ready': self.ready,
+            'device': device,
+            'embedding_backend': embedding_backend,
+            'emb_model_loaded': self._emb_model is not None,
+            'llm_model_loaded': self._llm_model is not None,
+            'draft_model_loaded': self._draft_model is not None,
+            'reranker_loaded': self._reranker is not None,
+            'warmup_error': self.warmup_error,
+        }
 
-tokenizer = AutoTokenizer.from_pretrained(llm_model_path)
-llm_model = AutoModelForCausalLM.from_pretrained(
-    llm_model_path,
-    # torch_dtype="auto",
-    dtype="auto",
-    device_map=device
-)
+
+model_loader = ModelLoader()
 
 
 def embed(chunks: List[str]):
-    return emb_model.encode(chunks, normalize_embeddings=True)
+    return model_loader.emb_model.encode(chunks, normalize_embeddings=True)
+
+
+@timed('embed_batch')
+def embed_batch(chunks: List[str], batch_size: int = 32):
+    """
+    批量向量化(入库用)
+    按文本长度排序后分桶encode, 同一批内长度相近以减少padding,
+    返回结果按输入顺序还原, 第i行对应chunks[i]
+    """
+    if not chunks:
+        return np.zeros((0, model_loader.emb_model.get_sentence_embedding_dimension()), dtype=np.float32)
+    batch_size = max(1, int(batch_size))
+    order = sorted(range(len(chunks)), key=lambda i: len(chunks[i]), reverse=True)
+    vectors = None
+    for start in range(0, len(order), batch_size):
+        bucket = order[start:start + batch_size]
+        emb = model_loader.emb_model.encode([chunks[i] for i in bucket],
+                               batch_size=len(bucket),
+                               normalize_embeddings=True)
+        if vectors is None:
+            vectors = np.zeros((len(chunks), emb.shape[1]), dtype=emb.dtype)
+        vectors[bucket] = emb
+    return vectors
+
+
+class EmbeddingBatcher:
+    """
+    查询向量动态微批调度
+    并发的embed请求先进入队列, 后台线程在 max_wait_ms 内尽量凑满 max_batch_size 后统一encode,
+    再按请求切分结果, 每个调用方只拿到自己的向量
+    """
+
+    def __init__(self, encode_fn, max_batch_size: int = 32, max_wait_ms: float = 5):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        # 统计: 请求数 批次数 文本数 批大小分布 队列深度
+        self._requests = 0
+        self._batches = 0
+        self._items = 0
+        self._last_batch_size = 0
+        self._max_batch_seen = 0
+        self._max_queue_depth = 0
+        self._batch_size_hist = {}
+        self._thread = threading.Thread(target=self._run, name='embed-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, chunks: List[str]) -> Future:
+        """提交一组文本, 返回Future, 结果为与chunks一一对应的向量"""
+        fut = Future()
+        self._queue.put((list(chunks), fut))
+        with self._lock:
+            self._requests += 1
+            self._max_queue_depth = max(self._max_queue_depth, self._queue.qsize())
+        return fut
+
+    def embed(self, chunks: List[str]):
+        """同步获取向量"""
+        return self.submit(chunks).result()
+
+    async def aembed(self, chunks: List[str]):
+        """异步获取向量, 不阻塞事件循环"""
+        return await asyncio.wrap_future(self.submit(chunks))
+
+    def _collect(self):
+        """阻塞取第一个请求, 然后在等待窗口内继续收集直到批次满"""
+        batch = [self._queue.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch, size
+
+    def _run(self):
+        while True:
+            batch, size = self._collect()
+            # 调用方已取消(如客户端断开时经 wrap_future 传递)的请求不再计算; 标记为运行中后不能再被取消,
+            # 之后 set_result 不会因状态冲突抛出而使调度线程退出
+            batch = [(chunks, fut) for chunks, fut in batch if fut.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            size = sum(len(chunks) for chunks, _ in batch)
+            texts = [t for chunks, _ in batch for t in chunks]
+            try:
+                with span('embed_encode'):
+                    vectors = self.encode_fn(texts)
+            except Exception as e:
+                logging.error(f"批量向量化失败: {e}")
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+            offset = 0
+            for chunks, fut in batch:
+                fut.set_result(vectors[offset:offset + len(chunks)])
+                offset += len(chunks)
+            self._record(len(batch), size)
+
+    def _record(self, n_requests: int, size: int):
+        with self._lock:
+            self._batches += 1
+            self._items += size
+            self._last_batch_size = size
+            self._max_batch_seen = max(self._max_batch_seen, size)
+            self._batch_size_hist[n_requests] = self._batch_size_hist.get(n_requests, 0) + 1
+        logging.debug(f"embed批次: 请求数={n_requests} 文本数={size} 剩余队列={self._queue.qsize()}")
+
+    def stats(self):
+        """队列深度与批大小统计"""
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'max_queue_depth': self._max_queue_depth,
+                'requests': self._requests,
+                'batches': self._batches,
+                'items': self._items,
+                'avg_batch_size': round(self._items / self._batches, 2) if self._batches else 0,
+                'last_batch_size': self._last_batch_size,
+                'max_batch_size_seen': self._max_batch_seen,
+                # key: 每批合并的请求数 value: 批次数
+                'requests_per_batch': dict(sorted(self._batch_size_hist.items())),
+            }
+
+
+_embed_batch_conf = get_config('model', {}).get('embed_batch', {})
+embed_batcher = EmbeddingBatcher(
+    embed,
+    max_batch_size=_embed_batch_conf.get('max_batch_size', 32),
+    max_wait_ms=_embed_batch_conf.get('max_wait_ms', 5),
+)
+
+
+def embed_query(query_text: str):
+    """单条查询向量, 经微批调度与并发请求合并"""
+    return embed_batcher.embed([query_text])[0]
+
+
+async def aembed_query(query_text: str):
+    """单条查询向量(异步)"""
+    return (await embed_batcher.aembed([query_text]))[0]
+
+@timed('rerank_model')
+def rerank(query: str, passages: List[str], batch_size: int = 32) -> List[float]:
+    """cross-encoder对(问题, 片段)打分, 全部候选一次批量推理, 返回与passages一一对应的相关度"""
+    if not passages:
+        return []
+    scores = model_loader.reranker.predict([(query, p) for p in passages],
+                                           batch_size=max(batch_size, len(passages)),
+                                           convert_to_numpy=True, show_progress_bar=False)
+    return [float(x) for x in scores]
+
+
+@dataclass
+class GenerationProfile:
+    """生成参数模板: 不同任务使用不同的token预算/停止词/采样参数/超时"""
+    name: str
+    max_new_tokens: int = 1024
+    stop_strings: List[str] = field(default_factory=list)
+    do_sample: bool = False
+    temperature: float = 0.7
+    top_p: float = 0.8
+    top_k: int = 20
+    repetition_penalty: float = 1.0
+    timeout_s: float = 60  # 单次generate墙钟超时(秒)
+    speculative: bool = False  # 有草稿模型时使用投机解码
+    lane: str = 'chat'  # 连续批处理调度的优先级: chat(交互) | ingest(入库/后台任务, chat 等待时不接纳)
+
+    def generate_kwargs(self) -> Dict[str, Any]:
+        kwargs = {
+            'max_new_tokens': self.max_new_tokens,
+            'do_sample': self.do_sample,
+            'repetition_penalty': self.repetition_penalty,
+            'max_time': self.timeout_s,
+            'pad_token_id': model_loader.tokenizer.pad_token_id,
+        }
+        if self.do_sample:
+            kwargs.update(temperature=self.temperature, top_p=self.top_p, top_k=self.top_k)
+        if self.stop_strings:
+            kwargs.update(stop_strings=self.stop_strings, tokenizer=model_loader.tokenizer)
+        return kwargs
+
+    def trim(self, text: str) -> str:
+        """截掉停止词及其后的内容"""
+        for stop in self.stop_strings:
+            pos = text.find(stop)
+            if pos >= 0:
+                text = text[:pos]
+        return text
+
+
+_default_profiles = {
+    # 对话回复
+    'chat': dict(max_new_tokens=2048, do_sample=True, temperature=0.7, top_p=0.8, top_k=20, timeout_s=120,
+                 speculative=True),
+    # 入库模拟问题, 只需输出一个短JSON数组
+    'question_gen': dict(max_new_tokens=256, do_sample=False, timeout_s=60, lane='ingest'),
+    # 摘要(后台任务)
+    'summary': dict(max_new_tokens=512, do_sample=False, timeout_s=90, lane='ingest'),
+}
+
+
+def _load_profiles():
+    """默认模板, 可被 server.yaml model.generation_profiles 覆盖或扩展"""
+    conf = get_config('model', {}).get('generation_profiles', {}) or {}
+    profiles = {}
+    for name in set(_default_profiles) | set(conf):
+        params = {**_default_profiles.get(name, {}), **(conf.get(name) or {})}
+        profiles[name] = GenerationProfile(name=name, **params)
+    return profiles
+
+
+generation_profiles = _load_profiles()
+
+
+def get_profile(profile) -> GenerationProfile:
+    if isinstance(profile, GenerationProfile):
+        return profile
+    if profile not in generation_profiles:
+        raise ValueError(f"未知的生成模板: {profile}")
+    return generation_profiles[profile]
+
+
+class GenerationStats:
+    """按模板统计生成token数与速度"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, profile: str, tokens: int, cost: float, ttft: float = None, prefill: float = None,
+               decode: float = None):
+        """
+        :param cost: 生成总耗时(秒)
+        :param ttft: 首token耗时; prefill: 预填充耗时; decode: 首token之后的解码耗时, 已知时记录到直方图
+        """
+        tps = tokens / cost if cost > 0 else 0
+        # 直方图中的生成速度只计解码阶段
+        decode_tps = (tokens - 1) / decode if decode and tokens > 1 else tps
+        if tokens:
+            llm_tokens_per_second.observe(decode_tps, profile)
+        if ttft is not None:
+            llm_ttft_seconds.observe(ttft, profile)
+        if prefill is not None:
+            llm_prefill_seconds.observe(prefill, profile)
+        if decode is not None:
+            llm_decode_seconds.observe(decode, profile)
+        with self._lock:
+            st = self._stats.setdefault(profile, {'calls': 0, 'tokens': 0, 'seconds': 0.0})
+            st['calls'] += 1
+            st['tokens'] += tokens
+            st['seconds'] += cost
+            st['last_tokens_per_sec'] = round(tps, 2)
+        logging.info(f"llm[{profile}] 生成 {tokens} tokens 耗时 {cost:.2f}s {tps:.1f} tokens/s")
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {**st,
+                       'seconds': round(st['seconds'], 3),
+                       'avg_tokens_per_sec': round(st['tokens'] / st['seconds'], 2) if st['seconds'] else 0}
+                for name, st in self._stats.items()
+            }
+
+
+generation_stats = GenerationStats()
+
+
+def _count_new_tokens(output_ids) -> int:
+    """统计生成部分的有效token数(排除padding)"""
+    return int((output_ids != model_loader.tokenizer.pad_token_id).sum().item())
+
+
+def _cache_nbytes(cache) -> int:
+    """past_key_values 占用字节数, 兼容新旧版本的 DynamicCache"""
+    if hasattr(cache, 'layers'):
+        tensors = [t for layer in cache.layers for t in (layer.keys, layer.values)]
+    else:
+        tensors = list(cache.key_cache) + list(cache.value_cache)
+    return sum(t.numel() * t.element_size() for t in tensors if isinstance(t, torch.Tensor))
+
+
+class SessionKVCache:
+    """
+    会话级KV缓存
+    按 user_identifier 保存上一轮(提示词+回复)的 past_key_values,
+    下一轮与缓存token的公共前缀直接复用, 只prefill新增部分; 按显存预算LRU淘汰;
+    只保存提示词与实际返回给调用方的回复token(停止词之后的内容、不完整的尾部token不保存),
+    与下一轮历史中的回复一致
+    """
 
-def llm(messages: List[Dict[str, str]]):
-    text = tokenizer.apply_chat_template(
+    def __init__(self, max_bytes: int, max_sessions: int = 64):
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self._entries = OrderedDict()  # session_id -> (token_ids, cache, nbytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._reused_tokens = 0
+        self._evictions = 0
+
+    def _pop(self, session_id):
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry:
+                self._bytes -= entry[2]
+            return entry
+
+    def take(self, session_id: str, input_ids: torch.Tensor) -> Dict[str, Any]:
+        """
+        取出会话缓存并裁剪到与input_ids的公共前缀, 返回generate的额外参数
+        缓存被取出期间不在LRU中, 生成结束后由put放回
+        """
+        entry = self._pop(session_id)
+        prefix_len = 0
+        if entry is not None:
+            cached_ids, cache, _ = entry
+            n = min(len(cached_ids), input_ids.shape[-1] - 1)
+            if n > 0:
+                diff = (cached_ids[:n].to(input_ids.device) != input_ids[0, :n]).nonzero()
+                prefix_len = int(diff[0, 0]) if len(diff) else n
+        with self._lock:
+            if prefix_len <= 0:
+                self._misses += 1
+                return {}
+            self._hits += 1
+            self._reused_tokens += prefix_len
+        if cache.get_seq_length() > prefix_len:
+            cache.crop(prefix_len)
+        logging.debug(f"KV缓存命中 session={session_id} 复用 {prefix_len}/{input_ids.shape[-1]} tokens")
+        return {'past_key_values': cache}
+
+    @staticmethod
+    def returned_length(output_ids: List[int], answer: str) -> int:
+        """生成的token中与返回文本一致的前缀长度; 回复完整结束时包含结束符(下一轮模板中回复后紧跟结束符)"""
+        answer_ids = model_loader.tokenizer.encode(answer, add_special_tokens=False)
+        n = 0
+        for generated, returned in zip(output_ids, answer_ids):
+            if generated != returned:
+                break
+            n += 1
+        if n == len(answer_ids) and n < len(output_ids) and output_ids[n] in _eos_token_ids():
+            n += 1
+        return n
+
+    def put(self, session_id: str, sequence: torch.Tensor, cache, prompt_len: int, answer: str):
+        """
+        保存本轮序列的缓存, 超出显存预算时淘汰最久未使用的会话
+        :param prompt_len: 提示词token数, sequence[prompt_len:] 为生成的token
+        :param answer: 实际返回的回复文本
+        """
+        if cache is None:
+            return
+        keep = prompt_len + self.returned_length(sequence[prompt_len:].tolist(), answer)
+        # 最后一个生成token未经过前向, 不在缓存中
+        keep = min(keep, cache.get_seq_length())
+        if cache.get_seq_length() > keep:
+            cache.crop(keep)
+        nbytes = _cache_nbytes(cache)
+        if nbytes > self.max_bytes:
+            return
+        cached_ids = sequence[:keep].detach()
+        with self._lock:
+            old = self._entries.pop(session_id, None)
+            if old:
+                self._bytes -= old[2]
+            self._entries[session_id] = (cached_ids, cache, nbytes)
+            self._bytes += nbytes
+            while self._entries and (self._bytes > self.max_bytes or len(self._entries) > self.max_sessions):
+                _, (_, _, freed) = self._entries.popitem(last=False)
+                self._bytes -= freed
+                self._evictions += 1
+
+    def stats(self):
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                'sessions': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / total, 4) if total else 0,
+                'reused_tokens': self._reused_tokens,
+                'evictions': self._evictions,
+            }
+
+
+_kv_cache_conf = get_config('model', {}).get('kv_cache', {})
+session_kv_cache = SessionKVCache(
+    max_bytes=int(_kv_cache_conf.get('max_memory_mb', 2048)) * 1024 * 1024,
+    max_sessions=_kv_cache_conf.get('max_sessions', 64),
+) if _kv_cache_conf.get('enabled', True) else None
+
+
+def _session_take(session_id, model_inputs):
+    if session_id is None or session_kv_cache is None:
+        return {}
+    return session_kv_cache.take(session_id, model_inputs.input_ids)
+
+
+def _session_put(session_id, profile: GenerationProfile, outputs, prompt_len: int, answer: str):
+    # 辅助生成不使用会话缓存
+    if session_id is None or session_kv_cache is None or _draft_for(profile) is not None:
+        return
+    session_kv_cache.put(session_id, outputs.sequences[0], outputs.past_key_values, prompt_len, answer)
+
+
+_eos_ids = None
+
+
+def _eos_token_ids():
+    global _eos_ids
+    if _eos_ids is None:
+        eos = model_loader.llm_model.generation_config.eos_token_id
+        eos = set(eos if isinstance(eos, (list, tuple)) else [eos])
+        eos.add(model_loader.tokenizer.eos_token_id)
+        _eos_ids = {e for e in eos if e is not None}
+    return _eos_ids
+
+
+class SpeculativeStats:
+    """
+    投机解码接受率统计
+    通过forward hook计数主模型验证轮数与草稿模型提议token数:
+    每轮接受的草稿token = 本轮新增token - 1, 接受率 = 接受数 / 提议数
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._attached = False
+        self.calls = 0
+        self.new_tokens = 0
+        self.target_forwards = 0
+        self.draft_forwards = 0
+
+    def attach(self, target_model, draft_model):
+        if self._attached:
+            return
+        target_model.register_forward_hook(self._hook(0))
+        draft_model.register_forward_hook(self._hook(1))
+        self._attached = True
+
+    def _hook(self, idx):
+        def hook(module, args, output):
+            # 只统计当前线程中处于track内的调用
+            counts = getattr(self._local, 'counts', None)
+            if counts is not None:
+                counts[idx] += 1
+        return hook
+
+    @contextmanager
+    def track(self):
+        counts = self._local.counts = [0, 0]
+        try:
+            yield counts
+        finally:
+            self._local.counts = None
+
+    def record(self, counts, new_tokens: int):
+        target_forwards, draft_forwards = counts
+        accepted = max(0, new_tokens - target_forwards)
+        with self._lock:
+            self.calls += 1
+            self.new_tokens += new_tokens
+            self.target_forwards += target_forwards
+            self.draft_forwards += draft_forwards
+        rate = accepted / draft_forwards if draft_forwards else 0
+        logging.info(f"投机解码 新增 {new_tokens} tokens 验证 {target_forwards} 轮 "
+                     f"草稿提议 {draft_forwards} 接受率 {rate:.2%}")
+
+    def stats(self):
+        with self._lock:
+            accepted = max(0, self.new_tokens - self.target_forwards)
+            return {
+                'calls': self.calls,
+                'new_tokens': self.new_tokens,
+                'target_forwards': self.target_forwards,
+                'draft_tokens': self.draft_forwards,
+                'acceptance_rate': round(accepted / self.draft_forwards, 4) if self.draft_forwards else 0,
+                'tokens_per_target_forward': round(self.new_tokens / self.target_forwards, 3)
+                if self.target_forwards else 0,
+            }
+
+
+speculative_stats = SpeculativeStats()
+
+
+def _draft_for(profile: GenerationProfile):
+    return model_loader.draft_model if profile.speculative else None
+
+
+def _generate(model_inputs, profile: GenerationProfile, session_id: str = None, **extra):
+    """
+    直接调用generate
+    模板开启speculative且草稿模型可用时走辅助生成(贪心解码下输出与普通解码一致), 否则复用会话KV缓存;
+    得到返回文本后由调用方 _session_put 保存本轮缓存
+    """
+    draft = _draft_for(profile)
+    if draft is None:
+        return model_loader.llm_model.generate(
+            **model_inputs,
+            **profile.generate_kwargs(),
+            **_session_take(session_id, model_inputs),
+            **extra,
+            return_dict_in_generate=True
+        )
+
+    # 辅助生成按单序列逐轮验证, 不使用会话缓存
+    with speculative_stats.track() as counts:
+        outputs = model_loader.llm_model.generate(
+            **model_inputs,
+            **profile.generate_kwargs(),
+            **extra,
+            assistant_model=draft,
+            return_dict_in_generate=True
+        )
+    output_ids = outputs.sequences[0][model_inputs.input_ids.shape[1]:]
+    speculative_stats.record(counts, _count_new_tokens(output_ids))
+    return outputs
+
+
+def _scheduler():
+    if not llm_scheduler_enabled:
+        return None
+    from ser.utils.llm_scheduler import llm_scheduler
+    return llm_scheduler
+
+
+def model_stats():
+    """模型侧统计(在模型所在进程调用): 微批大小、生成速度、投机解码接受率、会话KV缓存、调度队列"""
+    scheduler = _scheduler()
+    return {
+        'model': model_loader.status(),
+        'embed_batcher': embed_batcher.stats(),
+        'generation': generation_stats.stats(),
+        'speculative': speculative_stats.stats(),
+        'session_kv_cache': session_kv_cache.stats() if session_kv_cache is not None else None,
+        'llm_scheduler': scheduler.stats() if scheduler is not None else None,
+    }
+
+
+def llm(messages: List[Dict[str, str]], profile='chat', session_id: str = None):
+    """
+    单条生成
+    session_id: 会话标识, 传入时复用该会话上一轮的KV缓存
+    """
+    scheduler = _scheduler()
+    if scheduler is not None:
+        return scheduler.generate(messages, profile, session_id)
+    profile = get_profile(profile)
+    text = model_loader.tokenizer.apply_chat_template(
+        messages,
+        tokenize=False,
+        add_generation_prompt=True,
+    )
+    model_inputs = model_loader.tokenizer([text], return_tensors="pt").to(device)
+
+    st = time.time()
+    timer = _FirstTokenTimer()
+    outputs = _generate(model_inputs, profile, session_id, stopping_criteria=StoppingCriteriaList([timer]))
+
+    output_ids = outputs.sequences[0][len(model_inputs.input_ids[0]):]
+    end = time.time()
+    generation_stats.record(profile.name, _count_new_tokens(output_ids), end - st, **timer.timings(st, end))
+    answer = profile.trim(model_loader.tokenizer.decode(output_ids.tolist(), skip_special_tokens=True))
+    _session_put(session_id, profile, outputs, model_inputs.input_ids.shape[1], answer)
+    return answer
+
+
+class _FirstTokenTimer(StoppingCriteria):
+    """记录首个token生成的时间, 首次被调用时预填充与第一个token已完成"""
+
+    def __init__(self):
+        self.first_token_time = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first_token_time is None:
+            self.first_token_time = time.time()
+        return False
+
+    def timings(self, st: float, end: float) -> Dict[str, float]:
+        if self.first_token_time is None:
+            return {}
+        ttft = self.first_token_time - st
+        return {'ttft': ttft, 'prefill': ttft, 'decode': end - self.first_token_time}
+
+
+class _EventStoppingCriteria(StoppingCriteria):
+    """外部事件触发时停止生成(如客户端断开)"""
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.event.is_set()
+
+
+def llm_stream(messages: List[Dict[str, str]], profile='chat', session_id: str = None):
+    """
+    流式生成: generate在后台线程执行, 按解码进度逐段yield文本
+    调用方提前关闭生成器时停止后台生成
+    session_id: 会话标识, 传入时复用该会话上一轮的KV缓存
+    """
+    scheduler = _scheduler()
+    if scheduler is not None:
+        yield from _llm_stream_scheduled(scheduler, messages, profile, session_id)
+        return
+    profile = get_profile(profile)
+    text = model_loader.tokenizer.apply_chat_template(
         messages,
         tokenize=False,
         add_generation_prompt=True,
     )
-    model_inputs = tokenizer([text], return_tensors="pt").to(device)
+    model_inputs = model_loader.tokenizer([text], return_tensors="pt").to(device)
+    streamer = TextIteratorStreamer(model_loader.tokenizer, skip_prompt=True, skip_special_tokens=True)
+    stop_event = threading.Event()
+    timer = _FirstTokenTimer()
+    result = {}
+
+    def _run():
+        result['outputs'] = _generate(
+            model_inputs, profile, session_id,
+            streamer=streamer,
+            stopping_criteria=StoppingCriteriaList([_EventStoppingCriteria(stop_event), timer])
+        )
+
+    st = time.time()
+    thread = threading.Thread(target=_run, name='llm-stream', daemon=True)
+    thread.start()
+    emitted = ''
+    try:
+        for piece in streamer:
+            if not piece:
+                continue
+            # 遇到停止词时截断并结束
+            trimmed = profile.trim(emitted + piece)
+            if len(trimmed) < len(emitted) + len(piece):
+                if len(trimmed) > len(emitted):
+                    yield trimmed[len(emitted):]
+                    emitted = trimmed
+                break
+            emitted += piece
+            yield piece
+    finally:
+        stop_event.set()
+        thread.join()
+        if 'outputs' in result:
+            output_ids = result['outputs'].sequences[0][model_inputs.input_ids.shape[1]:]
+            end = time.time()
+            generation_stats.record(profile.name, _count_new_tokens(output_ids), end - st, **timer.timings(st, end))
+            # 只缓存已返回给调用方的内容(中途断开时为部分回复, 与历史记录一致)
+            _session_put(session_id, profile, result['outputs'], model_inputs.input_ids.shape[1], emitted)
+
+
+def _llm_stream_scheduled(scheduler, messages, profile, session_id):
+    """经调度线程流式生成, 回调写入队列后逐段yield"""
+    pieces = queue.Queue()
+    stop_event = threading.Event()
+    future = scheduler.submit(messages, profile, session_id, on_text=pieces.put, stop_event=stop_event)
+    future.add_done_callback(lambda _: pieces.put(None))
+    deadline = time.time() + scheduler.wait_timeout(profile)
+    try:
+        while True:
+            try:
+                piece = pieces.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                raise TimeoutError('llm流式生成等待超时')
+            if piece is None:
+                break
+            yield piece
+        future.result()
+    finally:
+        stop_event.set()
+
+
+def llm_batch(messages_list: List[List[Dict[str, str]]], profile='question_gen') -> List[str]:
+    """
+    批量生成: 多组对话左侧padding后合并为一次generate
+    返回结果与messages_list一一对应
+    """
+    if not messages_list:
+        return []
+    scheduler = _scheduler()
+    if scheduler is not None:
+        stop_event = threading.Event()
+        futures = [scheduler.submit(messages, profile, stop_event=stop_event) for messages in messages_list]
+        return [scheduler.wait(future, profile, stop_event) for future in futures]
+    profile = get_profile(profile)
+    texts = [
+        model_loader.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        for messages in messages_list
+    ]
+    model_inputs = model_loader.tokenizer(texts, return_tensors="pt", padding=True).to(device)
 
-    generated_ids = llm_model.generate(
+    st = time.time()
+    generated_ids = model_loader.llm_model.generate(
         **model_inputs,
-        max_new_tokens=16384
+        **profile.generate_kwargs()
     )
 
-    output_ids = generated_ids[0][len(model_inputs.input_ids[0]):].tolist()
-    content = tokenizer.decode(output_ids, skip_special_tokens=True)
-    return content
+    # 左侧padding后所有序列输入长度一致
+    input_len = model_inputs.input_ids.shape[1]
+    output_ids = generated_ids[:, input_len:]
+    generation_stats.record(profile.name, _count_new_tokens(output_ids), time.time() - st)
+    return [profile.trim(text) for text in model_loader.tokenizer.batch_decode(output_ids, skip_special_tokens=True)]
 
 
 if __name__ == '__main__':
@@ -69,7 +924,7 @@ if __name__ == '__main__':
                                     f'\n\n请根据以上内容,模拟提出最多3个问题'
                                     f'\n请以标准JSON数组格式输出,例如：[\"问题1\", \"问题2\", \"问题3\"]'}
     ]
-    s = llm(messages)
+    s = llm(messages, profile='question_gen')
     logging.info(type(s))
     logging.info(s)
 
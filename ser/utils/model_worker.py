@@ -0,0 +1,419 @@
+import asyncio
+import itertools
+import logging
+import queue
+import threading
+import multiprocessing as mp
+from contextlib import nullcontext
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from typing import List, Dict
+
+import numpy as np
+
+from ser.utils.conf import get_config
+from ser.utils.embed_cache import query_embed_cache
+from ser.utils.work_scheduler import work_scheduler
+
+# 操作所属的并发池
+_OP_KINDS = {
+    'embed_query': 'embed',
+    'embed_batch': 'embed',
+    'rerank': 'embed',
+    'llm': 'llm',
+    'llm_batch': 'llm',
+    'llm_stream': 'llm',
+    'stats': 'control',
+    'metrics': 'control',
+}
+
+
+def _to_shm(array) -> Dict:
+    """向量数组写入共享内存, 只通过队列传递名称与形状"""
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    shm.close()
+    return {'shm': shm.name, 'shape': array.shape, 'dtype': str(array.dtype)}
+
+
+def _from_shm(meta: Dict):
+    """从共享内存读出向量数组并释放共享内存"""
+    shm = shared_memory.SharedMemory(name=meta['shm'])
+    try:
+        return np.ndarray(meta['shape'], dtype=meta['dtype'], buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+# ---------------- 子进程 ----------------
+
+def _handle(model_cli, responses, cancel_events, req_id, op, args):
+    try:
+        if op == 'embed_query':
+            responses.put((req_id, 'ok', _to_shm(model_cli.embed_query(*args))))
+        elif op == 'embed_batch':
+            responses.put((req_id, 'ok', _to_shm(model_cli.embed_batch(*args))))
+        elif op == 'rerank':
+            responses.put((req_id, 'ok', model_cli.rerank(*args)))
+        elif op == 'llm':
+            responses.put((req_id, 'ok', model_cli.llm(*args)))
+        elif op == 'llm_batch':
+            responses.put((req_id, 'ok', model_cli.llm_batch(*args)))
+        elif op == 'llm_stream':
+            event = cancel_events[req_id]
+            stream = model_cli.llm_stream(*args)
+            try:
+                for piece in stream:
+                    if event.is_set():
+                        break
+                    responses.put((req_id, 'chunk', piece))
+            finally:
+                stream.close()
+            responses.put((req_id, 'ok', None))
+        elif op == 'stats':
+            responses.put((req_id, 'ok', model_cli.model_stats()))
+        elif op == 'metrics':
+            from ser.utils.metrics import metrics_registry
+            responses.put((req_id, 'ok', metrics_registry.snapshot()))
+        else:
+            raise ValueError(f"未知操作: {op}")
+    except Exception as e:
+        logging.exception(f"模型进程处理失败 op={op}: {e}")
+        responses.put((req_id, 'error', f"{type(e).__name__}: {e}"))
+    finally:
+        cancel_events.pop(req_id, None)
+
+
+def _worker_main(requests, responses, limits):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - model-worker - %(levelname)s - %(message)s')
+    from ser.utils import model_cli
+
+    try:
+        model_cli.model_loader.warmup()
+        responses.put((None, 'ready', model_cli.model_loader.status()))
+    except Exception as e:
+        responses.put((None, 'error', str(e)))
+
+    # 每类操作一个线程池, 线程数即该类操作的并发上限
+    pools = {kind: ThreadPoolExecutor(max_workers=max(1, int(n)), thread_name_prefix=f'worker-{kind}')
+             for kind, n in limits.items()}
+    cancel_events = {}
+    while True:
+        msg = requests.get()
+        if msg is None:
+            break
+        req_id, op, args = msg
+        if op == 'cancel':
+            event = cancel_events.get(req_id)
+            if event:
+                event.set()
+            continue
+        if op == 'llm_stream':
+            cancel_events[req_id] = threading.Event()
+        pools[_OP_KINDS.get(op, 'control')].submit(_handle, model_cli, responses, cancel_events, req_id, op, args)
+    for pool in pools.values():
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+# ---------------- 主进程 ----------------
+
+class ModelWorkerClient:
+    """
+    模型子进程客户端
+    请求经队列发给子进程, 后台线程读取响应并完成对应的Future; 向量结果经共享内存传回
+    """
+
+    def __init__(self, limits: Dict[str, int]):
+        self.limits = limits
+        self._ctx = mp.get_context('spawn')
+        self._requests = None
+        self._responses = None
+        self._process = None
+        self._pending = {}  # req_id -> Future 或 流式 queue.Queue
+        self._pending_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.ready = False
+        self.error = None
+        self.worker_status = {}
+
+    def start(self):
+        self._requests = self._ctx.Queue()
+        self._responses = self._ctx.Queue()
+        self._process = self._ctx.Process(target=_worker_main,
+                                          args=(self._requests, self._responses, self.limits),
+                                          name='model-worker', daemon=True)
+        self._process.start()
+        threading.Thread(target=self._read_responses, name='model-worker-reader', daemon=True).start()
+        logging.info(f"模型进程已启动 pid={self._process.pid} limits={self.limits}")
+
+    def _read_responses(self):
+        while True:
+            try:
+                req_id, kind, payload = self._responses.get(timeout=1)
+            except queue.Empty:
+                if not self._process.is_alive():
+                    self._on_worker_exit()
+                    return
+                continue
+            if req_id is None:
+                self.ready = kind == 'ready'
+                self.error = None if self.ready else payload
+                self.worker_status = payload if self.ready else {}
+                continue
+            with self._pending_lock:
+                target = self._pending.get(req_id)
+                if kind != 'chunk':
+                    self._pending.pop(req_id, None)
+            # 共享内存无论结果是否还有人等待都要读出并释放, 避免泄漏
+            if kind == 'ok' and isinstance(payload, dict) and 'shm' in payload:
+                payload = _from_shm(payload)
+            if target is None:
+                continue
+            if isinstance(target, queue.Queue):
+                if kind == 'chunk':
+                    target.put(payload)
+                else:
+                    target.put(RuntimeError(payload) if kind == 'error' else None)
+                continue
+            # 调用方已取消(如 wait_for 超时经 wrap_future 传递取消), 结果丢弃; 不能抛出, 否则读取线程退出后所有调用挂起
+            if target.done():
+                continue
+            try:
+                if kind == 'error':
+                    target.set_exception(RuntimeError(payload))
+                else:
+                    target.set_result(payload)
+            except InvalidStateError:
+                pass
+
+    def _on_worker_exit(self):
+        self.ready = False
+        self.error = f"模型进程已退出 exitcode={self._process.exitcode}"
+        logging.error(self.error)
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for target in pending.values():
+            if isinstance(target, queue.Queue):
+                target.put(RuntimeError(self.error))
+            elif not target.done():
+                try:
+                    target.set_exception(RuntimeError(self.error))
+                except InvalidStateError:
+                    pass
+
+    def call(self, op: str, *args) -> Future:
+        if self._process is None or not self._process.is_alive():
+            raise RuntimeError(self.error or '模型进程未启动')
+        req_id = next(self._ids)
+        future = Future()
+        with self._pending_lock:
+            self._pending[req_id] = future
+        future.add_done_callback(lambda f: self._discard(req_id) if f.cancelled() else None)
+        self._requests.put((req_id, op, args))
+        return future
+
+    def _discard(self, req_id):
+        """已取消的调用不再等待结果, 之后到达的响应按无主处理(释放共享内存)"""
+        with self._pending_lock:
+            self._pending.pop(req_id, None)
+
+    def stream(self, op: str, *args):
+        """流式调用, 同步生成器; 提前关闭时通知子进程停止生成"""
+        if self._process is None or not self._process.is_alive():
+            raise RuntimeError(self.error or '模型进程未启动')
+        req_id = next(self._ids)
+        pieces = queue.Queue()
+        with self._pending_lock:
+            self._pending[req_id] = pieces
+        self._requests.put((req_id, op, args))
+        finished = False
+        try:
+            while True:
+                try:
+                    piece = pieces.get(timeout=1)
+                except queue.Empty:
+                    # 子进程崩溃时读取线程可能已退出, 不能无限等待
+                    if not self._process.is_alive():
+                        raise RuntimeError(self.error or f"模型进程已退出 exitcode={self._process.exitcode}")
+                    continue
+                if piece is None:
+                    finished = True
+                    return
+                if isinstance(piece, Exception):
+                    finished = True
+                    raise piece
+                yield piece
+        finally:
+            if not finished:
+                self._requests.put((req_id, 'cancel', ()))
+                with self._pending_lock:
+                    self._pending.pop(req_id, None)
+
+    def stop(self):
+        if self._process is not None and self._process.is_alive():
+            self._requests.put(None)
+            self._process.join(timeout=10)
+
+
+class ModelClient:
+    """
+    模型调用入口
+    model.worker.enabled 开启时推理在独立子进程执行, 否则在本进程线程池执行;
+    API层统一await结果, 不阻塞事件循环
+    model.work_scheduler 开启时每次调用先在 chat/ingest 通道申请槽位, 交互请求优先
+    """
+
+    def __init__(self):
+        conf = get_config('model', {}).get('worker', {})
+        self.use_process = bool(conf.get('enabled', False))
+        self._worker = ModelWorkerClient(
+            limits={
+                'embed': conf.get('embed_concurrency', 4),
+                'llm': conf.get('llm_concurrency', 16),
+                'control': 1,
+            },
+        ) if self.use_process else None
+
+    def start(self, warmup: bool = True):
+        """服务启动时调用: 拉起模型进程, 或在本进程后台预热"""
+        if self._worker is not None:
+            self._worker.start()
+        elif warmup:
+            from ser.utils.model_cli import model_loader
+            threading.Thread(target=model_loader.warmup, name='model-warmup', daemon=True).start()
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.stop()
+
+    def status(self):
+        if self._worker is not None:
+            return {'mode': 'process', 'ready': self._worker.ready, 'error': self._worker.error,
+                    **self._worker.worker_status}
+        from ser.utils.model_cli import model_loader
+        return {'mode': 'inprocess', **model_loader.status()}
+
+    @property
+    def ready(self):
+        return self.status()['ready']
+
+    @staticmethod
+    def _slot(lane: str, bounded: bool = True, kind: str = 'llm'):
+        return work_scheduler.slot(lane, bounded, kind) if work_scheduler is not None else nullcontext()
+
+    @staticmethod
+    def _aslot(lane: str, bounded: bool = True, kind: str = 'llm'):
+        return work_scheduler.aslot(lane, bounded, kind) if work_scheduler is not None else nullcontext()
+
+    async def embed_query(self, text: str):
+        # 重复查询(重试/重复提交)直接取缓存向量
+        if query_embed_cache is not None:
+            vector = await query_embed_cache.aget(text)
+            if vector is not None:
+                return vector
+        async with self._aslot('chat', kind='embed'):
+            if self._worker is not None:
+                vector = await asyncio.wrap_future(self._worker.call('embed_query', text))
+            else:
+                from ser.utils import model_cli
+                vector = await model_cli.aembed_query(text)
+        if query_embed_cache is not None:
+            query_embed_cache.put(text, vector)
+        return vector
+
+    def _embed_batch(self, texts: List[str], batch_size: int):
+        if self._worker is not None:
+            return self._worker.call('embed_batch', texts, batch_size).result()
+        from ser.utils import model_cli
+        return model_cli.embed_batch(texts, batch_size)
+
+    def embed_batch(self, texts: List[str], batch_size: int = 32):
+        """入库向量化; 开启调度时按批申请槽位, 批次之间让出给聊天请求"""
+        if work_scheduler is None or len(texts) <= batch_size:
+            with self._slot('ingest', bounded=False, kind='embed'):
+                return self._embed_batch(texts, batch_size)
+        # 先按长度排序再分批, 与 model_cli.embed_batch 一样减少padding, 结果按输入顺序还原
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+        vectors = None
+        for start in range(0, len(order), batch_size):
+            bucket = order[start:start + batch_size]
+            with self._slot('ingest', bounded=False, kind='embed'):
+                emb = self._embed_batch([texts[i] for i in bucket], batch_size)
+            if vectors is None:
+                vectors = np.zeros((len(texts), emb.shape[1]), dtype=emb.dtype)
+            vectors[bucket] = emb
+        return vectors
+
+    async def rerank(self, query: str, passages: List[str]) -> List[float]:
+        async with self._aslot('chat', kind='rerank'):
+            if self._worker is not None:
+                return await asyncio.wrap_future(self._worker.call('rerank', query, passages))
+            from ser.utils import model_cli
+            return await asyncio.to_thread(model_cli.rerank, query, passages)
+
+    async def llm(self, messages: List[Dict[str, str]], profile: str = 'chat', session_id: str = None) -> str:
+        async with self._aslot('chat'):
+            if self._worker is not None:
+                return await asyncio.wrap_future(self._worker.call('llm', messages, profile, session_id))
+            from ser.utils import model_cli
+            return await asyncio.to_thread(model_cli.llm, messages, profile, session_id)
+
+    def llm_sync(self, messages: List[Dict[str, str]], profile: str = 'chat', session_id: str = None,
+                 lane: str = 'ingest') -> str:
+        """线程内调用, 用于入库与后台任务(模拟问题/对话摘要), 默认走 ingest 通道"""
+        with self._slot(lane, bounded=lane == 'chat'):
+            if self._worker is not None:
+                return self._worker.call('llm', messages, profile, session_id).result()
+            from ser.utils import model_cli
+            return model_cli.llm(messages, profile, session_id)
+
+    def llm_batch(self, messages_list: List[List[Dict[str, str]]], profile: str = 'question_gen') -> List[str]:
+        with self._slot('ingest', bounded=False):
+            if self._worker is not None:
+                return self._worker.call('llm_batch', messages_list, profile).result()
+            from ser.utils import model_cli
+            return model_cli.llm_batch(messages_list, profile)
+
+    def llm_stream(self, messages: List[Dict[str, str]], profile: str = 'chat', session_id: str = None,
+                   reservation=None):
+        """
+        同步生成器, 由StreamingResponse在线程池中迭代; 生成期间占用 chat 槽位
+        reservation: 请求处理函数内已申请的槽位(WorkScheduler.areserve), 生成结束时释放; 未传入时在此申请
+        """
+        with self._slot('chat') if reservation is None else nullcontext():
+            try:
+                if self._worker is not None:
+                    yield from self._worker.stream('llm_stream', messages, profile, session_id)
+                else:
+                    from ser.utils import model_cli
+                    yield from model_cli.llm_stream(messages, profile, session_id)
+            finally:
+                if reservation is not None:
+                    reservation.release()
+
+    def stats(self):
+        if self._worker is not None:
+            stats = self._worker.call('stats').result(timeout=10)
+        else:
+            from ser.utils import model_cli
+            stats = model_cli.model_stats()
+        # 查询向量缓存与调度器在API进程
+        stats['query_embed_cache'] = query_embed_cache.stats() if query_embed_cache is not None else None
+        stats['work_scheduler'] = work_scheduler.stats() if work_scheduler is not None else None
+        return stats
+
+    def metrics_snapshots(self):
+        """本进程与模型进程的指标快照, 进程名 -> 快照"""
+        from ser.utils.metrics import metrics_registry
+        snapshots = {'api': metrics_registry.snapshot()}
+        if self._worker is not None and self._worker.ready:
+            try:
+                snapshots['model_worker'] = self._worker.call('metrics').result(timeout=5)
+            except Exception as e:
+                logging.error(f"获取模型进程指标失败: {e}")
+        return snapshots
+
+
+model_client = ModelClient()
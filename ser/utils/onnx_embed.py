@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+import time
+from typing import List
+
+import numpy as np
+import torch
+from transformers import AutoModel, AutoTokenizer
+
+
+def _pooling_mode(model_path: str) -> str:
+    """读取 sentence-transformers 的池化配置, bge 默认取 CLS"""
+    conf_path = os.path.join(model_path, '1_Pooling', 'config.json')
+    if os.path.exists(conf_path):
+        with open(conf_path, 'r', encoding='utf-8') as f:
+            conf = json.load(f)
+        if conf.get('pooling_mode_mean_tokens'):
+            return 'mean'
+    return 'cls'
+
+
+class _LastHiddenState(torch.nn.Module):
+    """导出用包装: 只输出 last_hidden_state"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        return self.model(input_ids=input_ids,
+                          attention_mask=attention_mask,
+                          token_type_ids=token_type_ids).last_hidden_state
+
+
+class OnnxEmbedder:
+    """
+    向量模型的 ONNX Runtime 后端(CPU)
+    首次使用时导出ONNX, quantize=True 时再做int8动态量化;
+    encode 与 SentenceTransformer.encode 保持一致: 输入顺序不变, 同维度, 可归一化
+    """
+
+    def __init__(self, model_path: str, onnx_dir: str, quantize: bool = False,
+                 max_seq_length: int = 512, intra_op_threads: int = 0):
+        import onnxruntime as ort
+
+        self.model_path = model_path
+        self.onnx_dir = onnx_dir
+        self.max_seq_length = max_seq_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.pooling = _pooling_mode(model_path)
+
+        onnx_path = self._ensure_exported()
+        if quantize:
+            onnx_path = self._ensure_quantized(onnx_path)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+        self._dim = self.session.get_outputs()[0].shape[-1]
+        logging.info(f"ONNX向量模型加载完成 {onnx_path} pooling={self.pooling}")
+
+    def _ensure_exported(self) -> str:
+        onnx_path = os.path.join(self.onnx_dir, 'model.onnx')
+        if os.path.exists(onnx_path):
+            return onnx_path
+        os.makedirs(self.onnx_dir, exist_ok=True)
+        st = time.time()
+        model = AutoModel.from_pretrained(self.model_path).eval()
+        dummy = self.tokenizer(['导出'], return_tensors='pt')
+        token_type_ids = dummy.get('token_type_ids', torch.zeros_like(dummy['input_ids']))
+        dynamic_axes = {name: {0: 'batch', 1: 'sequence'}
+                        for name in ('input_ids', 'attention_mask', 'token_type_ids', 'last_hidden_state')}
+        with torch.no_grad():
+            torch.onnx.export(
+                _LastHiddenState(model),
+                (dummy['input_ids'], dummy['attention_mask'], token_type_ids),
+                onnx_path,
+                input_names=['input_ids', 'attention_mask', 'token_type_ids'],
+                output_names=['last_hidden_state'],
+                dynamic_axes=dynamic_axes,
+                opset_version=17,
+            )
+        logging.info(f"导出ONNX向量模型 {onnx_path} 耗时 {time.time() - st:.1f}s")
+        return onnx_path
+
+    def _ensure_quantized(self, onnx_path: str) -> str:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        int8_path = os.path.join(self.onnx_dir, 'model_int8.onnx')
+        if not os.path.exists(int8_path):
+            quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QInt8)
+            logging.info(f"int8动态量化完成 {int8_path}")
+        return int8_path
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self._dim
+
+    def encode(self, sentences: List[str], batch_size: int = 32, normalize_embeddings: bool = True, **kwargs):
+        if isinstance(sentences, str):
+            sentences = [sentences]
+        if not sentences:
+            return np.zeros((0, self._dim), dtype=np.float32)
+        vectors = np.zeros((len(sentences), self._dim), dtype=np.float32)
+        # 按长度排序分批, 减少padding
+        order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]), reverse=True)
+        for start in range(0, len(order), batch_size):
+            bucket = order[start:start + batch_size]
+            inputs = self.tokenizer([sentences[i] for i in bucket], padding=True, truncation=True,
+                                    max_length=self.max_seq_length, return_tensors='np')
+            if 'token_type_ids' not in inputs:
+                inputs['token_type_ids'] = np.zeros_like(inputs['input_ids'])
+            feeds = {name: inputs[name].astype(np.int64) for name in self._input_names}
+            hidden = self.session.run(None, feeds)[0]
+            if self.pooling == 'mean':
+                mask = inputs['attention_mask'][..., None].astype(np.float32)
+                emb = (hidden * mask).sum(1) / np.clip(mask.sum(1), 1e-9, None)
+            else:
+                emb = hidden[:, 0]
+            vectors[bucket] = emb
+        if normalize_embeddings:
+            vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        return vectors
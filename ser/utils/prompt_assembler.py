@@ -0,0 +1,119 @@
+import logging
+import os
+import threading
+from typing import List, Dict, Any
+
+from transformers import AutoTokenizer
+
+from ser.utils.conf import get_config, model_path
+
+PROJECT_BASE = os.path.abspath(
+            os.path.join(
+                os.path.dirname(os.path.realpath(__file__)),
+                os.pardir
+            )
+)
+
+llm_model_path = os.path.join(PROJECT_BASE, model_path('llm'))
+
+
+class PromptAssembler:
+    """
+    按token预算组装对话提示词
+    优先级: 系统提示词与当前问题(必选) > 检索片段(按排名, 不超过context预算) > 历史(不超过history预算)
+    消息顺序: 系统提示词, 历史, 本轮问题(含文档片段); 稳定的前缀在前, 便于复用会话KV缓存;
+    历史超出预算时从最旧处每次裁掉 history_trim_step 条, 而不是逐条裁剪, 之后若干轮的历史前缀不变
+    """
+
+    def __init__(self, max_prompt_tokens: int = 6144, context_max_tokens: int = 3072,
+                 history_max_tokens: int = 2048, max_question_tokens: int = 512, message_overhead: int = 8,
+                 history_trim_step: int = 10):
+        self.max_prompt_tokens = max_prompt_tokens
+        self.context_max_tokens = context_max_tokens
+        self.history_max_tokens = history_max_tokens
+        self.history_trim_step = max(2, int(history_trim_step) // 2 * 2)
+        self.max_question_tokens = max_question_tokens
+        # 每条消息的模板标记(<|im_start|>role\n ... <|im_end|>\n)开销
+        self.message_overhead = message_overhead
+        self._tokenizer = None
+        self._lock = threading.Lock()
+
+    @property
+    def tokenizer(self):
+        # 只加载分词器, 不依赖模型进程
+        if self._tokenizer is None:
+            with self._lock:
+                if self._tokenizer is None:
+                    self._tokenizer = AutoTokenizer.from_pretrained(llm_model_path)
+        return self._tokenizer
+
+    def count(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        ids = self.tokenizer.encode(text, add_special_tokens=False)
+        if len(ids) <= max_tokens:
+            return text
+        return self.tokenizer.decode(ids[:max_tokens])
+
+    def assemble(self, system_prompt: str, user_template: str, question: str,
+                 chunks: List[str], history: List[Dict[str, Any]]):
+        """
+        :param system_prompt: 系统提示词
+        :param user_template: 本轮用户消息模板, 含 {document_chunk} {question}
+        :param chunks: 检索片段, 按相关度从高到低
+        :param history: 历史消息, 按时间从旧到新
+        :return: (messages, 选中的片段下标, 选中的历史条数, 各部分token统计)
+        """
+        question = self.truncate(question, self.max_question_tokens)
+        base_tokens = (self.count(system_prompt) + self.count(user_template.format(document_chunk='', question=question))
+                       + 2 * self.message_overhead)
+        remaining = self.max_prompt_tokens - base_tokens
+
+        # 检索片段: 按排名依次放入, 放不下的跳过, 尝试后面更短的片段
+        context_budget = min(self.context_max_tokens, remaining)
+        chunk_ids, context_tokens = [], 0
+        for i, chunk in enumerate(chunks):
+            n = self.count(chunk) + 1
+            if context_tokens + n <= context_budget:
+                chunk_ids.append(i)
+                context_tokens += n
+        remaining -= context_tokens
+
+        # 历史: 超出预算时从最旧处整段裁剪, 保留的历史连续且起点在若干轮内不变
+        history_budget = min(self.history_max_tokens, remaining)
+        sizes = [self.count(msg.get('content', '')) + self.message_overhead for msg in history]
+        start, history_tokens = 0, sum(sizes)
+        while history_tokens > history_budget and start < len(history):
+            history_tokens -= sum(sizes[start:start + self.history_trim_step])
+            start += self.history_trim_step
+        # 不以assistant消息开头
+        kept_history = history[start:]
+        while kept_history and kept_history[0].get('role') == 'assistant':
+            history_tokens -= self.count(kept_history[0].get('content', '')) + self.message_overhead
+            kept_history = kept_history[1:]
+
+        document_chunk = '\n'.join(chunks[i] for i in chunk_ids)
+        messages = [{"role": "system", "content": system_prompt}]
+        messages.extend({"role": m['role'], "content": m['content']} for m in kept_history)
+        messages.append({"role": "user", "content": user_template.format(document_chunk=document_chunk,
+                                                                          question=question)})
+        stats = {
+            'prompt_tokens': base_tokens + context_tokens + history_tokens,
+            'context_tokens': context_tokens,
+            'history_tokens': history_tokens,
+            'chunks': f"{len(chunk_ids)}/{len(chunks)}",
+            'history': f"{len(kept_history)}/{len(history)}",
+        }
+        logging.info(f"提示词组装 {stats}")
+        return messages, chunk_ids, len(kept_history), stats
+
+
+_budget_conf = get_config('chat', {}).get('prompt_budget', {})
+prompt_assembler = PromptAssembler(
+    max_prompt_tokens=_budget_conf.get('max_prompt_tokens', 6144),
+    context_max_tokens=_budget_conf.get('context_max_tokens', 3072),
+    history_max_tokens=_budget_conf.get('history_max_tokens', 2048),
+    max_question_tokens=_budget_conf.get('max_question_tokens', 512),
+    history_trim_step=get_config('chat', {}).get('history', {}).get('trim_step', 10),
+)
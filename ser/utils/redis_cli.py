@@ -2,9 +2,11 @@ import json
 import logging
 from fastapi import APIRouter
 import redis
+import redis.asyncio as aioredis
 from typing import List, Dict, Any
 
 from ser.utils.conf import get_config
+from ser.utils.metrics import timed
 
 router = APIRouter()
 
@@ -23,15 +25,32 @@ class RedisClient:
         """初始化 Redis 客户端"""
         redis_config = get_config('redis', {})  # 从配置文件获取 Redis 配置
 
-        self.client = redis.Redis(
+        self._pool_kwargs = dict(
             host=redis_config.get('host', 'localhost'),
             port=redis_config.get('port', 6379),
             db=redis_config.get('db', 0),
             password=redis_config.get('password', None),
             decode_responses=True,  # 自动解码响应
-            encoding='utf-8'
+            encoding='utf-8',
+            max_connections=redis_config.get('max_connections', 64),
         )
+        # 进程内共享连接池, 连接用尽时等待而不是报错
+        self.client = redis.Redis(connection_pool=redis.BlockingConnectionPool(**self._pool_kwargs))
+        self._async_client = None
 
+    @property
+    def async_client(self):
+        """异步客户端(redis.asyncio), 首次使用时创建, 共享连接池"""
+        if self._async_client is None:
+            self._async_client = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool(**self._pool_kwargs))
+        return self._async_client
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+    @timed('redis')
     def set_list(self, key: str, data_list: List[Dict[str, Any]]) -> bool:
         """
         存储 list<object> 到 Redis
@@ -48,6 +67,7 @@ class RedisClient:
             logging.error(f"存储数据到 Redis 失败: {e}")
             return False
 
+    @timed('redis')
     def get_list(self, key: str) -> List[Dict[str, Any]]:
         """
         从 Redis 获取 list<object>
@@ -63,25 +83,7 @@ class RedisClient:
             logging.error(f"从 Redis 获取数据失败: {e}")
             return []
 
-    def append_to_list(self, key: str, item: Dict[str, Any]) -> int:
-        """
-        向列表追加对象
-        :param key: 字符串键
-        :param item: 要追加的对象
-        :return: 列表长度
-        """
-        try:
-            # 获取现有列表
-            existing_list = self.get_list(key)
-            # 添加新项
-            existing_list.append(item)
-            # 重新存储
-            self.set_list(key, existing_list)
-            return len(existing_list)
-        except Exception as e:
-            logging.error(f"向 Redis 列表追加数据失败: {e}")
-            return -1
-
+    @timed('redis')
     def delete_key(self, key: str) -> bool:
         """
         删除指定键
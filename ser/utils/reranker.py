@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import List, Dict, Any, Optional, Tuple
+
+from ser.utils.conf import get_config
+from ser.utils.model_worker import model_client
+
+
+class RerankStage:
+    """
+    两阶段检索的重排序阶段
+    混合检索召回 candidates 条, cross-encoder 一次批量打分后保留 top_n 条;
+    延迟预算:
+      retrieval_budget_ms  向量化+检索已超出该耗时则跳过重排序, 不再叠加延迟
+      budget_ms            重排序阶段预算, 历史耗时(EMA)超出预算时跳过, 单次超时则放弃结果沿用召回顺序
+    """
+
+    def __init__(self, candidates: int = 20, top_n: int = 6, budget_ms: float = 300,
+                 retrieval_budget_ms: float = 800, min_score: Optional[float] = None):
+        self.candidates = candidates
+        self.top_n = top_n
+        self.budget_ms = budget_ms
+        self.retrieval_budget_ms = retrieval_budget_ms
+        self.min_score = min_score
+        self._ema_ms = None
+        self._lock = threading.Lock()
+        self._stats = {'reranked': 0, 'skipped_retrieval_budget': 0, 'skipped_rerank_budget': 0,
+                       'timeouts': 0, 'errors': 0}
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _observe(self, cost_ms: float):
+        with self._lock:
+            self._ema_ms = cost_ms if self._ema_ms is None else 0.8 * self._ema_ms + 0.2 * cost_ms
+
+    async def rerank(self, question: str, hits: List[Dict[str, Any]],
+                     elapsed_ms: float = 0) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        :param hits: 召回结果, 按融合分数降序
+        :param elapsed_ms: 本次请求在重排序之前已消耗的耗时
+        :return: (重排后的结果, 本阶段信息 {'reranked', 'reason', 'cost_ms'})
+        """
+        if len(hits) <= 1:
+            return hits, {'reranked': False, 'reason': 'too_few_hits', 'cost_ms': 0}
+        if elapsed_ms > self.retrieval_budget_ms:
+            self._count('skipped_retrieval_budget')
+            logging.info(f"检索耗时 {elapsed_ms:.0f}ms 超出预算, 跳过重排序")
+            return hits, {'reranked': False, 'reason': 'retrieval_budget', 'cost_ms': 0}
+        if self._ema_ms is not None and self._ema_ms > self.budget_ms:
+            # 跳过时让估计值回落, 负载下降后可恢复重排序
+            self._observe(self.budget_ms)
+            self._count('skipped_rerank_budget')
+            return hits, {'reranked': False, 'reason': 'rerank_budget', 'cost_ms': 0}
+
+        candidates = hits[:self.candidates]
+        st = time.time()
+        # 超时只放弃等待, 不取消调用: 调用结束前一直占用调度槽位(模型仍在计算), 迟到的结果丢弃
+        task = asyncio.ensure_future(model_client.rerank(question, [h['content'] for h in candidates]))
+        try:
+            scores = await asyncio.wait_for(asyncio.shield(task), timeout=self.budget_ms / 1000)
+        except asyncio.TimeoutError:
+            task.add_done_callback(self._drop_late)
+            cost_ms = (time.time() - st) * 1000
+            self._observe(cost_ms)
+            self._count('timeouts')
+            logging.warning(f"重排序超时 {cost_ms:.0f}ms, 沿用召回顺序")
+            return hits, {'reranked': False, 'reason': 'timeout', 'cost_ms': round(cost_ms)}
+        except Exception as e:
+            self._count('errors')
+            logging.error(f"重排序失败, 沿用召回顺序: {e}")
+            return hits, {'reranked': False, 'reason': 'error', 'cost_ms': 0}
+        cost_ms = (time.time() - st) * 1000
+        self._observe(cost_ms)
+        self._count('reranked')
+
+        for hit, score in zip(candidates, scores):
+            hit['rerank_score'] = score
+        ranked = sorted(candidates, key=lambda h: h['rerank_score'], reverse=True)
+        if self.min_score is not None:
+            ranked = [h for h in ranked if h['rerank_score'] >= self.min_score]
+        ranked = ranked[:self.top_n]
+        logging.info(f"重排序 {len(candidates)} -> {len(ranked)} 耗时 {cost_ms:.0f}ms")
+        return ranked, {'reranked': True, 'reason': None, 'cost_ms': round(cost_ms)}
+
+    @staticmethod
+    def _drop_late(task: asyncio.Future):
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning(f"超时的重排序调用失败: {task.exception()}")
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, 'ema_ms': round(self._ema_ms, 1) if self._ema_ms is not None else None}
+
+
+_rerank_conf = get_config('chat', {}).get('rerank', {})
+rerank_stage = RerankStage(
+    candidates=_rerank_conf.get('candidates', 20),
+    top_n=_rerank_conf.get('top_n', 6),
+    budget_ms=_rerank_conf.get('budget_ms', 300),
+    retrieval_budget_ms=_rerank_conf.get('retrieval_budget_ms', 800),
+    min_score=_rerank_conf.get('min_score'),
+) if _rerank_conf.get('enabled', False) else None
@@ -0,0 +1,151 @@
+import logging
+import time
+from typing import List, Dict, Any, Optional
+
+from ser.utils.conf import get_config
+from ser.utils.elasticsearch_cli import es_client
+
+
+class HybridRetriever:
+    """
+    混合检索: HNSW近似kNN向量召回 + multi_match全文召回, 两路一次msearch往返, 在本地融合
+    fusion=rrf      倒数排名融合 score = Σ w / (rrf_k + rank), 不依赖两路分数的量纲
+    fusion=weighted 各路分数归一化到[0,1]后加权求和, 全文按本次结果的最大分归一化, 向量分数本身即(1+cos)/2
+    """
+
+    def __init__(self, index: str, fusion: str = 'rrf', top_k: int = 20, knn_k: int = 50,
+                 num_candidates: int = 200, lexical_size: int = 50, rrf_k: int = 60, vector_weight: float = 0.6, lexical_weight: float = 0.4,
+                 min_similarity: Optional[float] = None, min_score: float = 0.0,
+                 lexical_fields: List[str] = None, fetch_vectors: bool = False):
+        if fusion not in ('rrf', 'weighted'):
+            raise ValueError(f"不支持的融合方式: {fusion}")
+        self.index = index
+        self.fusion = fusion
+        self.top_k = top_k
+        self.knn_k = knn_k
+        self.num_candidates = max(num_candidates, knn_k)
+        self.lexical_size = lexical_size
+        self.rrf_k = rrf_k
+        self.vector_weight = vector_weight
+        self.lexical_weight = lexical_weight
+        self.min_similarity = min_similarity
+        self.min_score = min_score
+        self.lexical_fields = lexical_fields or ['content', 'questions']
+        # 召回阶段不回传向量字段(每个候选512维), 需要向量时只为融合后的 top_k 按ID补取
+        self.source_excludes = ['emb_512']
+        self.fetch_vectors = fetch_vectors
+
+    def knn_body(self, query_vector, k: int) -> Dict[str, Any]:
+        knn = {
+            "field": "emb_512",
+            "query_vector": [float(x) for x in query_vector],
+            "k": k,
+            "num_candidates": max(self.num_candidates, k),
+        }
+        if self.min_similarity is not None:
+            knn["similarity"] = self.min_similarity
+        return {"knn": knn, "size": k, "_source": {"excludes": self.source_excludes}}
+
+    def lexical_body(self, query_text: str, size: int) -> Dict[str, Any]:
+        return {
+            "query": {"multi_match": {"query": query_text, "fields": self.lexical_fields}},
+            "size": size,
+            "_source": {"excludes": self.source_excludes},
+        }
+
+    def fuse(self, vector_hits: List[Dict], lexical_hits: List[Dict]) -> List[Dict[str, Any]]:
+        """融合两路结果, 按融合分数降序"""
+        merged: Dict[str, Dict[str, Any]] = {}
+        max_lexical = max((h['_score'] for h in lexical_hits), default=0) or 1.0
+        for source, hits, weight in (('vector', vector_hits, self.vector_weight),
+                                     ('lexical', lexical_hits, self.lexical_weight)):
+            for rank, hit in enumerate(hits, start=1):
+                item = merged.setdefault(hit['_id'], {
+                    'id': hit['_id'],
+                    'score': 0.0,
+                    'content': hit['_source']['content'],
+                    'doc_oid': hit['_source'].get('doc_oid'),
+                    'content_hash': hit['_source'].get('content_hash'),
+                    # fetch_vectors 时由 _attach_vectors 补取, 供MMR计算片段间相似度
+                    'emb_512': None,
+                    'vector_score': None,
+                    'lexical_score': None,
+                })
+                item[f'{source}_score'] = hit['_score']
+                if self.fusion == 'rrf':
+                    item['score'] += weight / (self.rrf_k + rank)
+                else:
+                    norm = hit['_score'] if source == 'vector' else hit['_score'] / max_lexical
+                    item['score'] += weight * norm
+        return sorted(merged.values(), key=lambda item: item['score'], reverse=True)
+
+    def _queries(self, query_text: str, query_vector, top_k: int):
+        return [
+            self.knn_body(query_vector, max(self.knn_k, top_k)),
+            self.lexical_body(query_text, max(self.lexical_size, top_k)),
+        ]
+
+    def search(self, query_text: str, query_vector, top_k: Optional[int] = None,
+               min_score: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        :return: [{'id', 'score'(融合分), 'content', 'doc_oid', 'content_hash', 'emb_512',
+                   'vector_score', 'lexical_score'}]
+        """
+        top_k = top_k or self.top_k
+        st = time.time()
+        responses = es_client.msearch(self.index, self._queries(query_text, query_vector, top_k))
+        fused = self._collect(responses, top_k, min_score)
+        if self.fetch_vectors and fused:
+            self._attach_vectors(fused, es_client.mget(self.index, [item['id'] for item in fused], ['emb_512']))
+        self._log(responses, fused, st)
+        return fused
+
+    async def asearch(self, query_text: str, query_vector, top_k: Optional[int] = None,
+                      min_score: Optional[float] = None) -> List[Dict[str, Any]]:
+        """异步检索, 不占用线程池"""
+        top_k = top_k or self.top_k
+        st = time.time()
+        responses = await es_client.async_msearch(self.index, self._queries(query_text, query_vector, top_k))
+        fused = self._collect(responses, top_k, min_score)
+        if self.fetch_vectors and fused:
+            self._attach_vectors(fused, await es_client.async_mget(self.index, [item['id'] for item in fused],
+                                                                   ['emb_512']))
+        self._log(responses, fused, st)
+        return fused
+
+    @staticmethod
+    def _hits(responses):
+        return [r.get('hits', {}).get('hits', []) for r in responses]
+
+    def _collect(self, responses, top_k: int, min_score: Optional[float]) -> List[Dict[str, Any]]:
+        min_score = self.min_score if min_score is None else min_score
+        vector_hits, lexical_hits = self._hits(responses)
+        return [item for item in self.fuse(vector_hits, lexical_hits) if item['score'] >= min_score][:top_k]
+
+    @staticmethod
+    def _attach_vectors(fused: List[Dict[str, Any]], sources: Dict[str, Dict]):
+        for item in fused:
+            item['emb_512'] = sources.get(item['id'], {}).get('emb_512')
+
+    def _log(self, responses, fused: List[Dict[str, Any]], st: float):
+        vector_hits, lexical_hits = self._hits(responses)
+        logging.info(f"混合检索 fusion={self.fusion} 向量 {len(vector_hits)} 全文 {len(lexical_hits)} "
+                     f"融合后 {len(fused)} 补取向量 {self.fetch_vectors} 耗时 {(time.time() - st) * 1000:.1f}ms")
+
+
+_retrieval_conf = get_config('chat', {}).get('retrieval', {})
+retriever = HybridRetriever(
+    index='rag_demo_es_document_index',
+    fusion=_retrieval_conf.get('fusion', 'rrf'),
+    top_k=_retrieval_conf.get('top_k', 20),
+    knn_k=_retrieval_conf.get('knn_k', 50),
+    num_candidates=_retrieval_conf.get('num_candidates', 200),
+    lexical_size=_retrieval_conf.get('lexical_size', 50),
+    rrf_k=_retrieval_conf.get('rrf_k', 60),
+    vector_weight=_retrieval_conf.get('vector_weight', 0.6),
+    lexical_weight=_retrieval_conf.get('lexical_weight', 0.4),
+    min_similarity=_retrieval_conf.get('min_similarity'),
+    min_score=_retrieval_conf.get('min_score', 0.0),
+    # 开启上下文选择(MMR)时为融合结果补取片段向量
+    fetch_vectors=get_config('chat', {}).get('context_select', {}).get('enabled', True),
+)
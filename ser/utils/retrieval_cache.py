@@ -0,0 +1,78 @@
+import hashlib
+import json
+import logging
+from typing import List, Dict, Any, Optional, Tuple
+
+from ser.utils.conf import get_config
+from ser.utils.embed_cache import normalize_query
+from ser.utils.redis_cli import redis_client
+
+
+def generation_key(index: str) -> str:
+    return f"es_index_generation:{index}"
+
+
+def bump_index_generation(indexes) -> None:
+    """索引写入成功后递增代数, 旧代数下的检索缓存随之失效"""
+    try:
+        pipe = redis_client.client.pipeline()
+        for index in set(indexes):
+            pipe.incr(generation_key(index))
+        pipe.execute()
+    except Exception as e:
+        logging.error(f"递增索引代数失败: {e}")
+
+
+class RetrievalCache:
+    """
+    检索结果缓存
+    键 = 索引代数 + 查询指纹(归一化问题文本, top_k, min_score, 检索配置); 索引每次写入后代数递增,
+    旧代数的条目不再被命中, 无需扫描删除, 由TTL自然过期
+    """
+
+    def __init__(self, index: str, ttl_s: int = 300, config_tag: str = ''):
+        self.index = index
+        self.ttl_s = ttl_s
+        # 检索参数(融合方式/候选数等)变化时指纹随之变化
+        self.config_tag = config_tag
+
+    def fingerprint(self, query_text: str, top_k: int, min_score: float) -> str:
+        raw = json.dumps([normalize_query(query_text), top_k, min_score, self.config_tag], ensure_ascii=False)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def _key(self, generation: int, fingerprint: str) -> str:
+        return f"retrieval_cache:{self.index}:{generation}:{fingerprint}"
+
+    async def get(self, query_text: str, top_k: int,
+                  min_score: float) -> Tuple[Optional[List[Dict[str, Any]]], int]:
+        """
+        :return: (命中的检索结果或None, 当前索引代数); 未命中时用该代数写回, 检索期间索引变化则写入即过时
+        """
+        try:
+            client = redis_client.async_client
+            generation = int(await client.get(generation_key(self.index)) or 0)
+            raw = await client.get(self._key(generation, self.fingerprint(query_text, top_k, min_score)))
+            return (json.loads(raw) if raw else None), generation
+        except Exception as e:
+            logging.error(f"检索缓存读取失败: {e}")
+            return None, -1
+
+    async def put(self, query_text: str, top_k: int, min_score: float,
+                  hits: List[Dict[str, Any]], generation: int):
+        if generation < 0:
+            return
+        try:
+            await redis_client.async_client.set(
+                self._key(generation, self.fingerprint(query_text, top_k, min_score)),
+                json.dumps(hits, ensure_ascii=False), ex=self.ttl_s)
+        except Exception as e:
+            logging.error(f"检索缓存写入失败: {e}")
+
+
+_retrieval_conf = get_config('chat', {}).get('retrieval', {})
+_cache_conf = _retrieval_conf.get('cache', {})
+retrieval_cache = RetrievalCache(
+    index='rag_demo_es_document_index',
+    ttl_s=_cache_conf.get('ttl_s', 300),
+    config_tag=json.dumps({k: v for k, v in sorted(_retrieval_conf.items()) if k != 'cache'}),
+) if _cache_conf.get('enabled', True) else None
@@ -0,0 +1,229 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+from ser.utils.comm import vector_to_b64, b64_to_vector
+from ser.utils.conf import get_config
+from ser.utils.redis_cli import redis_client
+
+
+class SemanticCache:
+    """
+    语义答案缓存
+    以问题向量为键, 余弦相似度超过阈值即复用已有回答;
+    记录回答所用的文档, 文档重新分片入库时失效相关条目; 条目带TTL且总数有上限
+    redis结构:
+      {prefix}:entry:{id}    条目JSON, 带TTL
+      {prefix}:vectors       hash id -> 问题向量
+      {prefix}:index         zset id -> 写入时间, 用于容量淘汰/过期清理, 也作为新增日志
+      {prefix}:removed       zset id -> 删除时间, 删除日志, 保留 log_retention_s
+      {prefix}:doc:{doc_oid} set  引用该文档的条目id
+      {prefix}:stats         hash 命中/未命中/节省耗时
+    本地向量矩阵最多每 refresh_interval_s 秒同步一次, 只拉取上次同步之后新增/删除的条目;
+    首次加载或长时间未同步(超过删除日志保留时间)时全量加载. 同步时顺带清理已过期的条目
+    """
+
+    # 新增/删除日志按写入方本地时间记录, 增量同步时向前多取一段, 容忍进程间时钟偏差与写入延迟
+    clock_skew_s = 5
+
+    def __init__(self, threshold: float = 0.95, ttl_s: int = 86400, max_entries: int = 1000,
+                 prefix: str = 'semantic_cache', refresh_interval_s: float = 1.0, log_retention_s: int = 3600):
+        self.threshold = threshold
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.prefix = prefix
+        self.refresh_interval_s = refresh_interval_s
+        self.log_retention_s = log_retention_s
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._synced_at = None  # 上次同步开始的时间
+        self._checked_at = 0.0
+        self._ids: List[str] = []
+        self._matrix: Optional[np.ndarray] = None
+
+    @property
+    def client(self):
+        return redis_client.client
+
+    def _key(self, *parts):
+        return ':'.join([self.prefix, *parts])
+
+    def _refresh(self):
+        """同步本地向量矩阵, 限频; 其他线程正在同步时直接使用当前矩阵"""
+        now = time.time()
+        if self._synced_at is not None and now - self._checked_at < self.refresh_interval_s:
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = now
+            self._prune(now)
+            if self._synced_at is None or now - self._synced_at > self.log_retention_s - self.clock_skew_s:
+                self._load_all()
+            else:
+                self._load_changes(self._synced_at - self.clock_skew_s)
+            self._synced_at = now
+        finally:
+            self._refresh_lock.release()
+
+    def _load_all(self):
+        vectors = self.client.hgetall(self._key('vectors'))
+        with self._lock:
+            self._ids = list(vectors.keys())
+            self._matrix = np.stack([b64_to_vector(v) for v in vectors.values()]) if vectors else None
+
+    def _load_changes(self, since: float):
+        """只拉取 since 之后新增与删除的条目"""
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zrangebyscore(self._key('index'), since, '+inf')
+        pipe.zrangebyscore(self._key('removed'), since, '+inf')
+        added, removed = pipe.execute()
+        with self._lock:
+            known = set(self._ids)
+        added = [i for i in added if i not in known]
+        vectors = self.client.hmget(self._key('vectors'), added) if added else []
+        self._apply([i for i, v in zip(added, vectors) if v is not None],
+                    [b64_to_vector(v) for v in vectors if v is not None], removed)
+
+    def _apply(self, added_ids: List[str], added_vectors: List[np.ndarray], removed_ids):
+        """本地矩阵追加新增行并去掉已删除的行"""
+        removed = set(removed_ids)
+        with self._lock:
+            ids, matrix = self._ids, self._matrix
+            if removed and matrix is not None:
+                keep = [n for n, i in enumerate(ids) if i not in removed]
+                if len(keep) < len(ids):
+                    ids = [ids[n] for n in keep]
+                    matrix = matrix[keep] if keep else None
+            if added_ids:
+                rows = np.stack(added_vectors)
+                ids = ids + added_ids
+                matrix = rows if matrix is None else np.vstack([matrix, rows])
+            self._ids, self._matrix = ids, matrix
+
+    def _prune(self, now: float):
+        """清理已过期条目的残留向量与索引"""
+        expired = self.client.zrangebyscore(self._key('index'), '-inf', now - self.ttl_s)
+        if expired:
+            self._remove(expired)
+            logging.info(f"语义缓存清理过期条目 {len(expired)}")
+
+    def lookup(self, vector) -> Optional[Dict[str, Any]]:
+        """查找相似问题的缓存回答, 命中返回条目(含similarity/saved_ms)"""
+        st = time.time()
+        try:
+            self._refresh()
+            with self._lock:
+                ids, matrix = self._ids, self._matrix
+            if matrix is not None:
+                sims = matrix @ np.asarray(vector, dtype=np.float32)
+                for i in np.argsort(-sims):
+                    if sims[i] < self.threshold:
+                        break
+                    raw = self.client.get(self._key('entry', ids[i]))
+                    if raw is None:
+                        # 条目已过期, 清理残留向量
+                        self._remove([ids[i]])
+                        continue
+                    entry = json.loads(raw)
+                    lookup_ms = (time.time() - st) * 1000
+                    entry['similarity'] = round(float(sims[i]), 4)
+                    entry['saved_ms'] = max(0, round(entry.get('cost_ms', 0) - lookup_ms))
+                    pipe = self.client.pipeline()
+                    pipe.hincrby(self._key('stats'), 'hits', 1)
+                    pipe.hincrbyfloat(self._key('stats'), 'saved_ms', entry['saved_ms'])
+                    pipe.execute()
+                    logging.info(f"语义缓存命中 相似度={entry['similarity']} 节省 {entry['saved_ms']}ms")
+                    return entry
+            self.client.hincrby(self._key('stats'), 'misses', 1)
+        except Exception as e:
+            logging.error(f"语义缓存查询失败: {e}")
+        return None
+
+    def store(self, question: str, vector, answer: str, related_docs: str,
+              chunk_ids: List[str], doc_oids: List[str], cost_ms: float):
+        """写入缓存条目并登记所引用的文档"""
+        try:
+            entry_id = uuid.uuid4().hex
+            entry = {
+                'question': question,
+                'answer': answer,
+                'related_docs': related_docs,
+                'chunk_ids': chunk_ids,
+                'doc_oids': doc_oids,
+                'cost_ms': round(cost_ms),
+                'created': time.time(),
+            }
+            pipe = self.client.pipeline()
+            pipe.set(self._key('entry', entry_id), json.dumps(entry, ensure_ascii=False), ex=self.ttl_s)
+            pipe.hset(self._key('vectors'), entry_id, vector_to_b64(vector))
+            pipe.zadd(self._key('index'), {entry_id: entry['created']})
+            for doc_oid in set(doc_oids):
+                pipe.sadd(self._key('doc', str(doc_oid)), entry_id)
+                pipe.expire(self._key('doc', str(doc_oid)), self.ttl_s)
+            pipe.execute()
+            # 本进程立即可见, 其他进程在下次同步时通过新增日志拉取
+            self._apply([entry_id], [np.asarray(vector, dtype=np.float16).astype(np.float32)], [])
+            # 超出容量时淘汰最早的条目
+            overflow = self.client.zcard(self._key('index')) - self.max_entries
+            if overflow > 0:
+                self._remove(self.client.zrange(self._key('index'), 0, overflow - 1))
+        except Exception as e:
+            logging.error(f"语义缓存写入失败: {e}")
+
+    def _remove(self, entry_ids: List[str]):
+        if not entry_ids:
+            return
+        now = time.time()
+        pipe = self.client.pipeline()
+        pipe.delete(*[self._key('entry', i) for i in entry_ids])
+        pipe.hdel(self._key('vectors'), *entry_ids)
+        pipe.zrem(self._key('index'), *entry_ids)
+        # 记录删除日志供其他进程增量同步, 超出保留时间的日志截断
+        pipe.zadd(self._key('removed'), {i: now for i in entry_ids})
+        pipe.zremrangebyscore(self._key('removed'), '-inf', now - self.log_retention_s)
+        pipe.execute()
+        self._apply([], [], entry_ids)
+
+    def invalidate_docs(self, doc_oids: List[str]) -> int:
+        """文档重新入库时, 删除引用这些文档的缓存条目"""
+        try:
+            entry_ids = set()
+            for doc_oid in doc_oids:
+                key = self._key('doc', str(doc_oid))
+                entry_ids.update(self.client.smembers(key))
+                self.client.delete(key)
+            self._remove(list(entry_ids))
+            if entry_ids:
+                logging.info(f"语义缓存失效 文档={doc_oids} 条目数={len(entry_ids)}")
+            return len(entry_ids)
+        except Exception as e:
+            logging.error(f"语义缓存失效失败: {e}")
+            return 0
+
+    def stats(self):
+        raw = self.client.hgetall(self._key('stats'))
+        hits, misses = int(raw.get('hits', 0)), int(raw.get('misses', 0))
+        saved_ms = float(raw.get('saved_ms', 0))
+        return {
+            'entries': self.client.zcard(self._key('index')),
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 4) if hits + misses else 0,
+            'saved_ms_total': round(saved_ms),
+            'saved_ms_avg': round(saved_ms / hits) if hits else 0,
+        }
+
+
+_semantic_conf = get_config('chat', {}).get('semantic_cache', {})
+semantic_cache = SemanticCache(
+    threshold=_semantic_conf.get('threshold', 0.95),
+    ttl_s=_semantic_conf.get('ttl_s', 86400),
+    max_entries=_semantic_conf.get('max_entries', 1000),
+    refresh_interval_s=_semantic_conf.get('refresh_interval_s', 1.0),
+) if _semantic_conf.get('enabled', True) else None
@@ -0,0 +1,273 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from typing import Dict
+
+from ser.utils.conf import get_config
+
+# 通道按优先级排列, 靠前的优先获得槽位
+LANES = ('chat', 'ingest')
+
+
+class QueueFullError(Exception):
+    """通道排队已满或等待超时, 由API层转换为429"""
+
+    def __init__(self, lane: str, retry_after: int):
+        super().__init__(f"{lane} 通道繁忙, 请 {retry_after}s 后重试")
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+class _Lane:
+    def __init__(self, name: str, max_concurrency: int = 4, max_queue: int = 32, max_wait_s: float = None,
+                 busy_concurrency: int = None):
+        self.name = name
+        self.max_concurrency = max(1, int(max_concurrency))
+        # 高优先级通道有执行中或排队的调用时, 本通道的并发上限
+        self.busy_concurrency = (min(self.max_concurrency, max(1, int(busy_concurrency)))
+                                 if busy_concurrency is not None else self.max_concurrency)
+        self.max_queue = max(0, int(max_queue))
+        self.max_wait_s = max_wait_s
+        self.active = 0
+        self.waiters = deque()
+        # 单次占用时长的滑动平均, 按调用类型(llm/embed/rerank)分别统计, 用于估计 Retry-After
+        self.ema_s: Dict[str, float] = {}
+        self.stats = {'admitted': 0, 'queued': 0, 'rejected': 0, 'timeouts': 0}
+
+
+class _Waiter:
+    """排队凭据; state 只在调度器锁内修改, 决定槽位归属"""
+    __slots__ = ('event', 'loop', 'future', 'state')
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+        self.event = threading.Event() if loop is None else None
+        self.state = 'waiting'
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._set_result)
+
+    def _set_result(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class Reservation:
+    """已获得的槽位, 由持有者在调用结束时释放; release 可重复调用, 只生效一次"""
+
+    def __init__(self, scheduler: 'WorkScheduler', lane_name: str, kind: str = 'llm'):
+        self._scheduler = scheduler
+        self.lane_name = lane_name
+        self.kind = kind
+        self._st = time.time()
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._scheduler.release(self.lane_name, time.time() - self._st, self.kind)
+
+
+class WorkScheduler:
+    """
+    模型调用准入控制
+    embed/llm 调用按通道排队: chat 为交互请求, ingest 为批量入库与后台任务;
+    每个通道有独立的并发上限与有界队列, 所有通道共享 max_total 个槽位;
+    槽位释放时先唤醒高优先级通道, 高优先级通道有等待时低优先级不获得新槽位;
+    高优先级通道有执行中的调用时, 低优先级通道并发降到 busy_concurrency, 避免入库占满模型.
+    入库按批次(分片组)申请槽位, 每批结束即释放, 因此聊天请求到达后最多等待当前批次完成.
+    队列满或等待超时抛出 QueueFullError, 携带估计的 Retry-After 秒数
+    """
+
+    def __init__(self, lanes: Dict[str, dict], max_total: int = 16):
+        self.max_total = max(1, int(max_total))
+        self._lanes = {name: _Lane(name, **lanes.get(name, {})) for name in LANES}
+        self._lock = threading.Lock()
+        self._total = 0
+
+    def _higher_waiting(self, lane: _Lane) -> bool:
+        for name in LANES:
+            if name == lane.name:
+                return False
+            if self._lanes[name].waiters:
+                return True
+        return False
+
+    def _higher_busy(self, lane: _Lane) -> bool:
+        for name in LANES:
+            if name == lane.name:
+                return False
+            if self._lanes[name].active or self._lanes[name].waiters:
+                return True
+        return False
+
+    def _can_run(self, lane: _Lane) -> bool:
+        limit = lane.busy_concurrency if self._higher_busy(lane) else lane.max_concurrency
+        return lane.active < limit and self._total < self.max_total
+
+    def _grant(self, lane: _Lane):
+        lane.active += 1
+        lane.stats['admitted'] += 1
+        self._total += 1
+
+    def _dispatch(self):
+        """锁内调用, 按优先级把空闲槽位分给等待者"""
+        for name in LANES:
+            lane = self._lanes[name]
+            while lane.waiters and self._can_run(lane):
+                waiter = lane.waiters.popleft()
+                waiter.state = 'granted'
+                self._grant(lane)
+                waiter.wake()
+            if lane.waiters:
+                break
+
+    def _retry_after(self, lane: _Lane) -> int:
+        # 排队者主要在等生成结束, 优先按llm调用耗时估计, embed等短调用不拉低估计
+        per_slot = lane.ema_s.get('llm', lane.ema_s.get('embed', 1.0))
+        return max(1, math.ceil(per_slot * (len(lane.waiters) + 1) / lane.max_concurrency))
+
+    def _reject(self, lane: _Lane, reason: str) -> QueueFullError:
+        lane.stats[reason] += 1
+        retry_after = self._retry_after(lane)
+        logging.warning(f"模型调用拒绝 lane={lane.name} reason={reason} 活跃 {lane.active} "
+                        f"排队 {len(lane.waiters)} retry_after={retry_after}s")
+        return QueueFullError(lane.name, retry_after)
+
+    def _enqueue(self, lane: _Lane, bounded: bool, loop=None):
+        """锁内调用: 可立即执行返回None, 否则返回排队凭据"""
+        if not lane.waiters and not self._higher_waiting(lane) and self._can_run(lane):
+            self._grant(lane)
+            return None
+        if bounded and len(lane.waiters) >= lane.max_queue:
+            raise self._reject(lane, 'rejected')
+        waiter = _Waiter(loop)
+        lane.waiters.append(waiter)
+        lane.stats['queued'] += 1
+        return waiter
+
+    def _abandon(self, lane: _Lane, waiter: _Waiter) -> bool:
+        """等待超时或取消; 返回 True 表示已获得槽位(竞争中刚被分配), 由调用方释放"""
+        with self._lock:
+            if waiter.state == 'granted':
+                return True
+            waiter.state = 'abandoned'
+            lane.waiters.remove(waiter)
+            # 队首离开后低优先级通道可能可以执行
+            self._dispatch()
+            return False
+
+    def check(self, lane_name: str):
+        """入口快速检查, 队列已满时直接拒绝, 避免做完检索后才被拒绝"""
+        lane = self._lanes[lane_name]
+        with self._lock:
+            if len(lane.waiters) >= lane.max_queue and not self._can_run(lane):
+                raise self._reject(lane, 'rejected')
+
+    def acquire(self, lane_name: str, bounded: bool = True):
+        """同步申请槽位(线程内调用)"""
+        lane = self._lanes[lane_name]
+        with self._lock:
+            waiter = self._enqueue(lane, bounded)
+        if waiter is None:
+            return
+        timeout = lane.max_wait_s if bounded else None
+        if waiter.event.wait(timeout):
+            return
+        if self._abandon(lane, waiter):
+            return
+        with self._lock:
+            raise self._reject(lane, 'timeouts')
+
+    async def aacquire(self, lane_name: str, bounded: bool = True):
+        """异步申请槽位, 排队时不占用线程"""
+        lane = self._lanes[lane_name]
+        with self._lock:
+            waiter = self._enqueue(lane, bounded, asyncio.get_running_loop())
+        if waiter is None:
+            return
+        timeout = lane.max_wait_s if bounded else None
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+            return
+        except asyncio.TimeoutError:
+            if self._abandon(lane, waiter):
+                return
+            with self._lock:
+                raise self._reject(lane, 'timeouts')
+        except asyncio.CancelledError:
+            # 调用方取消(如重排序超时), 已分配的槽位立即归还
+            if self._abandon(lane, waiter):
+                self.release(lane_name)
+            raise
+
+    def release(self, lane_name: str, held_s: float = None, kind: str = 'llm'):
+        lane = self._lanes[lane_name]
+        with self._lock:
+            lane.active -= 1
+            self._total -= 1
+            if held_s is not None:
+                ema = lane.ema_s.get(kind)
+                lane.ema_s[kind] = held_s if ema is None else ema * 0.9 + held_s * 0.1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, lane_name: str, bounded: bool = True, kind: str = 'llm'):
+        """:param kind: 调用类型, 各类型耗时分别统计"""
+        self.acquire(lane_name, bounded)
+        st = time.time()
+        try:
+            yield
+        finally:
+            self.release(lane_name, time.time() - st, kind)
+
+    async def areserve(self, lane_name: str, bounded: bool = True, kind: str = 'llm') -> Reservation:
+        """
+        申请槽位并交给调用方持有, 用于槽位需要跨出当前协程的场景(流式响应):
+        在请求处理函数内排队, 通道已满时 QueueFullError 在返回响应前抛出(429)
+        """
+        await self.aacquire(lane_name, bounded)
+        return Reservation(self, lane_name, kind)
+
+    @asynccontextmanager
+    async def aslot(self, lane_name: str, bounded: bool = True, kind: str = 'llm'):
+        await self.aacquire(lane_name, bounded)
+        st = time.time()
+        try:
+            yield
+        finally:
+            self.release(lane_name, time.time() - st, kind)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'total': self._total,
+                'max_total': self.max_total,
+                'lanes': {name: {
+                    'active': lane.active,
+                    'waiting': len(lane.waiters),
+                    'max_concurrency': lane.max_concurrency,
+                    'busy_concurrency': lane.busy_concurrency,
+                    'max_queue': lane.max_queue,
+                    'ema_s': {kind: round(ema, 3) for kind, ema in lane.ema_s.items()},
+                    **lane.stats,
+                } for name, lane in self._lanes.items()},
+            }
+
+
+_scheduler_conf = get_config('model', {}).get('work_scheduler', {})
+work_scheduler = WorkScheduler(
+    lanes=_scheduler_conf.get('lanes', {}),
+    max_total=_scheduler_conf.get('max_total', 16),
+) if _scheduler_conf.get('enabled', False) else None